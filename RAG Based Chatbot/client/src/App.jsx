@@ -276,6 +276,35 @@ function App() {
     }
   };
 
+  // Follow a background ingestion job (202 from /upload or /ingest-url) until it finishes,
+  // showing its progress and a cancel button in the loading toast
+  const followJob = async (job, toast, toastId, label) => {
+    while (!['done', 'failed', 'cancelled'].includes(job.status)) {
+      const progress = job.progress || {};
+      const detail = job.status === 'queued'
+        ? 'queued'
+        : `${progress.pages ? `${progress.pages} pages, ` : ''}${progress.stored || 0}/${progress.chunks || 0} chunks stored`;
+      toast.loading(
+        <span>
+          {label} ({detail})
+          <button
+            onClick={() => fetch(`${API_BASE}/jobs/${job.id}`, { method: 'DELETE' })}
+            className="ml-3 px-2 py-0.5 text-xs rounded-lg bg-gray-200 hover:bg-gray-300 text-gray-700 transition-colors"
+          >
+            Cancel
+          </button>
+        </span>,
+        { id: toastId }
+      );
+      await new Promise(resolve => setTimeout(resolve, 1000));
+      const res = await fetch(`${API_BASE}/jobs/${job.id}`);
+      if (!res.ok) throw new Error('Lost track of the ingestion job');
+      job = await res.json();
+    }
+    if (job.status === 'failed') throw new Error(job.error || 'Ingestion failed');
+    return job;
+  };
+
   const handleFileUpload = async (file) => {
     setIsLoading(true);
     const formData = new FormData();
@@ -294,6 +323,14 @@ function App() {
       if (!response.ok) throw new Error('Upload failed');
       
       const data = await response.json();
+
+      if (response.status === 202) {
+        const job = await followJob(data, toast, loadingToast, `Processing ${file.name}`);
+        if (job.status === 'cancelled') {
+          toast('Upload cancelled', { id: loadingToast });
+          return;
+        }
+      }
       
       toast.success('Document processed successfully!', { id: loadingToast });
       
@@ -338,10 +375,19 @@ function App() {
       }
       
       const data = await response.json();
+
+      let numPages = 1;
+      if (response.status === 202) {
+        const job = await followJob(data, toast, loadingToast, 'Processing URL');
+        if (job.status === 'cancelled') {
+          toast('Ingestion cancelled', { id: loadingToast });
+          return;
+        }
+        numPages = job.result?.pages || 1;
+      }
       
       toast.success('URL processed successfully!', { id: loadingToast });
 
-      let numPages = 1;
       try {
          if (data.details) {
             const parsed = JSON.parse(data.details);
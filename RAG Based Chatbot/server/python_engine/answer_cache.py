@@ -0,0 +1,113 @@
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from config import ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_THRESHOLD
+
+def answer_scope(model, system_prompt, active_documents):
+    """Everything besides the question that changes the answer."""
+    prompt_hash = hashlib.sha1((system_prompt or "").encode("utf-8")).hexdigest()
+    return (model, prompt_hash, tuple(sorted(set(active_documents or []))))
+
+def corpus_signature(state, active_documents):
+    """Changes whenever one of the sources is re-ingested (new seqs) or loses chunks.
+
+    With no active_documents the answer may draw on any source, so the whole index counts.
+    """
+    if not active_documents:
+        return ("*", len(state.ids), int(state.seqs.max()) if len(state.seqs) else 0)
+    signature = []
+    for source in sorted(set(active_documents)):
+        rows = state.source_rows.get(source)
+        if rows is None or not len(rows):
+            signature.append((source, 0, 0))
+        else:
+            signature.append((source, len(rows), int(state.seqs[rows].max())))
+    return tuple(signature)
+
+def replay_tokens(text):
+    # Word-sized pieces, so a cached answer streams like a generated one
+    return re.findall(r"\s*\S+", text)
+
+
+class AnswerCache:
+    """Semantic cache of final answers for repeated questions.
+
+    Entries are grouped by scope (model, system prompt, active documents) and
+    matched on cosine similarity of the query embeddings, at or above
+    `threshold`. Each entry remembers the corpus signature of its sources, so a
+    re-ingested or deleted source invalidates it on the next lookup. Eviction
+    is LRU over `max_entries`, plus a TTL in seconds.
+    """
+
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, threshold=ANSWER_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = OrderedDict()  # key -> entry dict
+        self.lock = threading.Lock()
+        self.next_key = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def lookup(self, query_vector, scope, signature):
+        """Return the best matching live entry ({answer, sources, followups, similarity}) or None."""
+        query = self.normalize(query_vector)
+        now = time.time()
+        with self.lock:
+            best_key, best_similarity = None, self.threshold
+            for key, entry in list(self.entries.items()):
+                if entry["scope"] != scope:
+                    continue
+                if now - entry["created"] > self.ttl or entry["signature"] != signature:
+                    del self.entries[key]
+                    self.invalidated += 1
+                    continue
+                if len(entry["vector"]) != len(query):
+                    continue
+                similarity = float(entry["vector"] @ query)
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best_key)
+            entry = self.entries[best_key]
+            return {"answer": entry["answer"], "sources": list(entry["sources"]),
+                    "followups": list(entry["followups"]), "similarity": round(best_similarity, 4)}
+
+    def store(self, query_vector, scope, signature, answer, sources, followups):
+        with self.lock:
+            self.entries[self.next_key] = {
+                "vector": self.normalize(query_vector), "scope": scope, "signature": signature,
+                "answer": answer, "sources": list(sources), "followups": list(followups), "created": time.time()
+            }
+            self.next_key += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    @staticmethod
+    def normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidated": self.invalidated,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
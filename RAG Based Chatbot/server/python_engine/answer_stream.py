@@ -0,0 +1,76 @@
+import re
+import json
+
+SOURCE_MARKER = "SOURCE_RELEVANT:"
+FOLLOWUP_MARKER = "FOLLOWUP:"
+MARKERS = (SOURCE_MARKER, FOLLOWUP_MARKER)
+FOLLOWUP_LIST = re.compile(r"\[.*\]")
+MARKER_PREFIXES = frozenset(marker[:n] for marker in MARKERS for n in range(1, len(marker)))
+LONGEST_PREFIX = max(map(len, MARKER_PREFIXES))
+
+def marker_prefix_length(text):
+    """Length of the longest suffix of `text` that could still grow into a marker."""
+    for length in range(min(len(text), LONGEST_PREFIX), 0, -1):
+        if text[-length:] in MARKER_PREFIXES:
+            return length
+    return 0
+
+
+class AnswerStream:
+    """Splits a streamed completion into answer text and the trailing metadata lines.
+
+    feed() returns the part of each token that is safe to show: anything
+    that might be the start of a marker is held back until the next token
+    settles it, so a marker split across tokens never reaches the client.
+    From the first marker on, text goes to the metadata buffer instead.
+    Only the held-back tail (shorter than a marker) is rescanned per token.
+    """
+
+    def __init__(self):
+        self.answer = []     # emitted pieces
+        self.metadata = []   # raw text from the first marker on
+        self.pending = ""    # held back: could be the start of a marker
+
+    def feed(self, token):
+        if self.metadata:
+            self.metadata.append(token)
+            return ""
+        text = self.pending + token
+        starts = [i for i in (text.find(marker) for marker in MARKERS) if i != -1]
+        if starts:
+            cut = min(starts)
+            self.metadata.append(text[cut:])
+            self.pending = ""
+        else:
+            cut = len(text) - marker_prefix_length(text)
+            self.pending = text[cut:]
+        if cut:
+            self.answer.append(text[:cut])
+        return text[:cut]
+
+    def close(self):
+        """Flush the held-back tail when the stream ends without a marker; returns it for emitting."""
+        tail, self.pending = self.pending, ""
+        if tail:
+            self.answer.append(tail)
+        return tail
+
+    def result(self):
+        """Return (answer text, {"source_relevant": bool, "followups": list})."""
+        metadata = {"source_relevant": True, "followups": []}
+        raw = "".join(self.metadata)
+        source_at = raw.find(SOURCE_MARKER)
+        if source_at != -1:
+            value = raw[source_at + len(SOURCE_MARKER):].split("\n", 1)[0]
+            metadata["source_relevant"] = "true" in value.strip().lower()
+        followup_at = raw.find(FOLLOWUP_MARKER)
+        if followup_at != -1:
+            match = FOLLOWUP_LIST.search(raw, followup_at + len(FOLLOWUP_MARKER))
+            if match:
+                try:
+                    followups = json.loads(match.group(0))
+                    if isinstance(followups, list):
+                        metadata["followups"] = followups
+                except ValueError:
+                    pass
+        return "".join(self.answer).strip(), metadata
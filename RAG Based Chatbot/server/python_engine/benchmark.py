@@ -0,0 +1,431 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+from datetime import datetime, timezone
+import numpy as np
+
+# End-to-end benchmark of ingestion, retrieval and generation with no external services:
+#   - MongoDB: mongomock in-process (pip install mongomock), or a local mongod via --mongo
+#   - embeddings: EMBEDDING_PROVIDER=hash, deterministic and model-free
+#   - LLM and web pages: a mock OpenAI-compatible server on localhost (LLM_BASE_URL)
+#
+#   python benchmark.py --sizes 1000,10000 --output results.json [--compare baseline.json]
+#
+# Absolute numbers are for comparing versions on the same machine, not for
+# predicting production latency: the stand-ins are faster than the real services.
+#
+# mongomock scans the whole collection for every query, so offline runs stay
+# practical up to about 20000 chunks (the default 1000,10000 takes a few minutes,
+# 20000 about six: ingestion slows to ~80 chunks/s, and each index refresh fetch
+# is a scan). Larger corpora need --mongo.
+
+HIGHER_IS_BETTER = ("per_sec", "recall_at_k")
+TRACKED = HIGHER_IS_BETTER + ("p50", "p99", "index_load_ms", "peak_rss_mb")
+
+# --- Synthetic corpus ---
+
+def make_vocabulary(rng, topics, words_per_topic=60, common_words=400):
+    def word():
+        return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 9)))
+    common = [word() for _ in range(common_words)]
+    return common, [[word() for _ in range(words_per_topic)] for _ in range(topics)]
+
+def paragraph(rng, vocabulary, topic, words=110):
+    """About one chunk of text: topic words mixed into common ones, in short sentences."""
+    common, topical = vocabulary
+    picks = [rng.choice(topical[topic]) if rng.random() < 0.3 else rng.choice(common) for _ in range(words)]
+    sentences = [" ".join(picks[i:i + 12]).capitalize() + "." for i in range(0, len(picks), 12)]
+    return " ".join(sentences)
+
+def corpus(rng, vocabulary, count, offset=0):
+    topics = len(vocabulary[1])
+    return [(i % topics, f"Section {offset + i}. " + paragraph(rng, vocabulary, i % topics)) for i in range(count)]
+
+def make_query(rng, vocabulary):
+    topic = rng.randrange(len(vocabulary[1]))
+    return " ".join(rng.sample(vocabulary[1][topic], 5) + rng.sample(vocabulary[0], 2))
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = np.asarray(values, dtype=np.float64)
+    return {"p50": round(float(np.percentile(values, 50)), 2), "p99": round(float(np.percentile(values, 99)), 2),
+            "mean": round(float(values.mean()), 2)}
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+# --- Mock services ---
+
+class MockServer:
+    """OpenAI-compatible streaming chat endpoint plus a small linked website, on a background loop.
+
+    `faults` scripts failures for tests: each chat request consumes the first
+    entry whose "model" (if given) matches, one of {"status", "headers"} (an
+    error response), {"cut_after": n} (end the stream after n tokens, without
+    [DONE]) or {"delay_ms": ms} (hold the first token back). A trailing
+    assistant message is continued from, the way llm_client resumes.
+    """
+
+    def __init__(self, answer_tokens, first_token_ms, token_ms, site_pages, page_paragraphs, rng, vocabulary):
+        self.answer_tokens = answer_tokens
+        self.first_token_ms = first_token_ms
+        self.token_ms = token_ms
+        self.pages = {i: [text for _, text in corpus(rng, vocabulary, page_paragraphs, i * page_paragraphs)]
+                      for i in range(site_pages)}
+        self.faults = []
+        self.chat_requests = []  # request bodies, in arrival order
+        self.port = None
+
+    def next_fault(self, model):
+        for i, fault in enumerate(self.faults):
+            if fault.get("model") in (None, model):
+                return self.faults.pop(i)
+        return {}
+
+    async def chat(self, request):
+        from aiohttp import web
+        body = await request.json()
+        self.chat_requests.append(body)
+        fault = self.next_fault(body.get("model"))
+        if "status" in fault:
+            return web.Response(status=fault["status"], headers=fault.get("headers"), text="injected failure")
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await asyncio.sleep((self.first_token_ms + fault.get("delay_ms", 0)) / 1000)
+        tokens = [f" word{i}" for i in range(self.answer_tokens)]
+        tokens += ["\nSOURCE_RELEVANT: True\n", 'FOLLOWUP: ["What else?", "Why?", "How?"]']
+        messages = body.get("messages") or [{}]
+        prefix = messages[-1].get("content", "") if messages[-1].get("role") == "assistant" else ""
+        start = 0
+        while start < len(tokens) and prefix.startswith(tokens[start]):
+            prefix = prefix[len(tokens[start]):]
+            start += 1
+        for i, token in enumerate(tokens[start:]):
+            if i == fault.get("cut_after"):
+                return response
+            if i:
+                await asyncio.sleep(self.token_ms / 1000)
+            chunk = {"model": body.get("model"), "choices": [{"delta": {"content": token}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        usage = {"prompt_tokens": 0, "completion_tokens": len(tokens)}
+        await response.write(f"data: {json.dumps({'choices': [], 'x_groq': {'usage': usage}})}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def page(self, request):
+        from aiohttp import web
+        number = int(request.match_info["number"])
+        if number not in self.pages:
+            raise web.HTTPNotFound()
+        links = "".join(f'<a href="/site/{child}">page {child}</a>' for child in (2 * number + 1, 2 * number + 2)
+                        if child in self.pages)
+        paragraphs = "".join(f"<p>{text}</p>" for text in self.pages[number])
+        html = f"<html><head><title>Page {number}</title></head><body>{paragraphs}{links}</body></html>"
+        return web.Response(text=html, content_type="text/html")
+
+    def start(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat)
+        app.router.add_get("/site/{number}", self.page)
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        threading.Thread(target=loop.run_forever, name="benchmark-mock", daemon=True).start()
+        return f"http://127.0.0.1:{self.port}"
+
+
+def use_mongomock():
+    """Route every MongoClient the engine creates to one in-process mongomock server."""
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("mongomock is not installed: pip install mongomock, or pass --mongo mongodb://localhost:27017")
+    import inspect
+    import pymongo
+    builder = mongomock.collection.BulkOperationBuilder
+    if "sort" not in inspect.signature(builder.add_update).parameters:
+        # pymongo >= 4.9 passes sort= to bulk updates, which older mongomock rejects
+        add_update = builder.add_update
+        builder.add_update = lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs)
+    shared = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: shared
+
+
+# --- Benchmarks ---
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """Silence the engine's per-request logging while timing."""
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull), contextlib.redirect_stdout(devnull):
+        yield
+
+def bulk_load(collection, rows, source, batch_size=5000):
+    """Insert pre-embedded chunks directly, bypassing the pipeline, to reach large corpus sizes quickly."""
+    from embeddings import HashEmbeddingProvider
+    from embedding_codec import encode_embedding
+    from chunk_store import content_hash
+    from sparse_index import term_counts
+    from vector_index import assign_seqs, mark_stale
+    provider = HashEmbeddingProvider()
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        vectors = provider.embed([text for _, text in batch])
+        documents = [{"text": text, **encode_embedding(vector), "source": source, "content_hash": content_hash(text),
+                      "terms": term_counts(text), "chunk_index": start + i}
+                     for i, ((_, text), vector) in enumerate(zip(batch, vectors))]
+        assign_seqs(collection, documents)
+        collection.insert_many(documents, ordered=False)
+    mark_stale()
+
+def bench_ingest_file(workdir, rng, vocabulary, count):
+    from ingest import ingest_file
+    path = os.path.join(workdir, f"corpus-{count}.txt")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(text for _, text in corpus(rng, vocabulary, count)))
+    started = time.perf_counter()
+    with quiet():
+        result = ingest_file(path, f"bench-{count}.txt")
+    seconds = time.perf_counter() - started
+    return {"chunks": result["chunks"], "seconds": round(seconds, 2),
+            "chunks_per_sec": round(result["chunks"] / seconds, 1), "embedding": {
+                k: result["throughput"][k] for k in ("batches", "retries", "splits")}}
+
+def bench_ingest_url(base_url, pages):
+    from scrape import ingest_url
+    started = time.perf_counter()
+    with quiet():
+        result = ingest_url(f"{base_url}/site/0", deep_crawl=True, max_depth=pages, max_pages=pages)
+    seconds = time.perf_counter() - started
+    return {"pages": result["pages"], "chunks": result["chunks"], "seconds": round(seconds, 2),
+            "chunks_per_sec": round(result["chunks"] / seconds, 1)}
+
+def bench_retrieval(rng, vocabulary, queries, top_k):
+    import retrieval
+    from embeddings import get_embedding
+    from retrieval_backends import ExactBackend
+
+    started = time.perf_counter()
+    state = retrieval.index.snapshot()
+    load_ms = (time.perf_counter() - started) * 1000
+    texts = [make_query(rng, vocabulary) for _ in range(queries)]
+
+    latencies = []
+    with quiet():
+        retrieval.retrieve_chunks(texts[0], top_k=top_k)  # first call syncs BM25 and the backend
+        trainer = getattr(retrieval.backend, "trainer", None)
+        if trainer is not None:
+            trainer.join()  # IVF trains in the background; time the trained index, not the exact fallback
+        for text in texts:
+            started = time.perf_counter()
+            retrieval.retrieve_chunks(text, top_k=top_k)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    # Recall of the configured dense backend against brute force over the same snapshot
+    exact = ExactBackend()
+    recalls = []
+    with quiet():
+        for text in texts:
+            vector = retrieval.to_query_vector(get_embedding(text))
+            # No similarity threshold: recall is about ranking, not cut-off
+            truth = set(exact.search(state, vector, top_k, threshold=-1.0)[0].tolist())
+            if truth:
+                found = set(retrieval.backend.search(state, vector, top_k, threshold=-1.0)[0].tolist())
+                recalls.append(len(truth & found) / len(truth))
+    return {"rows": len(state.ids), "index_load_ms": round(load_ms, 1), "latency_ms": percentiles(latencies),
+            "recall_at_k": round(float(np.mean(recalls)), 4) if recalls else None, "k": top_k,
+            "backend": retrieval.backend.name, "hybrid": retrieval.sparse is not None}
+
+def bench_generation(rng, vocabulary, chats, concurrency):
+    from generation import generate_answer
+    first_token, total = [], []
+    lock = threading.Lock()
+
+    def chat(text):
+        started = time.perf_counter()
+        seen = []
+
+        def on_token(token):
+            if not seen:
+                seen.append((time.perf_counter() - started) * 1000)
+
+        generate_answer(text, on_token=on_token)
+        with lock:
+            if seen:
+                first_token.append(seen[0])
+            total.append((time.perf_counter() - started) * 1000)
+
+    texts = [make_query(rng, vocabulary) for _ in range(chats)]
+    with quiet():
+        chat(texts[0])  # warm-up: opens the LLM connection pool
+        first_token.clear()
+        total.clear()
+        started = time.perf_counter()
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(chat, texts))
+        seconds = time.perf_counter() - started
+    return {"chats": chats, "concurrency": concurrency, "ttft_ms": percentiles(first_token),
+            "total_ms": percentiles(total), "chats_per_sec": round(chats / seconds, 2),
+            "failed": chats - len(first_token)}
+
+def reset(collection):
+    import retrieval
+    collection.delete_many({})
+    collection.database["sourceManifests"].delete_many({})
+    retrieval.index.refresh(force=True)
+
+
+# --- Regression check ---
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare(results, baseline, tolerance):
+    """Return the metrics that got worse than `baseline` by more than `tolerance` (a fraction)."""
+    current, previous = flatten(results["runs"]), flatten(baseline.get("runs", {}))
+    current["peak_rss_mb"] = results.get("peak_rss_mb") or 0
+    previous["peak_rss_mb"] = baseline.get("peak_rss_mb") or 0
+    regressions = []
+    for name, value in current.items():
+        old = previous.get(name)
+        if not old or not name.endswith(TRACKED):
+            continue
+        higher_is_better = name.endswith(HIGHER_IS_BETTER)
+        change = (value - old) / old
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append({"metric": name, "baseline": old, "current": value, "change": round(change, 3)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingestion, retrieval and generation offline.")
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="corpus sizes in chunks, comma-separated (up to ~20000 with mongomock; more needs --mongo)")
+    parser.add_argument("--ingest-limit", type=int, default=5000,
+                        help="chunks per size that go through ingest_file; the rest are bulk-loaded")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--site-pages", type=int, default=20, help="pages in the mock site for ingest_url")
+    parser.add_argument("--llm-tokens", type=int, default=100)
+    parser.add_argument("--llm-first-token-ms", type=float, default=50)
+    parser.add_argument("--llm-token-ms", type=float, default=2)
+    parser.add_argument("--mongo", help="MongoDB URI of a local mongod (default: mongomock in-process)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="earlier results JSON; exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression (default 0.2)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(rng, topics=50)
+    mock = MockServer(args.llm_tokens, args.llm_first_token_ms, args.llm_token_ms, args.site_pages, 4, rng, vocabulary)
+    base_url = mock.start()
+
+    # Configuration is read at import, so everything is set before the engine modules load
+    workdir = tempfile.mkdtemp(prefix="rag-benchmark-")
+    os.environ.update({
+        "EMBEDDING_PROVIDER": "hash",
+        "EMBEDDING_CACHE_PATH": "",
+        "LLM_BASE_URL": base_url + "/v1",
+        "GROQ_API_KEY": os.environ.get("GROQ_API_KEY") or "benchmark",
+        "ANSWER_CACHE_SIZE": "0",
+        "INDEX_DIR": os.path.join(workdir, "index_data"),
+        "CRAWL_RESPECT_ROBOTS": "false",
+        "MONGO_DB_NAME": "rag_benchmark",
+        "MONGODB_URI": args.mongo or "mongodb://mongomock",
+        # mongomock checks a unique index by scanning every document on each insert
+        "MONGO_CREATE_INDEXES": "true" if args.mongo else "false",
+    })
+    if not args.mongo:
+        use_mongomock()
+
+    with quiet():
+        from db import client, collection, build_indexes
+        import retrieval  # noqa: F401  (loads the index singletons before timing)
+    client.drop_database("rag_benchmark")
+    if args.mongo:
+        build_indexes()
+
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mongo": "local mongod" if args.mongo else "mongomock",
+        "settings": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "runs": {},
+    }
+    try:
+        for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            print(f"[bench] {size} chunks", file=sys.stderr)
+            reset(collection)
+            run = {}
+            ingested = min(size, args.ingest_limit)
+            run["ingest_file"] = bench_ingest_file(workdir, rng, vocabulary, ingested)
+            remainder = size - run["ingest_file"]["chunks"]
+            if remainder > 0:
+                started = time.perf_counter()
+                bulk_load(collection, corpus(rng, vocabulary, remainder, size), f"bulk-{size}")
+                run["bulk_load_seconds"] = round(time.perf_counter() - started, 2)
+            run["retrieval"] = bench_retrieval(rng, vocabulary, args.queries, args.top_k)
+            run["generation"] = bench_generation(rng, vocabulary, args.chats, args.concurrency)
+            run["peak_rss_mb"] = peak_rss_mb()
+            results["runs"][str(size)] = run
+            print(f"[bench] {size}: ingest {run['ingest_file']['chunks_per_sec']} chunks/s, "
+                  f"retrieval p50 {run['retrieval']['latency_ms']['p50']} ms / p99 {run['retrieval']['latency_ms']['p99']} ms, "
+                  f"recall@{args.top_k} {run['retrieval']['recall_at_k']}, "
+                  f"TTFT p50 {run['generation']['ttft_ms'].get('p50')} ms", file=sys.stderr)
+
+        reset(collection)
+        results["runs"]["ingest_url"] = bench_ingest_url(base_url, args.site_pages)
+        results["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        client.drop_database("rag_benchmark")
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results["regressions"] = regressions
+        for item in regressions:
+            print(f"[bench] REGRESSION {item['metric']}: {item['baseline']} -> {item['current']} "
+                  f"({item['change']:+.0%})", file=sys.stderr)
+        exit_code = 1 if regressions else 0
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    sys.exit(exit_code)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import sys
+import hashlib
+from datetime import datetime, timezone
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from vector_index import assign_seqs, mark_stale
+from embedding_codec import encode_embedding
+from segments import SegmentWriter
+from sparse_index import term_counts
+from config import VECTOR_SEGMENTS, MONGO_BATCH_SIZE
+from db import find_in_batches
+
+# Per-chunk location metadata produced by chunker.py (web chunks carry their page url instead of page numbers)
+CHUNK_FIELDS = ("start", "end", "page", "page_end", "tokens", "url")
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class SourceWriter:
+    """Incremental, content-addressed writes of one source's chunks.
+
+    Chunks are keyed by (source, content_hash). On re-ingestion only chunks
+    whose hash isn't stored yet are embedded and upserted; identical chunks
+    are skipped, and chunks that no longer appear are deleted in finish().
+    A per-source manifest in `sourceManifests` records the live chunk count
+    and a digest of the source's hashes.
+
+    `source` may be set after construction (scrape.py learns it from the
+    first page); existing hashes are loaded on the first filter_new() call.
+    """
+
+    def __init__(self, collection, source=None, extra_fields=None):
+        self.collection = collection
+        self.manifests = collection.database['sourceManifests']
+        self.source = source
+        self.extra_fields = extra_fields or {}
+        self.existing = None      # content_hash -> _id already stored for this source
+        self.redundant = []       # stored duplicates of an existing hash, dropped in finish()
+        self.locations = {}       # _id -> stored location fields, to spot unchanged chunks that moved
+        self.moved = []           # location updates for those, written in finish()
+        self.seen = {}            # hash -> position of chunks produced by this ingestion run
+        self.upserted_ids = []
+        self.segment = None       # segments.SegmentWriter for this run's vectors
+        self.added = 0
+        self.unchanged = 0
+
+    def load_existing(self):
+        self.existing = {}
+        backfill = []
+        projection = {"content_hash": 1, "chunk_index": 1, **{field: 1 for field in CHUNK_FIELDS}}
+        for doc in self.collection.find({"source": self.source}, projection, batch_size=MONGO_BATCH_SIZE):
+            self.locations[doc["_id"]] = {k: v for k, v in doc.items() if k not in ("_id", "content_hash")}
+            if doc.get("content_hash"):
+                self.remember_existing(doc["content_hash"], doc["_id"])
+            else:
+                backfill.append(doc["_id"])
+
+        # Chunks written before content hashing: hash their text once and store it
+        if backfill:
+            updates = []
+            for doc in find_in_batches(self.collection, backfill, {"text": 1}):
+                digest = content_hash(doc.get("text", ""))
+                # Duplicates are dropped in finish(); hashing them too would clash on the unique index
+                if self.remember_existing(digest, doc["_id"]):
+                    updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"content_hash": digest}}))
+            if updates:
+                self.collection.bulk_write(updates, ordered=False)
+                print(f"[INFO] {self.source}: backfilled content hashes on {len(updates)} chunks", file=sys.stderr)
+
+    def remember_existing(self, digest, doc_id):
+        """Record a stored chunk; False if its hash is already taken (the chunk is then redundant)."""
+        if digest in self.existing:
+            self.redundant.append(doc_id)
+            return False
+        self.existing[digest] = doc_id
+        return True
+
+    def filter_new(self, chunks):
+        """Return [(chunk, hash)] for the chunk dicts that must be embedded and written."""
+        if self.existing is None:
+            self.load_existing()
+        new = []
+        for chunk in chunks:
+            digest = content_hash(chunk["text"])
+            if digest in self.seen:
+                continue  # repeated text inside the same source adds nothing to retrieval
+            self.seen[digest] = len(self.seen)
+            if digest in self.existing:
+                self.unchanged += 1
+                doc_id = self.existing[digest]
+                location = self.location(chunk, digest)
+                if self.locations.get(doc_id) != location:
+                    self.moved.append(UpdateOne({"_id": doc_id}, {"$set": location}))
+            else:
+                new.append((chunk, digest))
+        return new
+
+    def location(self, chunk, digest):
+        return {"chunk_index": self.seen[digest], **{k: chunk[k] for k in CHUNK_FIELDS if k in chunk}}
+
+    def write(self, new_chunks, embeddings):
+        if not new_chunks:
+            return 0
+        documents = []
+        for (chunk, digest), embedding in zip(new_chunks, embeddings):
+            documents.append({
+                "text": chunk["text"],
+                **encode_embedding(embedding),
+                "source": self.source,
+                "content_hash": digest,
+                "terms": term_counts(chunk["text"]),
+                **self.location(chunk, digest),
+                **self.extra_fields
+            })
+
+        assign_seqs(self.collection, documents)
+        try:
+            upserted = self.collection.bulk_write([
+                UpdateOne({"source": self.source, "content_hash": doc["content_hash"]}, {"$setOnInsert": doc}, upsert=True)
+                for doc in documents
+            ], ordered=False).upserted_ids
+        except BulkWriteError as e:
+            # A concurrent ingest of this source stored some of these first; the unique index kept its copy
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+            upserted = {item["index"]: item["_id"] for item in e.details.get("upserted", [])}
+        self.upserted_ids.extend(upserted.values())
+        if VECTOR_SEGMENTS:
+            # Only rows this run actually inserted; a concurrent writer may have won an upsert
+            if self.segment is None:
+                self.segment = SegmentWriter(self.source)
+            rows = sorted(upserted)
+            self.segment.append([upserted[i] for i in rows], [documents[i]["seq"] for i in rows],
+                                [embeddings[i] for i in rows])
+        self.added += len(upserted)
+        mark_stale()
+        return len(upserted)
+
+    def finish(self):
+        """Delete chunks that disappeared from the source and refresh its manifest."""
+        stale = [doc_id for digest, doc_id in (self.existing or {}).items() if digest not in self.seen]
+        stale += self.redundant
+        if self.moved:
+            self.collection.bulk_write(self.moved, ordered=False)
+        removed = 0
+        if stale:
+            removed = self.collection.delete_many({"_id": {"$in": stale}}).deleted_count
+            mark_stale()
+
+        hashes = sorted(self.seen)
+        self.manifests.update_one(
+            {"_id": self.source},
+            {"$set": {
+                "chunks": len(hashes),
+                "content_digest": hashlib.sha256("".join(hashes).encode("ascii")).hexdigest(),
+                "updated_at": datetime.now(timezone.utc),
+                **self.extra_fields
+            }},
+            upsert=True
+        )
+        if self.segment is not None:
+            self.segment.commit()
+        return {"added": self.added, "unchanged": self.unchanged, "removed": removed, "chunks": len(hashes)}
+
+    def rollback(self):
+        """Undo this run's inserts; the previous version of the source stays intact."""
+        if self.segment is not None:
+            self.segment.discard()
+        if self.upserted_ids:
+            self.collection.delete_many({"_id": {"$in": self.upserted_ids}})
+            mark_stale()
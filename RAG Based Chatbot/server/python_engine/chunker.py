@@ -0,0 +1,232 @@
+import re
+import sys
+import bisect
+import threading
+from config import EMBEDDING_MODEL, CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS
+
+PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n\s*")
+PARAGRAPH_END = re.compile(r"\n[ \t]*\n\s*$")
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])[\"')\]]*\s+")
+HEADING = re.compile(r"^(#{1,6} |\d+(\.\d+)*\.? +[A-Z]|[A-Z][A-Z0-9 ,:&/\-]{2,80}$)")
+# WordPiece-like fallback: words and punctuation marks are roughly one token each
+APPROX_TOKEN = re.compile(r"\w+|[^\w\s]")
+MAX_PENDING_CHARS = 64 * 1024  # text held back waiting for a boundary before it is cut anyway
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+def get_tokenizer():
+    """The embedding model's fast tokenizer, or None to fall back to approximate counts."""
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            try:
+                from tokenizers import Tokenizer
+                _tokenizer = Tokenizer.from_pretrained(EMBEDDING_MODEL)
+                _tokenizer.no_truncation()
+                _tokenizer.no_padding()
+            except Exception as e:
+                print(f"[WARN] Tokenizer for {EMBEDDING_MODEL} unavailable ({e}). Chunk sizes are approximate.", file=sys.stderr)
+                _tokenizer = False
+        return _tokenizer or None
+
+def count_tokens(texts, tokenizer=None):
+    if tokenizer is None:
+        return [len(APPROX_TOKEN.findall(text)) for text in texts]
+    return [len(encoding.ids) for encoding in tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+def token_offsets(text, tokenizer=None):
+    """(start, end) character span of every token in `text`."""
+    if tokenizer is None:
+        return [m.span() for m in APPROX_TOKEN.finditer(text)]
+    return tokenizer.encode(text, add_special_tokens=False).offsets
+
+
+class Chunker:
+    """Streaming, structure-aware chunker with an exact token budget.
+
+    Text is cut into sentences, paragraphs and headings, which are packed
+    greedily into chunks of at most `max_tokens` tokens (special tokens
+    included). A chunk closes early at a heading, prefers to end at a
+    paragraph break in its second half, and the next chunk repeats whole
+    trailing sentences up to `overlap_tokens`. A sentence longer than the
+    budget is split at token boundaries. Offsets are into the concatenated
+    page texts, with a newline between pages.
+    """
+
+    def __init__(self, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS, tokenizer=None):
+        self.tokenizer = tokenizer if tokenizer is not None else get_tokenizer()
+        self.budget = max_tokens - (2 if self.tokenizer is not None else 0)  # [CLS] and [SEP]
+        self.overlap = min(overlap_tokens, self.budget // 2)
+
+        self.buffer = ""
+        self.buffer_start = 0  # document offset of buffer[0]
+        self.scanned = 0       # document offset up to which text has been segmented
+        self.length = 0        # document length so far
+        self.page_starts, self.page_numbers = [], []
+        self.last_page = None
+        self.paragraph_next = True
+        self.current = []      # segments (start, end, tokens, starts_paragraph) of the open chunk
+
+    # --- Input ---
+
+    def feed(self, page, text):
+        # Pieces with the same page number (TXT blocks) continue the same text
+        if not self.page_starts or page != self.last_page:
+            if self.length:
+                self.buffer += "\n"
+                self.length += 1
+            self.page_starts.append(self.length)
+            self.page_numbers.append(page)
+            self.last_page = page
+        self.buffer += text
+        self.length += len(text)
+        return self.pack(final=False)
+
+    def close(self):
+        chunks = self.pack(final=True)
+        if self.current:
+            chunks.append(self.emit(self.current))
+            self.current = []
+        return chunks
+
+    # --- Segmentation ---
+
+    def safe_end(self):
+        # Text after the last boundary may continue on the next page
+        tail = self.buffer[self.scanned - self.buffer_start:]
+        last = None
+        for last in SENTENCE_BREAK.finditer(tail):
+            pass
+        for match in PARAGRAPH_BREAK.finditer(tail, last.end() if last else 0):
+            last = match
+        if last is not None:
+            return self.scanned + last.end()
+        return self.length if len(tail) > MAX_PENDING_CHARS else self.scanned
+
+    def segments(self, end):
+        """Yield (start, end, starts_paragraph, is_heading) for text in [scanned, end)."""
+        region = self.buffer[self.scanned - self.buffer_start:end - self.buffer_start]
+        base = self.scanned
+        position = 0
+        for block in PARAGRAPH_BREAK.finditer(region + "\n\n"):
+            paragraph = region[position:block.start()]
+            if paragraph.strip():
+                starts_paragraph = self.paragraph_next
+                if "\n" not in paragraph.strip() and HEADING.match(paragraph.strip()):
+                    yield base + position, base + block.start(), True, True
+                else:
+                    sentence_start = 0
+                    for sentence in SENTENCE_BREAK.finditer(paragraph):
+                        yield base + position + sentence_start, base + position + sentence.end(), starts_paragraph, False
+                        sentence_start = sentence.end()
+                        starts_paragraph = False
+                    if sentence_start < len(paragraph):
+                        yield base + position + sentence_start, base + block.start(), starts_paragraph, False
+                self.paragraph_next = True
+            position = min(block.end(), len(region))
+        self.paragraph_next = PARAGRAPH_END.search(region) is not None
+
+    # --- Packing ---
+
+    def pack(self, final):
+        end = self.length if final else self.safe_end()
+        if end <= self.scanned:
+            return []
+        segments = [s for s in self.segments(end) if self.text(s[0], s[1]).strip()]
+        self.scanned = end
+        counts = count_tokens([self.text(s[0], s[1]) for s in segments], self.tokenizer)
+
+        chunks = []
+        for (start, stop, starts_paragraph, is_heading), tokens in zip(segments, counts):
+            if tokens > self.budget:
+                if self.current:
+                    chunks.append(self.emit(self.current))
+                    self.current = []
+                chunks.extend(self.split_long(start, stop))
+                continue
+            if is_heading and self.current:
+                chunks.append(self.emit(self.current))
+                self.current = []
+            while self.current and sum(s[2] for s in self.current) + tokens > self.budget:
+                chunks.append(self.emit(self.close_chunk(tokens)))
+            self.current.append((start, stop, tokens, starts_paragraph or is_heading))
+        self.trim_buffer()
+        return chunks
+
+    def close_chunk(self, incoming):
+        """Close the open chunk, at its last paragraph break if that is in the
+        second half; otherwise at the end, carrying trailing sentences over as overlap."""
+        paragraph_cuts = [i for i, seg in enumerate(self.current) if seg[3] and i > 0]
+        if paragraph_cuts and paragraph_cuts[-1] >= len(self.current) / 2:
+            cut = paragraph_cuts[-1]
+            closed, self.current = self.current[:cut], self.current[cut:]
+            return closed
+
+        closed, overlap, used = self.current, [], 0
+        room = min(self.overlap, self.budget - incoming)
+        for seg in reversed(closed[1:]):  # leave at least one segment behind so chunks advance
+            if used + seg[2] > room:
+                break
+            overlap.insert(0, seg)
+            used += seg[2]
+        self.current = overlap
+        return closed
+
+    def split_long(self, start, stop):
+        offsets = token_offsets(self.text(start, stop), self.tokenizer)
+        step = max(1, self.budget - self.overlap)
+        chunks = []
+        for first in range(0, len(offsets), step):
+            window = offsets[first:first + self.budget]
+            chunks.append(self.emit([(start + window[0][0], start + window[-1][1], len(window), False)]))
+            if first + self.budget >= len(offsets):
+                break
+        return chunks
+
+    # --- Output ---
+
+    def text(self, start, end):
+        return self.buffer[start - self.buffer_start:end - self.buffer_start]
+
+    def page_at(self, offset):
+        return self.page_numbers[max(0, bisect.bisect_right(self.page_starts, offset) - 1)]
+
+    def emit(self, segments):
+        start, end = segments[0][0], segments[-1][1]
+        raw = self.text(start, end)
+        text = raw.strip()
+        start += len(raw) - len(raw.lstrip())
+        end = start + len(text)
+        return {
+            "text": text,
+            "start": start,
+            "end": end,
+            "page": self.page_at(start),
+            "page_end": self.page_at(max(start, end - 1)),
+            "tokens": sum(s[2] for s in segments),
+        }
+
+    def trim_buffer(self):
+        keep_from = self.current[0][0] if self.current else self.scanned
+        if keep_from > self.buffer_start:
+            self.buffer = self.buffer[keep_from - self.buffer_start:]
+            self.buffer_start = keep_from
+        # Keep the page that contains keep_from
+        drop = max(0, bisect.bisect_right(self.page_starts, keep_from) - 1)
+        if drop:
+            del self.page_starts[:drop]
+            del self.page_numbers[:drop]
+
+
+def iter_chunks(pages, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS, progress=None, tokenizer=None):
+    """Chunk an iterable of (page_number, text), yielding chunk dicts as soon as they are complete."""
+    chunker = Chunker(max_tokens, overlap_tokens, tokenizer)
+    for page, text in pages:
+        if progress is not None:
+            progress["pages"] += 1
+        yield from chunker.feed(page, text)
+    yield from chunker.close()
+
+def chunk_text(text, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    return list(iter_chunks([(1, text)], max_tokens, overlap_tokens))
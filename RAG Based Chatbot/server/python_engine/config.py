@@ -13,6 +13,158 @@ LLM_MODEL = "llama-3.3-70b-versatile"
 GROQ_BASE_URL = "https://api.groq.com/openai/v1"
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 
+# Embeddings (embeddings.py): "auto" uses a local CPU model when sentence-transformers
+# is installed and falls back to the Hugging Face Inference API; "local" / "remote" force one.
+# "hash" is a deterministic model-free stand-in for offline development and benchmarks.
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "auto")
+EMBEDDING_LOCAL_BACKEND = os.getenv("EMBEDDING_LOCAL_BACKEND", "torch")  # or "onnx"
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+EMBEDDING_MAX_BATCH = int(os.getenv("EMBEDDING_MAX_BATCH", "32"))
+# Ingestion embeds in batches of at most EMBEDDING_BATCH_TOKENS tokens (shrunk while the API
+# rejects them as too large), with up to EMBEDDING_WORKERS remote requests in flight
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "8192"))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "4"))
+EMBEDDING_RETRIES = int(os.getenv("EMBEDDING_RETRIES", "3"))
+
+# Chunking (chunker.py): token budget per chunk, measured with the embedding model's
+# tokenizer (all-MiniLM-L6-v2 truncates at 256), and tokens of trailing sentences repeated
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "200"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+
+# Streaming ingestion (ingest.py): chunks per embedding/insert batch, and how many
+# batches may wait between pipeline stages
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+INGEST_QUEUE_DEPTH = int(os.getenv("INGEST_QUEUE_DEPTH", "2"))
+
+# PDF page extraction (pdf_extract.py): process count, smallest PDF worth
+# parallelising, and pages per work unit. PDF_WORKERS=1 forces serial mode.
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "32"))
+PDF_SHARD_PAGES = int(os.getenv("PDF_SHARD_PAGES", "8"))
+
+# Web crawling (crawler.py): deep crawls follow same-domain links up to CRAWL_MAX_DEPTH
+# levels and CRAWL_MAX_PAGES pages; single-page ingests fetch just the URL
+CRAWL_MAX_DEPTH = int(os.getenv("CRAWL_MAX_DEPTH", "1"))
+CRAWL_MAX_PAGES = int(os.getenv("CRAWL_MAX_PAGES", "6"))
+CRAWL_CONCURRENCY = int(os.getenv("CRAWL_CONCURRENCY", "8"))
+CRAWL_HOST_CONCURRENCY = int(os.getenv("CRAWL_HOST_CONCURRENCY", "4"))
+CRAWL_TIMEOUT = float(os.getenv("CRAWL_TIMEOUT", "15"))
+CRAWL_RESPECT_ROBOTS = os.getenv("CRAWL_RESPECT_ROBOTS", "true").lower() != "false"
+CRAWL_QUEUE_DEPTH = int(os.getenv("CRAWL_QUEUE_DEPTH", "4"))
+
+# Embedding storage in vectorStore (embedding_codec.py): packed "float32", "float16" or
+# scalar-quantized "int8" bytes; "list" keeps the old JSON float arrays
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "float32")
+
+# Prompt packing (context_packer.py): token budget for the whole prompt and for chat history,
+# retrieval candidates considered, chunks kept after MMR (CONTEXT_MMR_LAMBDA trades relevance
+# for diversity), the similarity above which chunks count as duplicates, and the cap per old turn
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_HISTORY_BUDGET = int(os.getenv("CONTEXT_HISTORY_BUDGET", "1500"))
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "10"))
+CONTEXT_MAX_CHUNKS = int(os.getenv("CONTEXT_MAX_CHUNKS", "5"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.95"))
+HISTORY_MESSAGE_MAX_TOKENS = int(os.getenv("HISTORY_MESSAGE_MAX_TOKENS", "400"))
+
+# Reranking (reranker.py): with RERANK=true, RERANK_CANDIDATES retrieved chunks are rescored
+# by a local cross-encoder (needs sentence-transformers) and the best RERANK_TOP_K go on to
+# prompt packing. Only as many uncached pairs as fit in RERANK_BUDGET_MS (0 = no limit) are
+# scored; (query, chunk) scores are cached for RERANK_CACHE_SIZE pairs.
+RERANK = os.getenv("RERANK", "false").lower() == "true"
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "8"))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "150"))
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "5000"))
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "512"))
+
+# Answer cache (answer_cache.py): answers to first questions of a conversation are reused
+# for later questions whose embedding is at least ANSWER_CACHE_THRESHOLD similar, with the
+# same model, system prompt and active documents, until a source changes or the TTL (seconds)
+# expires. ANSWER_CACHE_SIZE=0 disables it.
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+# LLM client (llm_client.py): OpenAI-compatible endpoint (point LLM_BASE_URL at a mock server
+# to test offline), pooled connections, retries with jittered exponential backoff (waits asked
+# for by rate-limit headers are honoured up to LLM_BACKOFF_MAX seconds) and the idle read timeout.
+# With LLM_HEDGE_MODEL set, a request with no token after LLM_HEDGE_DELAY seconds is also sent
+# to that model and whichever starts streaming first is used.
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", GROQ_BASE_URL)
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "20"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+LLM_HEDGE_MODEL = os.getenv("LLM_HEDGE_MODEL", "")
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "2"))
+
+# MongoDB (db.py): database name, connections pooled per process, and documents per cursor batch / page
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "rag_chatbot")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_BATCH_SIZE = int(os.getenv("MONGO_BATCH_SIZE", "1000"))
+# Whether the engine creates the vectorStore indexes (benchmark.py turns this off under mongomock,
+# whose unique index scans the whole collection on every insert)
+MONGO_CREATE_INDEXES = os.getenv("MONGO_CREATE_INDEXES", "true").lower() != "false"
+
+# Resident engine (engine_server.py): number of requests served concurrently. Chats mostly wait
+# on the shared LLM client, so they get their own, larger pool.
+ENGINE_WORKERS = int(os.getenv("ENGINE_WORKERS", "4"))
+ENGINE_CHAT_WORKERS = int(os.getenv("ENGINE_CHAT_WORKERS", "32"))
+# Background ingestion jobs (jobs.py): worker threads, and how many times a job interrupted
+# by an engine restart is resumed before it is marked failed
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Send a {"type": "metrics"} message with per-stage timings before each generate/ingest result
+ENGINE_METRICS = os.getenv("ENGINE_METRICS", "true").lower() == "true"
+
+# In-process vector index (vector_index.py): seconds between incremental
+# refreshes from MongoDB, and how many recent insertion markers to re-check
+INDEX_REFRESH_INTERVAL = float(os.getenv("INDEX_REFRESH_INTERVAL", "2"))
+INDEX_REFRESH_OVERLAP = int(os.getenv("INDEX_REFRESH_OVERLAP", "1000"))
+
+# Retrieval backend (retrieval_backends.py): "exact" brute force or "ivf" approximate search.
+# IVF_NLIST=0 picks ~4*sqrt(rows) lists; raise IVF_NPROBE for recall, lower it for latency.
+INDEX_DIR = os.getenv("INDEX_DIR", os.path.join(os.path.dirname(__file__), "index_data"))
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "exact")
+IVF_NLIST = int(os.getenv("IVF_NLIST", "0"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))
+IVF_MIN_ROWS = int(os.getenv("IVF_MIN_ROWS", "5000"))
+IVF_RETRAIN_FACTOR = float(os.getenv("IVF_RETRAIN_FACTOR", "2"))
+# Searches restricted to active_documents scan each source's rows in place, in slices of at
+# most SEARCH_SLICE_ROWS; selections of SEARCH_PARALLEL_MIN_ROWS rows or more are spread over
+# SEARCH_WORKERS threads (NumPy releases the GIL during the products).
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", str(min(4, os.cpu_count() or 1))))
+SEARCH_SLICE_ROWS = int(os.getenv("SEARCH_SLICE_ROWS", "65536"))
+SEARCH_PARALLEL_MIN_ROWS = int(os.getenv("SEARCH_PARALLEL_MIN_ROWS", "50000"))
+
+# Hybrid retrieval (sparse_index.py): BM25 over chunk text fused with the dense results,
+# by reciprocal rank ("rrf") or normalized scores ("weighted", HYBRID_DENSE_WEIGHT for dense).
+# With HYBRID_PREFILTER_MIN_ROWS > 0, larger searches score only the top BM25 candidates densely.
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() != "false"
+HYBRID_FUSION = os.getenv("HYBRID_FUSION", "rrf")
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+HYBRID_DENSE_WEIGHT = float(os.getenv("HYBRID_DENSE_WEIGHT", "0.7"))
+HYBRID_PREFILTER_MIN_ROWS = int(os.getenv("HYBRID_PREFILTER_MIN_ROWS", "0"))
+HYBRID_PREFILTER_CANDIDATES = int(os.getenv("HYBRID_PREFILTER_CANDIDATES", "2000"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+# Vector segments (segments.py): memory-mapped float32 copies of the embeddings so a new
+# process starts from disk instead of downloading vectorStore. Compacted into one file
+# when there are more than SEGMENT_MAX_FILES or the dead-row fraction passes the ratio.
+VECTOR_SEGMENTS = os.getenv("VECTOR_SEGMENTS", "true").lower() != "false"
+SEGMENT_DIR = os.getenv("SEGMENT_DIR", os.path.join(INDEX_DIR, "segments"))
+SEGMENT_MAX_FILES = int(os.getenv("SEGMENT_MAX_FILES", "16"))
+SEGMENT_COMPACT_DEAD_RATIO = float(os.getenv("SEGMENT_COMPACT_DEAD_RATIO", "0.2"))
+
+# Embedding cache (embedding_cache.py): in-memory LRU size and optional SQLite tier
+# (set EMBEDDING_CACHE_PATH to an empty string to keep it memory-only)
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(INDEX_DIR, "embedding_cache.sqlite"))
+
 if not GROQ_API_KEY:
     raise ValueError("CRITICAL ERROR: GROQ_API_KEY is missing from .env file!")
 
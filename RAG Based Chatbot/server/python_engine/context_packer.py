@@ -0,0 +1,129 @@
+import numpy as np
+from config import (CONTEXT_TOKEN_BUDGET, CONTEXT_HISTORY_BUDGET, CONTEXT_MAX_CHUNKS, CONTEXT_MMR_LAMBDA,
+                    CONTEXT_DUPLICATE_THRESHOLD, HISTORY_MESSAGE_MAX_TOKENS)
+from chunker import get_tokenizer, count_tokens, token_offsets
+
+# Tokens are counted locally with the embedding model's tokenizer (or the
+# approximate counter). Llama's tokenizer differs, but the counts are close
+# enough to budget against.
+
+def count(text):
+    return count_tokens([text], get_tokenizer())[0] if text else 0
+
+def truncate(text, max_tokens):
+    offsets = token_offsets(text, get_tokenizer())
+    if len(offsets) <= max_tokens:
+        return text
+    if max_tokens < 2:
+        return ""
+    return text[:offsets[max_tokens - 2][1]].rstrip() + " …"  # the ellipsis takes the last token
+
+def mmr_order(chunks, lambda_=CONTEXT_MMR_LAMBDA, duplicate_threshold=CONTEXT_DUPLICATE_THRESHOLD):
+    """Order chunks by maximal marginal relevance, dropping near-duplicates.
+
+    Relevance is each chunk's `rerank_score` if it has one, else its retrieval
+    `score`; redundancy is its highest
+    cosine similarity to a chunk already picked (from the `vector` field).
+    Returns (ordered chunks, number dropped as duplicates).
+    """
+    if len(chunks) < 2 or any(chunk.get("vector") is None for chunk in chunks):
+        return list(chunks), 0
+    vectors = np.stack([np.asarray(chunk["vector"], dtype=np.float32) for chunk in chunks])
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    vectors = vectors / norms
+    similarity = vectors @ vectors.T
+    relevance = np.array([chunk.get("rerank_score", chunk.get("score", 0.0)) for chunk in chunks], dtype=np.float32)
+
+    picked, dropped = [], 0
+    remaining = list(range(len(chunks)))
+    while remaining:
+        if picked:
+            redundancy = similarity[np.ix_(remaining, picked)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(remaining), dtype=np.float32)
+        duplicates = [i for i, r in zip(remaining, redundancy) if r >= duplicate_threshold]
+        if duplicates:
+            dropped += len(duplicates)
+            keep = [k for k, i in enumerate(remaining) if i not in duplicates]
+            remaining = [remaining[k] for k in keep]
+            redundancy = redundancy[keep]
+            if not remaining:
+                break
+        best = int(np.argmax(lambda_ * relevance[remaining] - (1 - lambda_) * redundancy))
+        picked.append(remaining.pop(best))
+    return [chunks[i] for i in picked], dropped
+
+
+def pack_history(history, budget, message_max_tokens=HISTORY_MESSAGE_MAX_TOKENS):
+    """Fit the newest turns into `budget`; older ones collapse into a one-line recap.
+
+    Returns (messages oldest first, tokens used, number of turns truncated or recapped).
+    """
+    turns = []
+    for msg in history[-10:]:
+        content = msg.get("content", "")
+        if content:
+            turns.append({"role": "user" if msg.get("role") == "user" else "assistant", "content": content})
+
+    kept, used, condensed = [], 0, 0
+    older = []
+    for turn in reversed(turns):
+        content = turn["content"]
+        tokens = count(content)
+        if tokens > message_max_tokens:
+            content = truncate(content, message_max_tokens)
+            tokens = count(content)
+            condensed += 1
+        if older or used + tokens > budget:
+            older.append(turn)
+            continue
+        kept.append({"role": turn["role"], "content": content})
+        used += tokens
+
+    if older:
+        # Earlier questions, newest last, as much as still fits
+        questions = [turn["content"].split("\n")[0][:200] for turn in reversed(older) if turn["role"] == "user"]
+        if questions and budget - used > 20:
+            recap = truncate("Earlier in this conversation the user asked: " + " | ".join(questions), budget - used)
+            kept.append({"role": "system", "content": recap})
+            used += count(recap)
+        condensed += len(older)
+    kept.reverse()
+    return kept, used, condensed
+
+
+def pack_context(chunks, history, system_text, query, budget=CONTEXT_TOKEN_BUDGET,
+                 history_budget=CONTEXT_HISTORY_BUDGET, max_chunks=CONTEXT_MAX_CHUNKS):
+    """Choose the context chunks and history turns that fit the prompt budget.
+
+    `system_text` is the system prompt without the context. History gets at
+    most `history_budget` tokens; chunks (MMR-ordered, near-duplicates
+    dropped, at most `max_chunks`) fill whatever the history left over.
+    Returns (chunks, history messages, usage dict).
+    """
+    fixed = count(system_text) + count(query)
+    history_messages, history_tokens, condensed = pack_history(history, min(history_budget, max(0, budget - fixed)))
+
+    ordered, duplicates = mmr_order(chunks)
+    context_budget = budget - fixed - history_tokens
+    selected, context_tokens, over_budget = [], 0, 0
+    for chunk in ordered:
+        tokens = count(chunk.get("text", ""))
+        if len(selected) >= max_chunks or context_tokens + tokens > context_budget:
+            over_budget += 1
+            continue
+        selected.append(chunk)
+        context_tokens += tokens
+
+    usage = {
+        "prompt_tokens": fixed + history_tokens + context_tokens,
+        "context_tokens": context_tokens,
+        "history_tokens": history_tokens,
+        "chunks_used": len(selected),
+        "chunks_dropped_duplicate": duplicates,
+        "chunks_dropped_budget": over_budget,
+        "history_messages": len(history_messages),
+        "history_condensed": condensed,
+    }
+    return selected, history_messages, usage
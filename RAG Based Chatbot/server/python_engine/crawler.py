@@ -0,0 +1,222 @@
+import sys
+import time
+import asyncio
+from urllib import robotparser
+from urllib.parse import urljoin, urlparse, urlunparse, parse_qsl, urlencode
+import aiohttp
+from bs4 import BeautifulSoup
+from config import (CRAWL_MAX_DEPTH, CRAWL_MAX_PAGES, CRAWL_CONCURRENCY, CRAWL_HOST_CONCURRENCY,
+                    CRAWL_TIMEOUT, CRAWL_RESPECT_ROBOTS, CRAWL_QUEUE_DEPTH)
+from pipeline import prefetch
+from tracing import span, count
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+SKIP_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.zip', '.tar', '.gz', '.mp4', '.mp3', '.css', '.js')
+TRACKING_PARAMS = ('utm_', 'fbclid', 'gclid', 'mc_cid', 'mc_eid', 'ref')
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def get_domain(url):
+    return urlparse(url).netloc
+
+def normalize_url(url, base_url=None):
+    """Canonical form used for dedup: absolute, lowercase scheme/host, no default
+    port, no fragment, tracking parameters dropped, remaining query sorted."""
+    if base_url:
+        url = urljoin(base_url, url)
+    parts = urlparse(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    netloc = host
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{host}:{parts.port}"
+    path = parts.path or "/"
+    query = urlencode(sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith(TRACKING_PARAMS)
+    ))
+    return urlunparse((scheme, netloc, path, "", query, ""))
+
+def extract_links(soup, base_url):
+    links = set()
+    domain = get_domain(normalize_url(base_url))
+    for a in soup.find_all('a', href=True):
+        href = a['href'].strip()
+        if href.startswith(('mailto:', 'javascript:', 'tel:', '#')):
+            continue
+        link = normalize_url(href, base_url)
+        # Only keep links from same domain and avoid files
+        if urlparse(link).scheme in ('http', 'https') and get_domain(link) == domain \
+                and not urlparse(link).path.lower().endswith(SKIP_EXTENSIONS):
+            links.add(link)
+    return sorted(links)
+
+def parse_html(html, url):
+    soup = BeautifulSoup(html, 'html.parser')
+
+    # Remove noisy elements
+    for element in soup(["script", "style", "nav", "footer", "header", "aside"]):
+        element.decompose()
+
+    text = soup.get_text(separator='\n\n', strip=True)
+    title = (soup.title.string if soup.title else None) or url
+    return text, title.strip(), extract_links(soup, url)
+
+
+class Crawler:
+    """Breadth-first same-domain crawler on one pooled aiohttp session.
+
+    max_depth/max_pages bound the crawl, host_concurrency caps parallel
+    requests per host, and robots.txt (including Crawl-delay) is honoured
+    unless respect_robots is False.
+    """
+
+    def __init__(self, max_depth=CRAWL_MAX_DEPTH, max_pages=CRAWL_MAX_PAGES, concurrency=CRAWL_CONCURRENCY,
+                 host_concurrency=CRAWL_HOST_CONCURRENCY, timeout=CRAWL_TIMEOUT,
+                 respect_robots=CRAWL_RESPECT_ROBOTS, user_agent=USER_AGENT):
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.timeout = timeout
+        self.respect_robots = respect_robots
+        self.user_agent = user_agent
+
+        self.session = None
+        self.seen = set()
+        self.reserved = 0  # pages fetched or being fetched; failures give their slot back
+        self.host_slots = {}
+        self.host_last_request = {}
+        self.robots = {}
+
+    # --- Politeness ---
+
+    async def robots_for(self, url):
+        parts = urlparse(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        if origin not in self.robots:
+            parser = robotparser.RobotFileParser()
+            try:
+                async with self.session.get(origin + "/robots.txt") as response:
+                    if response.status == 200:
+                        parser.parse((await response.text(errors='ignore')).splitlines())
+                    else:
+                        parser.allow_all = True
+            except Exception:
+                parser.allow_all = True
+            self.robots[origin] = parser
+        return self.robots[origin]
+
+    async def allowed(self, url):
+        if not self.respect_robots:
+            return True
+        return (await self.robots_for(url)).can_fetch(self.user_agent, url)
+
+    async def wait_turn(self, url):
+        # Space requests to one host by its robots.txt Crawl-delay, if any
+        if not self.respect_robots:
+            return
+        delay = (await self.robots_for(url)).crawl_delay(self.user_agent)
+        if not delay:
+            return
+        host = get_domain(url)
+        now = time.monotonic()
+        start_at = max(now, self.host_last_request.get(host, 0) + float(delay))
+        self.host_last_request[host] = start_at
+        if start_at > now:
+            await asyncio.sleep(start_at - now)
+
+    # --- Fetching ---
+
+    async def fetch_page(self, url, depth):
+        if self.reserved >= self.max_pages:
+            return None
+        # Take the slot before awaiting anything, or concurrent fetches could all pass the check
+        self.reserved += 1
+        if not await self.allowed(url):
+            self.reserved -= 1
+            print(f"Skipping {url} (disallowed by robots.txt)", file=sys.stderr)
+            return None
+
+        host = get_domain(url)
+        slot = self.host_slots.setdefault(host, asyncio.Semaphore(self.host_concurrency))
+        print(f"Fetching content from: {url}", file=sys.stderr)
+        try:
+            async with slot:
+                await self.wait_turn(url)
+                with span("crawl.download"):
+                    async with self.session.get(url) as response:
+                        response.raise_for_status()
+                        content_type = response.headers.get("Content-Type", "")
+                        if content_type and "html" not in content_type and "text" not in content_type:
+                            raise ValueError(f"not an HTML page ({content_type})")
+                        body = await response.read()
+                        final_url = str(response.url)
+            with span("crawl.parse"):
+                text, title, links = await asyncio.to_thread(parse_html, body, final_url)
+            return {"url": url, "title": title, "text": text, "links": links, "depth": depth}
+        except Exception as e:
+            self.reserved -= 1
+            count("crawl.failures")
+            print(f"Warning: Failed to fetch {url}: {e}", file=sys.stderr)
+            return None
+
+    async def worker(self, frontier, results):
+        while True:
+            url, depth = await frontier.get()
+            try:
+                page = await self.fetch_page(url, depth)
+                if page:
+                    await results.put(page)
+                    if depth < self.max_depth:
+                        for link in page["links"]:
+                            if link not in self.seen:
+                                self.seen.add(link)
+                                frontier.put_nowait((link, depth + 1))
+            finally:
+                frontier.task_done()
+
+    async def crawl(self, start_url):
+        """Async generator of pages ({url, title, text, links, depth}) in the order they finish."""
+        start_url = normalize_url(start_url)
+        self.seen = {start_url}
+        frontier = asyncio.Queue()
+        frontier.put_nowait((start_url, 0))
+        # Bounded, so a slow consumer pauses the workers once this many pages are parsed and waiting
+        results = asyncio.Queue(maxsize=self.concurrency)
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.host_concurrency)
+        async with aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"User-Agent": self.user_agent}
+        ) as session:
+            self.session = session
+            workers = [asyncio.create_task(self.worker(frontier, results)) for _ in range(self.concurrency)]
+            finished = asyncio.create_task(frontier.join())
+            try:
+                while True:
+                    next_page = asyncio.create_task(results.get())
+                    done, _ = await asyncio.wait({next_page, finished}, return_when=asyncio.FIRST_COMPLETED)
+                    if next_page in done:
+                        yield next_page.result()
+                        continue
+                    next_page.cancel()
+                    while not results.empty():
+                        yield results.get_nowait()
+                    return
+            finally:
+                finished.cancel()
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(finished, *workers, return_exceptions=True)
+
+
+def iter_crawl(start_url, **options):
+    """Blocking iterator over Crawler.crawl().
+
+    The crawl runs on its own event loop in a background thread and hands
+    pages over through a bounded queue, so callers can chunk, embed and store
+    pages while fetches carry on.
+    """
+    return prefetch(Crawler(**options).crawl(start_url), CRAWL_QUEUE_DEPTH, "crawler")
@@ -0,0 +1,94 @@
+import sys
+import time
+import threading
+from pymongo import MongoClient, ASCENDING
+from config import MONGODB_URI, MONGO_DB_NAME, MONGO_MAX_POOL_SIZE, MONGO_BATCH_SIZE, MONGO_CREATE_INDEXES
+
+# One pooled client per process, shared by retrieval, generation and both
+# ingestion paths. MongoClient connects lazily, so importing this is cheap.
+client = MongoClient(MONGODB_URI, maxPoolSize=MONGO_MAX_POOL_SIZE, appname="rag-python-engine")
+db = client[MONGO_DB_NAME]
+collection = db['vectorStore']
+
+# Chunk fields the app reads back; embeddings and term counts only feed the in-process indexes
+CHUNK_PROJECTION = {"embedding": 0, "embedding_format": 0, "embedding_scale": 0, "terms": 0}
+
+INDEXES = [
+    # active_documents filters, per-source re-ingestion and deletes
+    ([("source", ASCENDING), ("chunk_index", ASCENDING)], "source_chunk_index", {}),
+    # SourceWriter upserts match on (source, content_hash); unique so concurrent ingests of a
+    # source can't both insert a chunk. Chunks stored before hashing have no hash yet.
+    ([("source", ASCENDING), ("content_hash", ASCENDING)], "source_content_hash_unique",
+     {"unique": True, "partialFilterExpression": {"content_hash": {"$exists": True}}}),
+    # VectorIndex scans the insertion-marker tail on every refresh
+    ([("seq", ASCENDING)], "seq", {}),
+]
+
+# Indexes of older versions, dropped once the index that replaces them exists
+REPLACED_INDEXES = {"source_content_hash": "source_content_hash_unique"}
+
+_index_thread = None
+_indexes_lock = threading.Lock()
+
+def ensure_indexes():
+    """Build the vectorStore indexes in a background thread, once per process.
+
+    Returns at once: with Mongo unreachable each create_index blocks for the
+    server selection timeout, and the engine must still start up.
+    """
+    global _index_thread
+    if not MONGO_CREATE_INDEXES:
+        return
+    with _indexes_lock:
+        if _index_thread is None:
+            _index_thread = threading.Thread(target=build_indexes, name="mongo-indexes", daemon=True)
+            _index_thread.start()
+
+def build_indexes(delay=1.0, max_delay=300.0):
+    """Create the missing indexes, retrying failures with backoff until all of them exist."""
+    missing = list(INDEXES)
+    while True:
+        for spec in list(missing):
+            keys, name, options = spec
+            try:
+                collection.create_index(keys, name=name, **options)
+                missing.remove(spec)
+            except Exception as e:
+                # e.g. Mongo unreachable, or duplicate hashes left by older versions
+                # (those go away when their source is re-ingested)
+                print(f"[WARN] Could not create vectorStore index {name}: {e}", file=sys.stderr)
+        if not missing:
+            try:
+                existing = collection.index_information()
+                for old in REPLACED_INDEXES:
+                    if old in existing:
+                        collection.drop_index(old)
+                return
+            except Exception as e:
+                print(f"[WARN] Could not drop replaced vectorStore indexes: {e}", file=sys.stderr)
+        print(f"[WARN] Retrying vectorStore indexes in {delay:.0f}s", file=sys.stderr)
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+def find_in_batches(target, ids, projection, batch_size=MONGO_BATCH_SIZE):
+    """Yield the documents with _id in `ids`, querying at most batch_size ids at a time."""
+    for start in range(0, len(ids), batch_size):
+        yield from target.find({"_id": {"$in": ids[start:start + batch_size]}}, projection, batch_size=batch_size)
+
+def iter_documents(target=collection, query=None, projection=CHUNK_PROJECTION, page_size=MONGO_BATCH_SIZE):
+    """Stream every matching document in _id order, one page per query.
+
+    Each page resumes after the last _id seen, so no cursor stays open
+    between pages and memory holds a single page.
+    """
+    query = dict(query or {})
+    last_id = None
+    while True:
+        page_query = query if last_id is None else {"$and": [query, {"_id": {"$gt": last_id}}]}
+        page = list(target.find(page_query, projection).sort("_id", ASCENDING).limit(page_size))
+        if not page:
+            return
+        yield from page
+        if len(page) < page_size:
+            return
+        last_id = page[-1]["_id"]
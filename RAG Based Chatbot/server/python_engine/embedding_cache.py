@@ -0,0 +1,121 @@
+import os
+import sys
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+from config import EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_PATH
+from tracing import count
+
+
+# all-MiniLM-L6-v2 uses an uncased tokenizer, so case and whitespace don't change the vector
+def normalize_text(text):
+    return " ".join(text.split()).lower()
+
+def cache_key(text, model):
+    return hashlib.sha1(f"{model}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Two-tier embedding cache keyed on (model and provider, normalized text).
+
+    The memory tier is an LRU of at most `max_entries` vectors. The optional
+    disk tier is a SQLite file of float32 blobs that survives restarts, so
+    re-ingested chunks and repeat questions skip the model entirely.
+    """
+
+    def __init__(self, max_entries=EMBEDDING_CACHE_SIZE, path=EMBEDDING_CACHE_PATH):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                self.db = sqlite3.connect(path, check_same_thread=False)
+                self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+                self.db.commit()
+            except Exception as e:
+                print(f"[WARN] Embedding disk cache disabled ({path}): {e}", file=sys.stderr)
+                self.db = None
+
+    def remember(self, key, vector):
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_many(self, keys):
+        """Return {key: vector} for every cached key, counting hits and misses."""
+        found = {}
+        with self.lock:
+            missing = []
+            for key in keys:
+                vector = self.entries.get(key)
+                if vector is not None:
+                    self.entries.move_to_end(key)
+                    found[key] = vector
+                else:
+                    missing.append(key)
+
+            if missing and self.db is not None:
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    rows = self.db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch)
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32).tolist()
+                        found[key] = vector
+                        self.remember(key, vector)
+                        self.disk_hits += 1
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        count("embedding_cache.hits", len(found))
+        count("embedding_cache.misses", len(keys) - len(found))
+        return found
+
+    def put_many(self, items):
+        with self.lock:
+            for key, vector in items:
+                if vector:
+                    self.remember(key, vector)
+            if self.db is not None:
+                rows = [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items if vector]
+                try:
+                    self.db.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+                    self.db.commit()
+                except Exception as e:
+                    print(f"[WARN] Embedding disk cache write failed: {e}", file=sys.stderr)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+def cached_embed(cache, model, text_list, embed_fn):
+    """Embed text_list, calling embed_fn only for texts not already cached."""
+    keys = [cache_key(text, model) for text in text_list]
+    found = cache.get_many(keys)
+
+    todo = {}
+    for key, text in zip(keys, text_list):
+        if key not in found and key not in todo:
+            todo[key] = text
+    if todo:
+        vectors = embed_fn(list(todo.values()))
+        fresh = list(zip(todo.keys(), vectors))
+        cache.put_many(fresh)
+        found.update(fresh)
+
+    return [found.get(key, []) for key in keys]
@@ -0,0 +1,92 @@
+import sys
+import numpy as np
+from bson import Binary
+from pymongo import UpdateOne
+from config import EMBEDDING_STORAGE
+
+# Chunk embeddings are stored as packed little-endian bytes in `embedding`, with
+# `embedding_format` naming the layout. int8 vectors are scalar-quantized per
+# chunk and keep their dequantization factor in `embedding_scale`. Documents
+# written before this have a plain list of doubles and no format field.
+FORMATS = {
+    "float32": np.dtype("<f4"),
+    "float16": np.dtype("<f2"),
+    "int8": np.dtype("i1"),
+}
+
+# Fields VectorIndex needs to rebuild a vector
+PROJECTION = {"embedding": 1, "embedding_format": 1, "embedding_scale": 1}
+
+def encode_embedding(vector, storage=EMBEDDING_STORAGE):
+    """Document fields for one embedding in the given storage format ("list" keeps JSON floats)."""
+    if storage == "list":
+        return {"embedding": [float(x) for x in vector]}
+    if storage not in FORMATS:
+        raise ValueError(f"Unknown embedding storage format: {storage}")
+
+    vector = np.asarray(vector, dtype=np.float32)
+    fields = {"embedding_format": storage}
+    if storage == "int8":
+        peak = float(np.abs(vector).max()) if len(vector) else 0.0
+        scale = peak / 127 if peak else 1.0
+        vector = np.clip(np.rint(vector / scale), -127, 127)
+        fields["embedding_scale"] = scale
+    fields["embedding"] = Binary(vector.astype(FORMATS[storage]).tobytes())
+    return fields
+
+def decode_embedding(doc):
+    """float32 vector for a stored document, or None if it has no usable embedding."""
+    emb = doc.get("embedding")
+    storage = doc.get("embedding_format")
+    if storage is None:
+        if not isinstance(emb, list) or not emb:
+            return None
+        return np.asarray(emb, dtype=np.float32)
+    if storage not in FORMATS or not isinstance(emb, bytes) or not emb:
+        return None
+
+    # Zero-copy view of the BSON payload; only float16/int8 need a widening copy
+    vector = np.frombuffer(emb, dtype=FORMATS[storage])
+    if storage == "float32":
+        return vector
+    vector = vector.astype(np.float32)
+    if storage == "int8":
+        vector *= np.float32(doc.get("embedding_scale", 1.0))
+    return vector
+
+def migrate_collection(collection, storage=EMBEDDING_STORAGE, batch_size=500):
+    """Re-encode every embedding not already stored as `storage`. Returns the number converted."""
+    query = {"embedding": {"$exists": True}, "embedding_format": {"$ne": storage}}
+    if storage == "list":
+        query = {"embedding_format": {"$exists": True}}
+
+    converted = 0
+    updates = []
+    for doc in collection.find(query, PROJECTION):
+        vector = decode_embedding(doc)
+        if vector is None:
+            continue
+        fields = encode_embedding(vector, storage)
+        unset = {k: "" for k in ("embedding_format", "embedding_scale") if k not in fields}
+        change = {"$set": fields}
+        if unset:
+            change["$unset"] = unset
+        updates.append(UpdateOne({"_id": doc["_id"]}, change))
+        if len(updates) >= batch_size:
+            converted += collection.bulk_write(updates, ordered=False).modified_count
+            updates = []
+            print(f"[INFO] Converted {converted} embeddings to {storage}", file=sys.stderr)
+    if updates:
+        converted += collection.bulk_write(updates, ordered=False).modified_count
+    return converted
+
+if __name__ == "__main__":
+    from db import collection
+
+    storage = sys.argv[1] if len(sys.argv) > 1 else EMBEDDING_STORAGE
+    if storage not in FORMATS and storage != "list":
+        print(f"Usage: python embedding_codec.py [{'|'.join(FORMATS)}|list]", file=sys.stderr)
+        sys.exit(1)
+
+    count = migrate_collection(collection, storage)
+    print(f"Migrated {count} embeddings to {storage}")
@@ -1,7 +1,19 @@
 from huggingface_hub import InferenceClient
-from config import EMBEDDING_MODEL, HF_API_KEY
+from config import (EMBEDDING_MODEL, HF_API_KEY, EMBEDDING_PROVIDER, EMBEDDING_LOCAL_BACKEND, EMBEDDING_BATCH_WAIT_MS,
+                    EMBEDDING_MAX_BATCH, EMBEDDING_BATCH_TOKENS, EMBEDDING_WORKERS, EMBEDDING_RETRIES)
+from embedding_cache import EmbeddingCache, cached_embed, cache_key
+from chunker import count_tokens
+from tracing import span, count
+from concurrent.futures import Future, ThreadPoolExecutor
+import queue
+import random
+import contextvars
+import re
 import sys
+import threading
 import time
+import zlib
+import numpy as np
 
 if not HF_API_KEY:
     print("Error: HF_API_KEY is not set. Cannot initialize Hugging Face client.", file=sys.stderr)
@@ -9,53 +21,306 @@ if not HF_API_KEY:
 else:
     client = InferenceClient(api_key=HF_API_KEY)
 
-def get_embedding(text):
-    if not client:
-        return []
-    
-    retries = 3
-    for attempt in range(retries):
-        try:
-            # feature_extraction returns a numpy array, we need to convert to list for JSON serialization
-            output = client.feature_extraction(text, model=EMBEDDING_MODEL)
-            return output.tolist()
-        except Exception as e:
-            if "503" in str(e) or "Model is loading" in str(e):
-                print(f"Model loading, retrying in 10s... (Attempt {attempt + 1}/{retries})", file=sys.stderr)
-                time.sleep(10)
-            elif attempt < retries - 1:
-                print(f"Network error, retrying in 5s... (Attempt {attempt + 1}/{retries})", file=sys.stderr)
-                time.sleep(5)
-            else:
-                raise e
-    return []
 
-def get_embeddings(text_list):
-    if not client:
+class RemoteEmbeddingProvider:
+    """Hugging Face Inference API. Used when no local model is available, and as a fallback."""
+
+    name = "remote"
+    dim = None  # whatever the hosted model returns
+
+    def embed(self, text_list, retries=3):
+        if not client:
+            return [[] for _ in text_list]
+
+        for attempt in range(retries):
+            try:
+                # feature_extraction on a list returns a 2D numpy array
+                output = client.feature_extraction(text_list, model=EMBEDDING_MODEL)
+                return output.tolist()
+            except Exception as e:
+                if attempt == retries - 1:
+                    raise e
+                if "503" in str(e) or "Model is loading" in str(e):
+                    print(f"Model loading, retrying in 10s... (Attempt {attempt + 1}/{retries})", file=sys.stderr)
+                    time.sleep(10)
+                else:
+                    print(f"Network error, retrying in 5s... (Attempt {attempt + 1}/{retries})", file=sys.stderr)
+                    time.sleep(5)
         return [[] for _ in text_list]
-        
-    retries = 3
-    for attempt in range(retries):
+
+
+class LocalEmbeddingProvider:
+    """all-MiniLM-L6-v2 on the local CPU via sentence-transformers (torch or ONNX Runtime backend)."""
+
+    name = "local"
+
+    def __init__(self):
+        from sentence_transformers import SentenceTransformer
+        kwargs = {"device": "cpu"}
+        if EMBEDDING_LOCAL_BACKEND != "torch":
+            kwargs["backend"] = EMBEDDING_LOCAL_BACKEND
+        self.model = SentenceTransformer(EMBEDDING_MODEL, **kwargs)
+        self.dim = self.model.get_sentence_embedding_dimension()
+        print(f"[INFO] Loaded local embedding model {EMBEDDING_MODEL} ({EMBEDDING_LOCAL_BACKEND})", file=sys.stderr)
+
+    def embed(self, text_list):
+        if not text_list:
+            return []
+        vectors = self.model.encode(text_list, batch_size=EMBEDDING_MAX_BATCH, convert_to_numpy=True, show_progress_bar=False)
+        return vectors.tolist()
+
+
+class HashEmbeddingProvider:
+    """Deterministic feature-hashing vectors, no model or network (EMBEDDING_PROVIDER=hash).
+
+    Texts sharing words get similar vectors, which is enough for offline
+    development and benchmark.py, but nowhere near a real model's quality.
+    """
+
+    name = "hash"
+    TOKEN = re.compile(r"\w+")
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def embed(self, text_list):
+        matrix = np.zeros((len(text_list), self.dim), dtype=np.float32)
+        for row, text in enumerate(text_list):
+            for token in self.TOKEN.findall(text.lower()):
+                digest = zlib.crc32(token.encode("utf-8"))
+                matrix[row, digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return (matrix / norms).tolist()
+
+
+class MicroBatcher:
+    """Coalesces concurrent single-text requests into one embed_fn(texts) call.
+
+    The first waiting request opens a window of EMBEDDING_BATCH_WAIT_MS; every
+    request that arrives in that window (up to EMBEDDING_MAX_BATCH) shares the
+    same forward pass.
+    """
+
+    def __init__(self, embed_fn, wait_ms=EMBEDDING_BATCH_WAIT_MS, max_batch=EMBEDDING_MAX_BATCH):
+        self.embed_fn = embed_fn
+        self.wait = wait_ms / 1000.0
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.run, name="embedding-batcher", daemon=True)
+        self.worker.start()
+
+    def submit(self, text):
+        future = Future()
+        self.requests.put((text, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                vectors = self.embed_fn(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+
+def load_provider():
+    if EMBEDDING_PROVIDER == "hash":
+        return HashEmbeddingProvider()
+    if EMBEDDING_PROVIDER in ("local", "auto"):
         try:
-            # feature_extraction on a list returns a 2D numpy array
-            output = client.feature_extraction(text_list, model=EMBEDDING_MODEL)
-            return output.tolist()
+            return LocalEmbeddingProvider()
         except Exception as e:
-            if "503" in str(e) or "Model is loading" in str(e):
-                print(f"Model loading, retrying in 10s... (Attempt {attempt + 1}/{retries})", file=sys.stderr)
-                time.sleep(10)
-            elif attempt < retries - 1:
-                print(f"Network error, retrying in 5s... (Attempt {attempt + 1}/{retries})", file=sys.stderr)
-                time.sleep(5)
-            else:
-                raise e
-    return [[] for _ in text_list]
+            level = "[WARN]" if EMBEDDING_PROVIDER == "local" else "[INFO]"
+            print(f"{level} Local embedding model unavailable ({e}). Using the Hugging Face Inference API.", file=sys.stderr)
+    return remote_provider
+
+remote_provider = RemoteEmbeddingProvider()
+provider = load_provider()
+
+# Cached vectors are only reused by the provider that made them: the hash
+# vectors of benchmark.py must never answer real queries from the disk cache
+CACHE_MODEL = ":".join(str(part) for part in (EMBEDDING_MODEL, provider.name, provider.dim) if part)
+def embed_with_fallback(text_list, retries=3):
+    if provider is remote_provider:
+        return remote_provider.embed(text_list, retries)
+    try:
+        return provider.embed(text_list)
+    except Exception as e:
+        if not client:
+            raise e
+        print(f"[WARN] Local embedding failed: {e}. Falling back to the Hugging Face Inference API.", file=sys.stderr)
+        return remote_provider.embed(text_list, retries)
+
+# Only a local model benefits from coalescing; remote calls go straight out
+batcher = MicroBatcher(embed_with_fallback) if provider is not remote_provider else None
+
+cache = EmbeddingCache()
+
+def embed_single(text_list):
+    if batcher:
+        futures = [batcher.submit(text) for text in text_list]
+        return [future.result() for future in futures]
+    return remote_provider.embed(text_list)
+
+def get_embedding(text):
+    result = cached_embed(cache, CACHE_MODEL, [text], embed_single)
+    return result[0] if result else []
+
+def get_embeddings(text_list):
+    return cached_embed(cache, CACHE_MODEL, text_list, embed_with_fallback)
+
+
+def as_vector_list(embeddings, count):
+    # A single-text batch can come back as one flat vector
+    if count == 1 and embeddings and not isinstance(embeddings[0], list):
+        return [embeddings]
+    return embeddings
+
+def is_oversized(error):
+    """True for errors that a smaller request would avoid: 413 Payload Too Large and timeouts."""
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    message = str(error).lower()
+    return status == 413 or "413" in message or "too large" in message or "timeout" in type(error).__name__.lower() \
+        or "timed out" in message
+
+
+class PendingEmbeddings:
+    """Result of AdaptiveEmbedder.submit(): cached vectors plus the batches still running."""
+
+    def __init__(self, count, found, batches):
+        self.vectors = [None] * count
+        for position, vector in found.items():
+            self.vectors[position] = vector
+        self.batches = batches  # [(positions, future)]
+
+    def result(self):
+        for positions, future in self.batches:
+            for position, vector in zip(positions, future.result()):
+                self.vectors[position] = vector
+        self.batches = []
+        return self.vectors
+
+
+class AdaptiveEmbedder:
+    """Embeds ingestion texts as token-bounded batches on a bounded worker pool.
+
+    Batches hold at most `target` tokens and `max_batch` texts. A batch the
+    endpoint rejects as too large (413) or that times out is split in half,
+    and the target shrinks for the batches cut after it; every success grows
+    it back by 10%, up to `max_tokens`. Other failures are retried per
+    batch with jittered backoff. Each finished batch goes into the embedding
+    cache straight away, so work already done survives a later failure.
+    """
+
+    def __init__(self, embed_fn, workers=EMBEDDING_WORKERS, max_tokens=EMBEDDING_BATCH_TOKENS,
+                 max_batch=EMBEDDING_MAX_BATCH, retries=EMBEDDING_RETRIES, min_tokens=256):
+        self.embed_fn = embed_fn
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embedding")
+        self.max_tokens = max_tokens
+        self.min_tokens = min(min_tokens, max_tokens)
+        self.max_batch = max_batch
+        self.retries = retries
+        self.target = max_tokens
+        self.lock = threading.Lock()
+
+    def shrink(self, failed_tokens):
+        with self.lock:
+            self.target = max(self.min_tokens, min(self.target, failed_tokens // 2))
+
+    def grow(self):
+        with self.lock:
+            self.target = min(self.max_tokens, int(self.target * 1.1) + 1)
+
+    def plan(self, tokens):
+        """Cut positions 0..len(tokens) into consecutive batches under the current target."""
+        batches, current, used = [], [], 0
+        for position, count in enumerate(tokens):
+            if current and (used + count > self.target or len(current) >= self.max_batch):
+                batches.append(current)
+                current, used = [], 0
+            current.append(position)
+            used += count
+        if current:
+            batches.append(current)
+        return batches
+
+    def run(self, texts, tokens, stats):
+        for attempt in range(self.retries + 1):
+            try:
+                with span("embed.batch"):
+                    vectors = as_vector_list(self.embed_fn(texts), len(texts))
+                cache.put_many(list(zip((cache_key(text, CACHE_MODEL) for text in texts), vectors)))
+                self.grow()
+                with self.lock:
+                    stats["batches"] += 1
+                return vectors
+            except Exception as e:
+                if is_oversized(e) and len(texts) > 1:
+                    self.shrink(sum(tokens))
+                    half = len(texts) // 2
+                    with self.lock:
+                        stats["splits"] += 1
+                    count("embed.splits")
+                    print(f"[WARN] Embedding batch of {len(texts)} texts too large ({e}). Splitting; "
+                          f"target now {self.target} tokens.", file=sys.stderr)
+                    return self.run(texts[:half], tokens[:half], stats) + self.run(texts[half:], tokens[half:], stats)
+                if attempt == self.retries:
+                    raise
+                loading = "503" in str(e) or "Model is loading" in str(e)
+                delay = 10 if loading else random.uniform(0, 2 ** attempt)
+                with self.lock:
+                    stats["retries"] += 1
+                count("embed.retries")
+                print(f"[WARN] Embedding batch failed ({e}). Retrying in {delay:.1f}s "
+                      f"(Attempt {attempt + 1}/{self.retries + 1})...", file=sys.stderr)
+                time.sleep(delay)
+
+    def submit(self, texts, tokens=None, stats=None):
+        """Start embedding `texts` (token counts optional); returns PendingEmbeddings."""
+        stats = stats if stats is not None else new_embedding_stats()
+        keys = [cache_key(text, CACHE_MODEL) for text in texts]
+        cached = cache.get_many(keys)
+        found = {position: cached[key] for position, key in enumerate(keys) if key in cached}
+        todo = [position for position in range(len(texts)) if position not in found]
+        if tokens is None or any(count is None for count in tokens):
+            tokens = count_tokens(texts)
+
+        batches = []
+        for group in self.plan([tokens[position] for position in todo]):
+            positions = [todo[i] for i in group]
+            # Run in the caller's context so batch spans join its request trace
+            future = self.pool.submit(contextvars.copy_context().run, self.run, [texts[p] for p in positions],
+                                      [tokens[p] for p in positions], stats)
+            batches.append((positions, future))
+        return PendingEmbeddings(len(texts), found, batches)
+
+def new_embedding_stats():
+    return {"batches": 0, "retries": 0, "splits": 0}
+
+# Remote requests overlap on the pool; a local model already uses every core for one batch
+document_embedder = AdaptiveEmbedder(lambda texts: embed_with_fallback(texts, retries=1),
+                                     workers=EMBEDDING_WORKERS if provider is remote_provider else 1)
 
 if __name__ == "__main__":
-    if not HF_API_KEY:
-        print("Error: HF_API_KEY is not set. Defaulting to empty list.", file=sys.stderr)
-        sys.exit(1)
-        
     test_text = "This is a test sentence for embedding generation."
     embedding = get_embedding(test_text)
-    print(f"Generated embedding of length: {len(embedding)}")
\ No newline at end of file
+    if not embedding:
+        print("Error: No embedding provider available (install sentence-transformers or set HF_API_KEY).", file=sys.stderr)
+        sys.exit(1)
+    print(f"Generated embedding of length: {len(embedding)} (provider: {provider.name})")
@@ -0,0 +1,164 @@
+import sys
+import json
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+started = time.perf_counter()
+
+# The protocol owns the real stdout. Pipeline modules print progress freely,
+# so everything else is routed to stderr where Node only logs it.
+protocol_out = sys.stdout
+sys.stdout = sys.stderr
+
+# PDF extraction workers (pdf_extract.py) re-import this script as __mp_main__;
+# they only need pdfplumber, not the models and clients loaded below.
+if __name__ != "__mp_main__":
+    from config import ENGINE_WORKERS, ENGINE_CHAT_WORKERS, ENGINE_METRICS, LLM_MODEL
+    from generation import generate_answer, answer_cache
+    from retrieval import index, backend
+    from embeddings import cache as embedding_cache
+    from ingest import ingest_file
+    from scrape import ingest_url
+    from db import ensure_indexes
+    from reranker import reranker
+    from jobs import jobs, remove_upload
+    import tracing
+
+write_lock = threading.Lock()
+
+def send(message):
+    line = json.dumps(message)
+    with write_lock:
+        protocol_out.write(line + "\n")
+        protocol_out.flush()
+
+# Handlers stream intermediate messages themselves and return the final one,
+# so dispatch() can send the request's metrics ahead of it: Node forgets a
+# request as soon as its metadata/result arrives.
+
+def handle_generate(request_id, data):
+    def on_token(token):
+        send({"id": request_id, "type": "chunk", "text": token})
+
+    usage = {}
+    answer, sources, followups = generate_answer(
+        data.get("query"),
+        data.get("history", []),
+        data.get("model") or LLM_MODEL,
+        data.get("system_prompt"),
+        data.get("active_documents", []),
+        on_token=on_token,
+        on_usage=usage.update
+    )
+    return {"type": "metadata", "answer": answer, "sources": sources, "followups": followups, "usage": usage}
+
+def handle_ingest_file(request_id, data):
+    # With delete_file the upload is ours: Node may stop waiting before we finish
+    try:
+        return {"type": "result", **ingest_file(data["file_path"], data.get("source"))}
+    finally:
+        if data.get("delete_file"):
+            remove_upload(data["file_path"])
+
+def handle_ingest_url(request_id, data):
+    return {"type": "result", **ingest_url(data["url"], data.get("deep_crawl", False))}
+
+def handle_index_stats(request_id, data):
+    return {"type": "result", "success": True, "backend": backend.name,
+            "embedding_cache": embedding_cache.stats(), "answer_cache": answer_cache.stats(),
+            "reranker": reranker.stats(), **index.stats()}
+
+def handle_metrics(request_id, data):
+    return {"type": "result", "success": True, "format": "prometheus", "text": tracing.registry.prometheus_text()}
+
+def handle_submit_job(request_id, data):
+    return {"type": "result", "success": True, "job": jobs.submit(data["kind"], data.get("params", {}))}
+
+def handle_job_status(request_id, data):
+    return {"type": "result", "success": True, "job": jobs.get(data["job_id"])}
+
+def handle_list_jobs(request_id, data):
+    return {"type": "result", "success": True, "jobs": jobs.recent(data.get("limit", 50), data.get("status"))}
+
+def handle_cancel_job(request_id, data):
+    return {"type": "result", "success": True, "job": jobs.cancel(data["job_id"])}
+
+def handle_ping(request_id, data):
+    return {"type": "result", "success": True}
+
+HANDLERS = {
+    "generate": handle_generate,
+    "ingest_file": handle_ingest_file,
+    "ingest_url": handle_ingest_url,
+    "index_stats": handle_index_stats,
+    "metrics": handle_metrics,
+    "submit_job": handle_submit_job,
+    "job_status": handle_job_status,
+    "list_jobs": handle_list_jobs,
+    "cancel_job": handle_cancel_job,
+    "ping": handle_ping,
+}
+
+# Ops worth a per-request metrics message; the rest are cheap lookups
+TRACED_OPS = ("generate", "ingest_file", "ingest_url")
+INGEST_OPS = ("ingest_file", "ingest_url")
+
+def compact_segments():
+    # Compaction rewrites the whole segment matrix: run it after ingestion, never on a query
+    threading.Thread(target=index.compact_segments, name="segment-compaction", daemon=True).start()
+
+def on_job_update(job):
+    send({"type": "job", "job": job})
+    if job["status"] == "done":
+        compact_segments()
+
+def dispatch(request_id, op, data):
+    with tracing.trace(op) as request_trace:
+        try:
+            final = HANDLERS[op](request_id, data)
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            tracing.count(f"errors.{op}")
+            final = {"type": "error", "error": str(e)}
+    if ENGINE_METRICS and op in TRACED_OPS:
+        send({"id": request_id, "type": "metrics", **request_trace.to_message()})
+    send({"id": request_id, **final})
+    if op in INGEST_OPS and final["type"] != "error":
+        compact_segments()
+
+def serve(stream=sys.stdin):
+    ensure_indexes()
+    # Background ingestion jobs report every state change as a {"type": "job"} message
+    jobs.on_update = on_job_update
+    jobs.start()
+    startup_ms = round((time.perf_counter() - started) * 1000)
+    tracing.registry.set_gauge("engine_startup_ms", startup_ms)
+    print(f"[INFO] Engine ready in {startup_ms}ms ({ENGINE_WORKERS} workers, {ENGINE_CHAT_WORKERS} chat workers).",
+          file=sys.stderr)
+    send({"type": "ready", "startup_ms": startup_ms})
+
+    # Chats spend most of their time waiting on the shared async LLM client, so
+    # they don't hold up (or get held up by) ingestion in the main pool
+    with ThreadPoolExecutor(max_workers=ENGINE_WORKERS) as pool, \
+            ThreadPoolExecutor(max_workers=ENGINE_CHAT_WORKERS, thread_name_prefix="chat") as chat_pool:
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError as e:
+                send({"type": "error", "error": f"Invalid request: {e}"})
+                continue
+
+            request_id = data.get("id")
+            op = data.get("op")
+            if op not in HANDLERS:
+                send({"id": request_id, "type": "error", "error": f"Unknown op: {op}"})
+                continue
+
+            (chat_pool if op == "generate" else pool).submit(dispatch, request_id, op, data)
+
+if __name__ == "__main__":
+    serve()
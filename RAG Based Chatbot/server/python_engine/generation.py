@@ -1,24 +1,76 @@
 import sys
 import json
-import os
-from groq import Groq
-from pymongo import MongoClient
-from config import GROQ_API_KEY, LLM_MODEL, MONGODB_URI
-from retrieval import retrieve_chunks
+import time
+from config import LLM_MODEL, CONTEXT_CANDIDATES, RERANK_CANDIDATES
+from db import collection, iter_documents, CHUNK_PROJECTION
+from llm_client import LLMClient
+from retrieval import retrieve_chunks, index, to_query_vector
+from embeddings import get_embedding
+from answer_cache import AnswerCache, answer_scope, corpus_signature, replay_tokens
+from context_packer import pack_context
+from reranker import reranker
+from answer_stream import AnswerStream
+from tracing import trace, span, record, count
 
-client = Groq(api_key=GROQ_API_KEY)
+llm = LLMClient()
+answer_cache = AnswerCache()
 
-mongo_client = MongoClient(MONGODB_URI)
-db = mongo_client['rag_chatbot']
-collection = db['vectorStore']
+def get_all_chunks(projection=CHUNK_PROJECTION):
+    """Stream every chunk, one page at a time."""
+    return iter_documents(collection, None, projection)
 
-def get_all_chunks():
-    return list(collection.find({}))
+def print_token(token):
+    print(json.dumps({"type": "chunk", "text": token}), flush=True)
 
-def generate_answer(query, history=[], model=LLM_MODEL, custom_system_prompt=None, active_documents=[]):
+def check_answer_cache(query, model, custom_system_prompt, active_documents):
+    """Return (cached hit or None, cache key to store under, or None when not cacheable)."""
     try:
-        relevant_chunks = retrieve_chunks(query, active_documents=active_documents)
-        
+        query_vector = to_query_vector(get_embedding(query))
+        scope = answer_scope(model, custom_system_prompt, active_documents)
+        signature = corpus_signature(index.snapshot(), active_documents)
+    except Exception as e:
+        print(f"[WARN] Answer cache skipped: {e}", file=sys.stderr)
+        return None, None
+    return answer_cache.lookup(query_vector, scope, signature), (query_vector, scope, signature)
+
+def generate_answer(query, history=[], model=LLM_MODEL, custom_system_prompt=None, active_documents=[], on_token=print_token,
+                    on_usage=None):
+    try:
+        # Only self-contained questions are cached: with history, the answer depends on the conversation
+        cache_key = None
+        if answer_cache.enabled and not history:
+            with span("generate.answer_cache"):
+                cached, cache_key = check_answer_cache(query, model, custom_system_prompt, active_documents)
+            count("answer_cache.hits" if cached else "answer_cache.misses")
+            if cached:
+                print(f"[INFO] Answer cache hit (similarity {cached['similarity']})", file=sys.stderr)
+                for token in replay_tokens(cached["answer"]):
+                    on_token(token)
+                if on_usage:
+                    on_usage({"prompt_tokens": 0, "answer_cache": "hit", "similarity": cached["similarity"]})
+                return cached["answer"], cached["sources"], cached["followups"]
+
+        base_prompt = custom_system_prompt if custom_system_prompt else "You are a helpful assistant."
+        rules = (f"{base_prompt}\n\n"
+                 f"CRITICAL RAG RULES:\n"
+                 f"1. ONLY use the provided <CONTEXT> to answer. If the <CONTEXT> is about a DIFFERENT subject than the query, say: 'I could not find information about this in your uploaded documents/URLs.'\n"
+                 f"2. AT THE VERY END of your response, you MUST provide exactly two metadata lines:\n"
+                 f"SOURCE_RELEVANT: [True if the context was used to answer the query, False if not or if subjective mismatch]\n"
+                 f"FOLLOWUP: [\"Question 1?\", \"Question 2?\", \"Question 3?\"]\n\n")
+
+        # Fetch extra candidates; the packer keeps the diverse ones that fit the token budget.
+        # With reranking on, fetch more still and let the cross-encoder pick the best few first.
+        top_k = RERANK_CANDIDATES if reranker.enabled else CONTEXT_CANDIDATES
+        with span("generate.retrieve"):
+            candidates = retrieve_chunks(query, top_k=top_k, active_documents=active_documents, with_vectors=True)
+        if reranker.enabled:
+            with span("generate.rerank", candidates=len(candidates)):
+                candidates = reranker.rerank(query, candidates)
+        with span("generate.pack_context"):
+            relevant_chunks, history_messages, usage = pack_context(candidates, history, rules, query)
+        print(f"[INFO] Prompt ~{usage['prompt_tokens']} tokens (context {usage['context_tokens']} in {usage['chunks_used']} chunks, "
+              f"history {usage['history_tokens']})", file=sys.stderr)
+
         if not relevant_chunks:
             print("[INFO] No relevant documents found.", file=sys.stderr)
             context_text = "No relevant documents found."
@@ -34,106 +86,64 @@ def generate_answer(query, history=[], model=LLM_MODEL, custom_system_prompt=Non
             else:
                 sources = list(set([chunk.get('source', 'Unknown') for chunk in relevant_chunks]))
 
-        base_prompt = custom_system_prompt if custom_system_prompt else "You are a helpful assistant."
         system_msg = {
             "role": "system", 
-            "content": f"{base_prompt}\n\n"
-                       f"CRITICAL RAG RULES:\n"
-                       f"1. ONLY use the provided <CONTEXT> to answer. If the <CONTEXT> is about a DIFFERENT subject than the query, say: 'I could not find information about this in your uploaded documents/URLs.'\n"
-                       f"2. AT THE VERY END of your response, you MUST provide exactly two metadata lines:\n"
-                       f"SOURCE_RELEVANT: [True if the context was used to answer the query, False if not or if subjective mismatch]\n"
-                       f"FOLLOWUP: [\"Question 1?\", \"Question 2?\", \"Question 3?\"]\n\n"
-                       f"<CONTEXT>\n{context_text}\n</CONTEXT>"
+            "content": f"{rules}<CONTEXT>\n{context_text}\n</CONTEXT>"
         }
         
-        messages = [system_msg]
-        
-        for msg in history[-10:]: 
-            role = "user" if msg.get("role") == "user" else "assistant"
-            content = msg.get("content", "")
-            if content:
-                messages.append({"role": role, "content": content})
-        
+        messages = [system_msg] + history_messages
         messages.append({"role": "user", "content": query})
 
-        max_retries = 3
-        retry_delay = 2
-
-        for attempt in range(max_retries):
-            try:
-                completion = client.chat.completions.create(
-                    messages=messages,
-                    model=model,
-                    stream=True
-                )
-                
-                full_answer = ""
-                streaming_active = True
-                for chunk in completion:
-                    if chunk.choices[0].delta.content:
-                        token = chunk.choices[0].delta.content
-                        full_answer += token
-                        
-                        if streaming_active:
-                            # Detect markers to stop streaming
-                            is_marker = any(m in full_answer for m in ["SOURCE_RELEVANT:", "FOLLOWUP:"])
-                            if is_marker:
-                                streaming_active = False
-                            else:
-                                # Stream the token immediately
-                                print(json.dumps({"type": "chunk", "text": token}), flush=True)
-                
-                # Parse relevance and followups
-                followups = []
-                source_relevant = True
-                
-                # Robust stripping: Find the first occurrence of any metadata marker
-                markers = ["SOURCE_RELEVANT:", "FOLLOWUP:"]
-                meta_start = len(full_answer)
-                for marker in markers:
-                    idx = full_answer.find(marker)
-                    if idx != -1 and idx < meta_start:
-                        meta_start = idx
-                
-                answer_text = full_answer[:meta_start].strip()
-                
-                if "SOURCE_RELEVANT:" in full_answer:
-                    relevant_str = full_answer.split("SOURCE_RELEVANT:")[1].split("\n")[0].strip().lower()
-                    source_relevant = "true" in relevant_str
-                    
-                if "FOLLOWUP:" in full_answer:
-                    followup_part = full_answer.split("FOLLOWUP:")[1].strip()
-                    try:
-                        # (Existing parsing logic for followups)
-                        if "[" in followup_part and "]" in followup_part:
-                            import re
-                            match = re.search(r'\[.*\]', followup_part)
-                            if match:
-                                followups = json.loads(match.group(0))
-                    except: pass
-
-                # USER REQUEST: Hide follow-ups if source is false
-                if not source_relevant:
-                    followups = []
-
-                # Hide sources if the model explicitly says it failed OR if it self-reports as irrelevant
-                fallback_phrases = ["i could not find information", "not mentioned in the provided context", "don't have information about that"]
-                is_fallback = any(p in answer_text.lower() for p in fallback_phrases)
-                
-                if is_fallback or not source_relevant:
-                    sources = []
-                    
-                return answer_text, sources, followups
-                
-            except Exception as api_err:
-                if attempt < max_retries - 1:
-                    import time
-                    print(f"API Error (Attempt {attempt+1}/{max_retries}): {str(api_err)}. Retrying in {retry_delay}s...", file=sys.stderr)
-                    time.sleep(retry_delay)
-                    retry_delay *= 2
-                else:
-                    raise api_err
+        started = time.time()
+        answer_stream = AnswerStream()
+
+        def on_delta(token):
+            if "ttft_ms" not in usage:
+                usage["ttft_ms"] = round((time.time() - started) * 1000)
+                record("llm.first_token", usage["ttft_ms"])
+            # Metadata lines and partial markers are held back from the client
+            visible = answer_stream.feed(token)
+            if visible:
+                on_token(visible)
+
+        # Retries and hedging happen inside the client; a retried stream continues the answer
+        with span("llm.stream", model=model):
+            completion = llm.stream(messages, model, on_delta)
+        count("llm.retries", completion["attempts"] - 1)
+        count("llm.hedged", int(completion["hedged"]))
+        llm_usage = completion["usage"] or {}
+        usage["llm_prompt_tokens"] = llm_usage.get("prompt_tokens")
+        usage["llm_completion_tokens"] = llm_usage.get("completion_tokens")
+        usage["llm_attempts"] = completion["attempts"]
+        if completion["hedged"]:
+            usage["llm_model"] = completion["model"]
+
+        tail = answer_stream.close()
+        if tail:
+            on_token(tail)
+        answer_text, metadata = answer_stream.result()
+        source_relevant = metadata["source_relevant"]
+        followups = metadata["followups"]
+
+        # USER REQUEST: Hide follow-ups if source is false
+        if not source_relevant:
+            followups = []
+
+        # Hide sources if the model explicitly says it failed OR if it self-reports as irrelevant
+        fallback_phrases = ["i could not find information", "not mentioned in the provided context", "don't have information about that"]
+        is_fallback = any(p in answer_text.lower() for p in fallback_phrases)
         
+        if is_fallback or not source_relevant:
+            sources = []
+
+        usage["total_ms"] = round((time.time() - started) * 1000)
+        if cache_key is not None:
+            answer_cache.store(*cache_key, answer_text, sources, followups)
+            usage["answer_cache"] = "miss"
+        if on_usage:
+            on_usage(usage)
+        return answer_text, sources, followups
+
     except Exception as e:
         return f"Error generating answer: {str(e)}", [], []
 
@@ -151,10 +161,15 @@ if __name__ == "__main__":
         system_prompt = data.get("system_prompt", None)
         active_documents = data.get("active_documents", [])
         
-        answer, sources, followups = generate_answer(query, history, model, system_prompt, active_documents)
+        usage = {}
+        with trace("generate") as request_trace:
+            answer, sources, followups = generate_answer(query, history, model, system_prompt, active_documents,
+                                                         on_usage=usage.update)
+        print(json.dumps({"type": "metrics", **request_trace.to_message()}), flush=True)
         
         # Send metadata containing sources and followups
-        print(json.dumps({"type": "metadata", "answer": answer, "sources": sources, "followups": followups}), flush=True)
+        print(json.dumps({"type": "metadata", "answer": answer, "sources": sources, "followups": followups,
+                          "usage": usage}), flush=True)
         
     except Exception as e:
         error_msg = str(e)
@@ -1,79 +1,135 @@
 import os
 import sys
-import pdfplumber
-from pymongo import MongoClient
-from config import MONGODB_URI
-from embeddings import get_embeddings
+import time
+from collections import deque
+from config import (INGEST_BATCH_SIZE, INGEST_QUEUE_DEPTH, PDF_WORKERS, PDF_PARALLEL_MIN_PAGES, PDF_SHARD_PAGES,
+                    EMBEDDING_WORKERS)
+from pipeline import batched, prefetch
+from pdf_extract import count_pages, iter_pages_parallel, iter_pages_serial
+from chunker import iter_chunks
+from tracing import span, timed
 
-client = MongoClient(MONGODB_URI)
-db = client['rag_chatbot']
-collection = db['vectorStore']
+# Run as a script, PDF extraction workers re-import this file as __mp_main__;
+# they don't need the embedding model or the Mongo client.
+if __name__ != "__mp_main__":
+    from embeddings import document_embedder, new_embedding_stats
+    from chunk_store import SourceWriter
+    from db import collection, ensure_indexes
 
-def extract_text(file_path):
+TEXT_BLOCK_SIZE = 64 * 1024
+
+def iter_pages(file_path):
+    """Yield (page_number, text) one page at a time; TXT files are read in fixed-size blocks, all as page 1."""
     if file_path.endswith('.pdf'):
-        text = ""
-        with pdfplumber.open(file_path) as pdf:
-            for page in pdf.pages:
-                text += page.extract_text() or ""
-        return text
+        page_count = count_pages(file_path)
+        if PDF_WORKERS > 1 and page_count >= PDF_PARALLEL_MIN_PAGES:
+            print(f"[INFO] Extracting {page_count} pages across {PDF_WORKERS} processes", file=sys.stderr)
+            yield from iter_pages_parallel(file_path, PDF_WORKERS, PDF_SHARD_PAGES, page_count)
+        else:
+            yield from iter_pages_serial(file_path)
     elif file_path.endswith('.txt'):
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            return f.read()
+            while True:
+                block = f.read(TEXT_BLOCK_SIZE)
+                if not block:
+                    break
+                yield 1, block
     else:
         raise ValueError("Unsupported file format. Only PDF and TXT are supported.")
 
-def chunk_text(text, chunk_size=500, overlap=50):
-    chunks = []
-    for i in range(0, len(text), chunk_size - overlap):
-        chunks.append(text[i:i + chunk_size])
-    return chunks
+def extract_text(file_path):
+    return "".join(text for _, text in iter_pages(file_path))
+
+def embed_batches(chunk_batches, writer=None, stats=None, in_flight=EMBEDDING_WORKERS):
+    """Yield (batch, new_chunks, embeddings) per batch of chunker dicts, in order.
+
+    With a writer, chunks already stored for the source are filtered out
+    first and only new ones are embedded; new_chunks is then [(chunk, hash)].
+    Up to `in_flight` batches are embedded at once on the shared
+    AdaptiveEmbedder; `stats` collects its batch/retry/split counts.
+    """
+    pending = deque()
+
+    def collect():
+        batch, new_chunks, embeddings = pending.popleft()
+        try:
+            with span("ingest.embed_wait"):
+                return batch, new_chunks, embeddings.result()
+        except Exception as e:
+            raise RuntimeError(f"Embedding generation failed: {e}")
 
-def ingest_file(file_path):
+    for batch in chunk_batches:
+        with span("ingest.dedupe"):
+            new_chunks = writer.filter_new(batch) if writer else batch
+        chunks = [chunk for chunk, _ in new_chunks] if writer else batch
+        embeddings = document_embedder.submit([chunk["text"] for chunk in chunks],
+                                              [chunk.get("tokens") for chunk in chunks], stats)
+        pending.append((batch, new_chunks, embeddings))
+        if len(pending) >= max(1, in_flight):
+            yield collect()
+    while pending:
+        yield collect()
+
+def throughput(progress, started, stats):
+    """Per-job rates for the ingest result: chunks/sec overall and embedding batch counters."""
+    elapsed = max(time.time() - started, 1e-6)
+    return {"seconds": round(elapsed, 2), "chunks_per_sec": round(progress["chunks"] / elapsed, 1),
+            "embedded_per_sec": round(progress["embedded"] / elapsed, 1), **stats}
+
+def ingest_file(file_path, source_name=None, on_progress=None):
+    """Stream a file through extract -> chunk -> embed -> insert.
+
+    Each arrow is a bounded queue between threads, so the stages overlap and
+    at most a few batches are in memory regardless of document size.
+    Re-ingesting a source only embeds chunks whose content changed and
+    removes the chunks that are gone (see chunk_store.SourceWriter).
+    """
     print(f"Ingesting {file_path}...")
+    source_name = source_name or os.path.basename(file_path)
+    progress = {"pages": 0, "chunks": 0, "embedded": 0, "stored": 0}
+    ensure_indexes()
+    writer = SourceWriter(collection, source_name)
+    started, embedding_stats = time.time(), new_embedding_stats()
+
     try:
-        text = extract_text(file_path)
-    except Exception as e:
-        print(f"Error reading file: {e}", file=sys.stderr)
-        sys.exit(1)
+        chunks = iter_chunks(timed(iter_pages(file_path), "ingest.extract"), progress=progress)
+        chunk_batches = prefetch(batched(chunks, INGEST_BATCH_SIZE), INGEST_QUEUE_DEPTH, "ingest-extract")
+        embedded = prefetch(embed_batches(chunk_batches, writer, embedding_stats), INGEST_QUEUE_DEPTH, "ingest-embed")
 
-    if not text.strip():
-        print("Warning: No text extracted from file.", file=sys.stderr)
-        sys.exit(1)
+        for batch, new_chunks, embeddings in embedded:
+            progress["chunks"] += len(batch)
+            progress["embedded"] += len(new_chunks)
+            try:
+                with span("ingest.store"):
+                    progress["stored"] += writer.write(new_chunks, embeddings)
+            except Exception as db_err:
+                raise RuntimeError(f"Database insertion failed: {db_err}")
 
-    chunks = chunk_text(text)
-    
-    try:
-        embeddings = get_embeddings(chunks)
+            print(f"[INFO] {source_name}: {progress['pages']} pages read, {progress['stored']} new chunks stored", file=sys.stderr)
+            if on_progress:
+                on_progress(dict(progress))
 
+        if not writer.seen:
+            raise ValueError("No text extracted from file.")
+        with span("ingest.finish"):
+            stats = writer.finish()
     except Exception as e:
-        print(f"Embedding generation failed: {e}", file=sys.stderr)
-        sys.exit(1)
-    
-    documents = []
-    for i, chunk in enumerate(chunks):
-        documents.append({
-            "text": chunk,
-            "embedding": embeddings[i] if isinstance(embeddings[i], list) else embeddings, 
-            "source": os.path.basename(file_path)
-        })
-    
-    if len(documents) > 0 and isinstance(documents[0]['embedding'], float):
-        pass
+        # All-or-nothing: don't leave half a document searchable
+        writer.rollback()
+        if isinstance(e, (RuntimeError, ValueError)):
+            raise
+        raise RuntimeError(f"Error reading file: {e}")
 
-    if documents:
-        try:
-            collection.insert_many(documents)
-            print(f"Successfully stored {len(documents)} chunks from {file_path}")
-        except Exception as db_err:
-            print(f"Database insertion failed: {db_err}", file=sys.stderr)
-            sys.exit(1)
-    else:
-        print("No chunks to store.", file=sys.stderr)
-        sys.exit(1)
+    rates = throughput(progress, started, embedding_stats)
+    print(f"Successfully stored {file_path}: {stats['added']} added, {stats['unchanged']} unchanged, {stats['removed']} removed")
+    print(f"[INFO] {source_name}: {rates['chunks_per_sec']} chunks/sec over {rates['seconds']}s "
+          f"({rates['batches']} embedding batches, {rates['retries']} retries, {rates['splits']} splits)", file=sys.stderr)
+    return {"success": True, "chunks": stats["chunks"], "added": stats["added"], "unchanged": stats["unchanged"],
+            "removed": stats["removed"], "pages": progress["pages"], "source": source_name, "throughput": rates}
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python ingest.py <file_path>", file=sys.stderr)
+        print("Usage: python ingest.py <file_path> [source_name]", file=sys.stderr)
         sys.exit(1)
     
     file_path = sys.argv[1]
@@ -82,4 +138,8 @@ if __name__ == "__main__":
         print(f"Error: File not found at {file_path}", file=sys.stderr)
         sys.exit(1)
         
-    ingest_file(file_path)
\ No newline at end of file
+    try:
+        ingest_file(file_path, sys.argv[2] if len(sys.argv) > 2 else None)
+    except Exception as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
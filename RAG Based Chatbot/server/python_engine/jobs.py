@@ -0,0 +1,221 @@
+import os
+import sys
+import time
+import uuid
+import queue
+import threading
+import traceback
+from datetime import datetime, timezone
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from config import JOB_WORKERS, JOB_MAX_ATTEMPTS
+from db import db
+from ingest import ingest_file
+from scrape import ingest_url
+import tracing
+
+ACTIVE = ("queued", "running")
+DATE_FIELDS = ("created_at", "updated_at", "started_at", "finished_at")
+
+class JobCancelled(RuntimeError):
+    # A RuntimeError, so ingest_file/ingest_url roll back and re-raise it unchanged
+    pass
+
+def now():
+    return datetime.now(timezone.utc)
+
+def public(job):
+    """JSON-safe view of a job document."""
+    view = {"id": job["_id"], **{key: value for key, value in job.items() if key != "_id"}}
+    for key in DATE_FIELDS:
+        if view.get(key) is not None:
+            view[key] = view[key].isoformat()
+    return view
+
+def remove_upload(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"[WARN] Could not delete {path}: {e}", file=sys.stderr)
+
+def run_file(params, on_progress):
+    return ingest_file(params["file_path"], params.get("source"), on_progress=on_progress)
+
+def run_url(params, on_progress):
+    return ingest_url(params["url"], params.get("deep_crawl", False), on_progress=on_progress)
+
+RUNNERS = {"file": run_file, "url": run_url}
+
+
+class JobQueue:
+    """Background ingestion jobs, persisted in the `ingestJobs` collection.
+
+    submit() stores a queued job and returns at once; `workers` threads run
+    jobs through ingest_file / ingest_url, saving their progress (pages,
+    chunks, embedded, stored) after every batch and reporting each change to
+    `on_update`. cancel() drops a queued job, or stops a running one at its
+    next batch and rolls back what it stored.
+
+    Jobs still queued or running when the engine stopped are picked up again
+    by start(). A resumed job starts over, but cheaply: batches embedded
+    before the restart come from the disk embedding cache, and chunks already
+    stored count as unchanged (see chunk_store.SourceWriter), so only the
+    remainder is embedded and written.
+    """
+
+    def __init__(self, collection=db['ingestJobs'], workers=JOB_WORKERS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.collection = collection
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.pending = queue.Queue()
+        self.cancelled = set()    # ids of running jobs asked to stop
+        self.threads = []
+        self.lock = threading.Lock()
+        self.on_update = None
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            # Recovery needs Mongo; chat doesn't need the job queue, so the engine never waits on it
+            targets = [(self.prepare, "ingest-job-recovery")]
+            targets += [(self.work, f"ingest-job-{n}") for n in range(self.workers)]
+            for target, name in targets:
+                thread = threading.Thread(target=target, name=name, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def prepare(self, delay=1.0, max_delay=60.0):
+        """Create the queue's index and requeue interrupted jobs, retrying until Mongo answers."""
+        while True:
+            try:
+                self.collection.create_index([("status", ASCENDING), ("created_at", ASCENDING)], name="status_created_at")
+                self.recover()
+                return
+            except Exception as e:
+                print(f"[WARN] Could not recover ingestion jobs ({e}). Retrying in {delay:.0f}s.", file=sys.stderr)
+                time.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    def recover(self):
+        for job in self.collection.find({"status": {"$in": list(ACTIVE)}}).sort("created_at", ASCENDING):
+            if job["status"] == "running":
+                if job.get("attempts", 0) >= self.max_attempts:
+                    self.finish(job, "failed", error=f"Interrupted {job['attempts']} times; giving up")
+                    continue
+                print(f"[INFO] Resuming ingestion job {job['_id']} ({job['kind']}) after a restart", file=sys.stderr)
+                self.update(job["_id"], {"status": "queued", "resumed": True})
+            self.pending.put(job["_id"])
+
+    # --- Requests ---
+
+    def submit(self, kind, params):
+        if kind not in RUNNERS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        created = now()
+        job = {"_id": uuid.uuid4().hex, "kind": kind, "params": params, "status": "queued",
+               "progress": {"pages": 0, "chunks": 0, "embedded": 0, "stored": 0}, "attempts": 0,
+               "created_at": created, "updated_at": created}
+        self.collection.insert_one(job)
+        self.pending.put(job["_id"])
+        self.notify(job)
+        return public(job)
+
+    def get(self, job_id):
+        job = self.collection.find_one({"_id": job_id})
+        if job is None:
+            raise ValueError(f"Unknown job: {job_id}")
+        return public(job)
+
+    def recent(self, limit=50, status=None):
+        query = {"status": status} if status else {}
+        return [public(job) for job in self.collection.find(query).sort("created_at", DESCENDING).limit(limit)]
+
+    def cancel(self, job_id):
+        job = self.collection.find_one_and_update(
+            {"_id": job_id, "status": "queued"},
+            {"$set": {"status": "cancelled", "finished_at": now(), "updated_at": now()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if job is not None:
+            self.cleanup(job)
+            self.notify(job)
+            return public(job)
+        job = self.collection.find_one({"_id": job_id})
+        if job is None:
+            raise ValueError(f"Unknown job: {job_id}")
+        if job["status"] == "running":
+            self.cancelled.add(job_id)
+            job = self.update(job_id, {"cancel_requested": True})
+        return public(job)
+
+    # --- Workers ---
+
+    def work(self):
+        while True:
+            job_id = self.pending.get()
+            job = self.collection.find_one_and_update(
+                {"_id": job_id, "status": "queued"},
+                {"$set": {"status": "running", "started_at": now(), "updated_at": now()}, "$inc": {"attempts": 1}},
+                return_document=ReturnDocument.AFTER
+            )
+            if job is None:
+                continue  # cancelled while it waited
+            self.notify(job)
+            self.run(job)
+
+    def run(self, job):
+        job_id = job["_id"]
+
+        def on_progress(progress):
+            if job_id in self.cancelled:
+                raise JobCancelled("Cancelled")
+            self.update(job_id, {"progress": progress})
+
+        try:
+            with tracing.trace(f"job.{job['kind']}"):
+                result = RUNNERS[job["kind"]](job["params"], on_progress)
+            self.finish(job, "done", result=result)
+        except JobCancelled:
+            print(f"[INFO] Ingestion job {job_id} cancelled", file=sys.stderr)
+            self.finish(job, "cancelled")
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            self.finish(job, "failed", error=str(e))
+        finally:
+            self.cancelled.discard(job_id)
+
+    # --- State ---
+
+    def update(self, job_id, fields):
+        job = self.collection.find_one_and_update(
+            {"_id": job_id}, {"$set": {**fields, "updated_at": now()}}, return_document=ReturnDocument.AFTER
+        )
+        if job is not None:
+            self.notify(job)
+        return job
+
+    def finish(self, job, status, result=None, error=None):
+        fields = {"status": status, "finished_at": now()}
+        if result is not None:
+            fields["result"] = result
+        if error is not None:
+            fields["error"] = error
+        self.update(job["_id"], fields)
+        self.cleanup(job)
+
+    def cleanup(self, job):
+        # Uploads handed over with delete_file belong to the job once it has finished
+        path = job["params"].get("file_path")
+        if job["params"].get("delete_file") and path:
+            remove_upload(path)
+
+    def notify(self, job):
+        if self.on_update:
+            try:
+                self.on_update(public(job))
+            except Exception as e:
+                print(f"[WARN] Job update listener failed: {e}", file=sys.stderr)
+
+jobs = JobQueue()
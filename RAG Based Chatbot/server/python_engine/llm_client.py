@@ -0,0 +1,239 @@
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import asyncio
+import threading
+import aiohttp
+from config import (GROQ_API_KEY, LLM_BASE_URL, LLM_MAX_CONNECTIONS, LLM_MAX_RETRIES, LLM_BACKOFF_BASE,
+                    LLM_BACKOFF_MAX, LLM_READ_TIMEOUT, LLM_HEDGE_MODEL, LLM_HEDGE_DELAY)
+
+RETRY_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+class LLMError(Exception):
+    pass
+
+class RetryableError(LLMError):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_duration(value):
+    """Seconds in a rate-limit header: "7.66s", "2m59.56s", "120ms" or a bare number."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        parts = DURATION_PART.findall(value)
+        return sum(float(n) * DURATION_SECONDS[unit] for n, unit in parts) if parts else None
+
+def retry_after(headers):
+    """How long the server asked us to wait, from Retry-After or an exhausted x-ratelimit-* window."""
+    wait = parse_duration(headers.get("retry-after"))
+    if wait is not None:
+        return wait
+    waits = [parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+             for kind in ("requests", "tokens") if headers.get(f"x-ratelimit-remaining-{kind}") == "0"]
+    waits = [w for w in waits if w is not None]
+    return max(waits) if waits else None
+
+
+class LLMClient:
+    """Streaming client for an OpenAI-compatible /chat/completions endpoint.
+
+    One pooled aiohttp session runs on a background event loop, shared by
+    every generation in the process. Failed requests are retried with
+    full-jitter exponential backoff, or after the delay the rate-limit
+    headers ask for. A stream that breaks after some tokens resumes by
+    sending the delivered text back as an assistant prefix, so nothing is
+    emitted twice. With a hedge model set, a request that has produced no
+    token after `hedge_delay` seconds is raced against the same request to
+    that model, and the first to start streaming wins.
+    """
+
+    def __init__(self, base_url=LLM_BASE_URL, api_key=GROQ_API_KEY, max_connections=LLM_MAX_CONNECTIONS,
+                 max_retries=LLM_MAX_RETRIES, backoff_base=LLM_BACKOFF_BASE, backoff_max=LLM_BACKOFF_MAX,
+                 read_timeout=LLM_READ_TIMEOUT, hedge_model=LLM_HEDGE_MODEL, hedge_delay=LLM_HEDGE_DELAY):
+        self.url = base_url.rstrip("/") + "/chat/completions"
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.read_timeout = read_timeout
+        self.hedge_model = hedge_model or None
+        self.hedge_delay = hedge_delay
+
+        self.loop = None
+        self.session = None
+        self.lock = threading.Lock()
+
+    # --- Event loop ---
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="llm-client", daemon=True).start()
+                atexit.register(self.close)
+            return self.loop
+
+    def close(self):
+        if self.loop is None:
+            return
+        if self.session is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result(timeout=5)
+            except Exception:
+                pass
+            self.session = None
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop = None
+
+    async def get_session(self):
+        # Created on the client loop, which is the only loop that touches it
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=None, connect=10, sock_read=self.read_timeout),
+                headers={"Authorization": f"Bearer {self.api_key}"}
+            )
+        return self.session
+
+    # --- Requests ---
+
+    async def events(self, messages, model):
+        """Async generator of (text delta, usage or None) from one streaming request."""
+        session = await self.get_session()
+        payload = {"model": model, "messages": messages, "stream": True}
+        try:
+            async with session.post(self.url, json=payload) as response:
+                if response.status >= 400:
+                    body = (await response.text(errors="ignore"))[:300]
+                    message = f"HTTP {response.status} from {model}: {body}"
+                    if response.status in RETRY_STATUSES:
+                        raise RetryableError(message, retry_after(response.headers))
+                    raise LLMError(message)
+                async for raw in response.content:
+                    line = raw.decode("utf-8", errors="ignore").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        return
+                    chunk = json.loads(data)
+                    if chunk.get("error"):
+                        raise RetryableError(f"Stream error from {model}: {chunk['error']}")
+                    choices = chunk.get("choices") or [{}]
+                    text = (choices[0].get("delta") or {}).get("content") or ""
+                    # Groq reports exact token usage on the last chunk
+                    usage = (chunk.get("x_groq") or {}).get("usage") or chunk.get("usage")
+                    if text or usage:
+                        yield text, usage
+                raise RetryableError(f"Stream from {model} ended before [DONE]")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise RetryableError(f"{type(e).__name__} from {model}: {e}") from e
+
+    async def first_event(self, messages, model):
+        """Start a request and wait for its first event. Returns (first event or None, rest of the stream)."""
+        stream = self.events(messages, model)
+        try:
+            return await stream.__anext__(), stream
+        except StopAsyncIteration:
+            return None, stream
+
+    async def open(self, messages, model, hedge):
+        """Return (first event, stream, model that produced it), hedging when allowed."""
+        primary = asyncio.ensure_future(self.first_event(messages, model))
+        if not hedge or not self.hedge_model or self.hedge_model == model:
+            return (*await primary, model)
+
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay)
+        if done:
+            return (*primary.result(), model)
+        print(f"[INFO] No token from {model} after {self.hedge_delay}s, hedging with {self.hedge_model}", file=sys.stderr)
+        backup = asyncio.ensure_future(self.first_event(messages, self.hedge_model))
+        tasks = {primary: model, backup: self.hedge_model}
+        errors = []
+        while tasks:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in done if task.exception() is None]
+            errors.extend(task.exception() for task in done if task.exception() is not None)
+            if not winners:
+                for task in done:
+                    del tasks[task]
+                continue
+            winner = winners[0]
+            for loser in tasks:
+                if loser is not winner:
+                    loser.cancel()
+            for loser in winners[1:]:
+                await loser.result()[1].aclose()
+            await asyncio.gather(*(t for t in tasks if t is not winner), return_exceptions=True)
+            return (*winner.result(), tasks[winner])
+        raise errors[0]
+
+    def backoff(self, attempt, hint):
+        if hint is not None:
+            return hint + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def astream(self, messages, model, on_delta):
+        """Stream one completion, calling on_delta(text) for each new piece.
+
+        Returns {"text", "model", "usage", "attempts", "hedged"}.
+        """
+        delivered = ""
+        result = {"model": model, "usage": None, "attempts": 0, "hedged": False}
+        for attempt in range(self.max_retries + 1):
+            result["attempts"] += 1
+            request = list(messages)
+            if delivered:
+                # Continue the answer from where the broken stream stopped
+                request.append({"role": "assistant", "content": delivered})
+            try:
+                event, stream, result["model"] = await self.open(request, result["model"], hedge=attempt == 0)
+                result["hedged"] = result["hedged"] or result["model"] != model
+                try:
+                    while event is not None:
+                        text, usage = event
+                        if usage:
+                            result["usage"] = usage
+                        if text:
+                            delivered += text
+                            on_delta(text)
+                        event = await stream.__anext__()
+                except StopAsyncIteration:
+                    pass
+                finally:
+                    await stream.aclose()
+                result["text"] = delivered
+                return result
+            except RetryableError as e:
+                delay = self.backoff(attempt, e.retry_after)
+                if attempt == self.max_retries or delay > self.backoff_max:
+                    raise
+                print(f"[WARN] LLM request failed (attempt {attempt + 1}/{self.max_retries + 1}): {e}. "
+                      f"Retrying in {delay:.1f}s{' from the partial answer' if delivered else ''}...", file=sys.stderr)
+                await asyncio.sleep(delay)
+
+    def stream(self, messages, model, on_token):
+        """Blocking astream() for worker threads: on_token runs on the calling thread."""
+        deltas = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self.astream(messages, model, deltas.put), self.start())
+        future.add_done_callback(lambda f: deltas.put(None))
+        try:
+            while True:
+                text = deltas.get()
+                if text is None:
+                    break
+                on_token(text)
+        except BaseException:
+            future.cancel()
+            raise
+        return future.result()
@@ -0,0 +1,89 @@
+import sys
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import pdfplumber
+
+# Kept free of config/Mongo/embedding imports so worker processes stay small.
+
+def count_pages(file_path):
+    with pdfplumber.open(file_path) as pdf:
+        return len(pdf.pages)
+
+def extract_page_range(file_path, start, end):
+    """Text of pages [start, end) (0-based), one string per page."""
+    texts = []
+    with pdfplumber.open(file_path) as pdf:
+        for page in pdf.pages[start:end]:
+            texts.append(page.extract_text() or "")
+            page.close()
+    return texts
+
+def iter_pages_serial(file_path):
+    with pdfplumber.open(file_path) as pdf:
+        for number, page in enumerate(pdf.pages, start=1):
+            text = page.extract_text() or ""
+            page.close()  # drop the parsed layout objects before the next page
+            yield number, text
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def pool_context():
+    # The engine is multi-threaded (job runner, embedding batcher, reranker loader),
+    # and a forked child can inherit a lock one of those threads held and deadlock.
+    # forkserver forks workers from a single-threaded server that has only imported
+    # this module. Workers still re-import the parent's script as __mp_main__, so
+    # engine_server.py and ingest.py skip their heavy imports under that name.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["pdf_extract"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+def get_pool(workers):
+    # One pool per process, reused across uploads so worker start-up is paid once
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=pool_context())
+        return _pool
+
+def drop_pool(pool):
+    # A worker died (e.g. killed for memory): the executor is unusable, so the next upload starts a new one
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def iter_pages_parallel(file_path, workers, shard_pages, page_count=None):
+    """Yield (page_number, text) in page order while shards are extracted across processes.
+
+    At most 2 * workers shards are in flight, so a huge PDF never has more
+    than that many pages of text waiting to be chunked.
+    """
+    page_count = count_pages(file_path) if page_count is None else page_count
+    pool = get_pool(workers)
+    shards = [(start, min(start + shard_pages, page_count)) for start in range(0, page_count, shard_pages)]
+    in_flight = []
+    next_shard = 0
+
+    try:
+        while next_shard < len(shards) or in_flight:
+            while next_shard < len(shards) and len(in_flight) < 2 * workers:
+                start, end = shards[next_shard]
+                in_flight.append((start, pool.submit(extract_page_range, file_path, start, end)))
+                next_shard += 1
+
+            start, future = in_flight.pop(0)
+            for offset, text in enumerate(future.result()):
+                yield start + offset + 1, text
+    except BrokenProcessPool:
+        print(f"[WARN] PDF extraction pool broke while reading {file_path}; it will be recreated", file=sys.stderr)
+        drop_pool(pool)
+        raise
+    finally:
+        for _, future in in_flight:
+            future.cancel()
@@ -0,0 +1,73 @@
+import queue
+import asyncio
+import threading
+import contextlib
+import contextvars
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def prefetch(iterable, maxsize=2, name="pipeline-stage"):
+    """Run `iterable` in a background thread, handing items over through a bounded queue.
+
+    Chaining prefetch() stages lets extraction, embedding and database writes
+    overlap while at most `maxsize` items wait between any two stages, so
+    memory stays flat however large the input is. Exceptions raised by the
+    producer are re-raised in the consumer. If the consumer stops early the
+    producer is told to stop at its next hand-off. The producer runs in a copy
+    of the consumer's context, so its spans land in the same request trace.
+
+    An async generator gets its own event loop in the background thread. That
+    loop keeps running while the queue is full (hand-offs wait in a worker
+    thread), so in-flight I/O and its timeouts don't stall on a slow consumer.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def hand_off(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    async def produce_async():
+        async with contextlib.aclosing(iterable) as items_async:
+            async for item in items_async:
+                if not await asyncio.to_thread(hand_off, ("item", item)):
+                    return
+        await asyncio.to_thread(hand_off, ("done", None))
+
+    def produce():
+        try:
+            if hasattr(iterable, "__aiter__"):
+                asyncio.run(produce_async())
+                return
+            for item in iterable:
+                if not hand_off(("item", item)):
+                    return
+            hand_off(("done", None))
+        except BaseException as e:
+            hand_off(("error", e))
+
+    worker = threading.Thread(target=contextvars.copy_context().run, args=(produce,), name=name, daemon=True)
+    worker.start()
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        stop.set()
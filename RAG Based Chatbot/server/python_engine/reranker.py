@@ -0,0 +1,132 @@
+import sys
+import math
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from config import (RERANK, RERANK_MODEL, RERANK_TOP_K, RERANK_BUDGET_MS, RERANK_CACHE_SIZE, RERANK_MAX_LENGTH)
+from embedding_cache import normalize_text
+from tracing import count
+
+
+class Reranker:
+    """Rescores retrieved chunks against the query with a cross-encoder on the local CPU.
+
+    All uncached (query, chunk) pairs of a request go through one batched
+    forward pass. The cost per pair is tracked as a moving average, and only
+    the best-ranked candidates that fit in `budget_ms` are scored; the rest
+    follow the scored ones in retrieval order. The model loads on a
+    background thread; until it is ready (or if it can't load) chunks keep
+    their retrieval order.
+    """
+
+    def __init__(self, model_name=RERANK_MODEL, top_k=RERANK_TOP_K, budget_ms=RERANK_BUDGET_MS,
+                 cache_size=RERANK_CACHE_SIZE, max_length=RERANK_MAX_LENGTH, enabled=RERANK):
+        self.model_name = model_name
+        self.top_k = top_k
+        self.budget_ms = budget_ms
+        self.cache_size = cache_size
+        self.max_length = max_length
+        self.enabled = enabled
+        self.model = None
+        self.logits = False      # the model outputs raw logits; squash them to 0..1
+        self.pair_ms = None      # moving average of forward-pass time per pair
+        self.scores = OrderedDict()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.pairs_scored = 0
+        self.cache_hits = 0
+        self.over_budget = 0
+        if enabled:
+            threading.Thread(target=self.load, name="reranker-load", daemon=True).start()
+
+    def load(self):
+        try:
+            from sentence_transformers import CrossEncoder
+            model = CrossEncoder(self.model_name, device="cpu", max_length=self.max_length)
+            # ms-marco models ship with an identity activation; older and newer releases name the attribute differently
+            activation = getattr(model, "activation_fn", None) or getattr(model, "default_activation_function", None)
+            self.logits = type(activation).__name__ == "Identity"
+            self.model = model
+            print(f"[INFO] Loaded reranker {self.model_name}", file=sys.stderr)
+        except Exception as e:
+            self.enabled = False
+            print(f"[WARN] Reranker unavailable ({e}). Using retrieval order.", file=sys.stderr)
+        finally:
+            self.ready.set()
+
+    @staticmethod
+    def pair_key(query, chunk):
+        chunk_key = chunk.get("content_hash") or str(chunk.get("_id"))
+        return hashlib.sha1(f"{normalize_text(query)}\x00{chunk_key}".encode("utf-8")).hexdigest()
+
+    def budgeted(self, pairs):
+        """How many of `pairs` uncached pairs fit in the latency budget."""
+        if self.budget_ms <= 0 or self.pair_ms is None:
+            return pairs
+        return max(1, min(pairs, int(self.budget_ms / self.pair_ms)))
+
+    def score(self, query, chunks):
+        """Return {position: relevance in 0..1} for the chunks scored (cached or within budget)."""
+        keys = [self.pair_key(query, chunk) for chunk in chunks]
+        scores = {}
+        with self.lock:
+            for position, key in enumerate(keys):
+                if key in self.scores:
+                    self.scores.move_to_end(key)
+                    scores[position] = self.scores[key]
+            self.cache_hits += len(scores)
+        count("rerank.cache_hits", len(scores))
+
+        todo = [position for position in range(len(chunks)) if position not in scores]
+        fit = self.budgeted(len(todo))
+        if fit < len(todo):
+            with self.lock:
+                self.over_budget += len(todo) - fit
+            count("rerank.over_budget", len(todo) - fit)
+            todo = todo[:fit]
+        if not todo:
+            return scores
+
+        started = time.perf_counter()
+        outputs = self.model.predict([(query, chunks[p].get("text", "")) for p in todo], batch_size=len(todo),
+                                     convert_to_numpy=True, show_progress_bar=False)
+        per_pair = (time.perf_counter() - started) * 1000 / len(todo)
+        with self.lock:
+            self.pair_ms = per_pair if self.pair_ms is None else 0.8 * self.pair_ms + 0.2 * per_pair
+            self.pairs_scored += len(todo)
+            for position, output in zip(todo, outputs.tolist()):
+                value = 1 / (1 + math.exp(-output)) if self.logits else float(output)
+                scores[position] = value
+                self.scores[keys[position]] = value
+                self.scores.move_to_end(keys[position])
+            while len(self.scores) > self.cache_size:
+                self.scores.popitem(last=False)
+        return scores
+
+    def rerank(self, query, chunks, top_k=None):
+        """Return the best `top_k` chunks, best first, each scored one with a `rerank_score`.
+
+        `score` stays the cosine similarity that callers threshold on.
+        """
+        top_k = top_k or self.top_k
+        if not self.enabled or not chunks or not self.ready.is_set() or self.model is None:
+            return chunks[:top_k]
+        try:
+            scores = self.score(query, chunks)
+        except Exception as e:
+            print(f"[WARN] Reranking failed ({e}). Using retrieval order.", file=sys.stderr)
+            return chunks[:top_k]
+        for position, value in scores.items():
+            chunks[position]["rerank_score"] = round(value, 4)
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        ranked += [position for position in range(len(chunks)) if position not in scores]
+        return [chunks[position] for position in ranked[:top_k]]
+
+    def stats(self):
+        return {"enabled": self.enabled, "model": self.model_name if self.enabled else None,
+                "ready": self.ready.is_set() and self.model is not None, "pairs_scored": self.pairs_scored,
+                "cache_hits": self.cache_hits, "over_budget": self.over_budget,
+                "ms_per_pair": round(self.pair_ms, 3) if self.pair_ms is not None else None}
+
+reranker = Reranker()
@@ -1,63 +1,106 @@
-from pymongo import MongoClient
-from config import MONGODB_URI
+import sys
+import numpy as np
+from config import (VECTOR_SEGMENTS, HYBRID_SEARCH, HYBRID_FUSION, HYBRID_RRF_K, HYBRID_DENSE_WEIGHT,
+                    HYBRID_PREFILTER_MIN_ROWS, HYBRID_PREFILTER_CANDIDATES)
 from embeddings import get_embedding
+from vector_index import VectorIndex
+from segments import SegmentStore
+from retrieval_backends import SIMILARITY_THRESHOLD, create_backend
+from sparse_index import BM25Index, fuse_rankings
+from db import collection, CHUNK_PROJECTION
+from tracing import span
 
-client = MongoClient(MONGODB_URI)
-db = client['rag_chatbot']
-collection = db['vectorStore']
+index = VectorIndex(collection, segments=SegmentStore() if VECTOR_SEGMENTS else None)
+backend = create_backend()
+sparse = BM25Index(collection) if HYBRID_SEARCH else None
 
-def retrieve_chunks(query, top_k=5, active_documents=[]):
+def to_query_vector(embedding_result):
+    # The embedding API may return [[...]] for a single input
+    if isinstance(embedding_result, list) and len(embedding_result) > 0 and isinstance(embedding_result[0], list):
+        embedding_result = embedding_result[0]
+    return np.asarray(embedding_result, dtype=np.float32)
+
+def cosine_scores(state, rows, query_embedding):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (state.matrix[rows] @ query_embedding) / (state.norms[rows] * np.linalg.norm(query_embedding))
+    return np.nan_to_num(scores)
+
+def dense_search(state, query_embedding, top_k, rows, active_documents):
+    # A source filter goes through the per-source path, which scans those sources in place
+    if active_documents and rows is not None:
+        return backend.search_sources(state, query_embedding, top_k, active_documents)
+    return backend.search(state, query_embedding, top_k, rows)
+
+def hybrid_search(state, query, query_embedding, top_k, rows, active_documents=None):
+    """Dense + BM25 candidates merged by score fusion. Returns (rows, {row: bm25 score})."""
+    sparse_hits, sparse_scores = sparse.search(state, query, max(top_k * 4, HYBRID_PREFILTER_CANDIDATES), rows)
+    if len(sparse_hits):
+        # Lexical matches must clear the dense threshold too, or a question sharing one
+        # word with a chunk would pull in unrelated context
+        relevant = cosine_scores(state, sparse_hits, query_embedding) >= SIMILARITY_THRESHOLD
+        sparse_hits, sparse_scores = sparse_hits[relevant], sparse_scores[relevant]
+
+    candidate_count = len(state.ids) if rows is None else len(rows)
+    if HYBRID_PREFILTER_MIN_ROWS and candidate_count >= HYBRID_PREFILTER_MIN_ROWS and len(sparse_hits) >= top_k:
+        # Large corpus and the query has lexical matches: score only those densely
+        dense_hits, dense_scores = backend.search(state, query_embedding, top_k * 2, np.sort(sparse_hits))
+    else:
+        dense_hits, dense_scores = dense_search(state, query_embedding, top_k * 2, rows, active_documents)
+
+    weights = [HYBRID_DENSE_WEIGHT, 1 - HYBRID_DENSE_WEIGHT] if HYBRID_FUSION == "weighted" else None
+    hits, _ = fuse_rankings([(dense_hits, dense_scores), (sparse_hits[:top_k * 2], sparse_scores[:top_k * 2])],
+                                HYBRID_FUSION, weights, HYBRID_RRF_K)
+    bm25 = dict(zip(sparse_hits.tolist(), sparse_scores.tolist()))
+    return hits[:top_k], bm25
+
+def retrieve_chunks(query, top_k=5, active_documents=[], with_vectors=False):
 
     try:
-        embedding_result = get_embedding(query)
-        
-        if isinstance(embedding_result, list) and len(embedding_result) > 0 and isinstance(embedding_result[0], list):
-            query_embedding = embedding_result[0]
-        else:
-            query_embedding = embedding_result
-            
-        import sys
+        with span("retrieve.embed_query"):
+            query_embedding = to_query_vector(get_embedding(query))
         print(f"[DEBUG] Query Embedding Length: {len(query_embedding)}", file=sys.stderr)
 
     except Exception as e:
-        print(f"[WARN] Atlas Vector Search failed or index missing: {e}. Falling back to in-memory search...", file=sys.stderr)
-        
+        print(f"[ERROR] Query embedding failed: {e}", file=sys.stderr)
+        return []
+
     try:
-        query_filter = {}
-        if active_documents:
-            query_filter = {"source": {"$in": active_documents}}
-            
-        all_docs = list(collection.find(query_filter))
-        if not all_docs:
+        with span("retrieve.refresh_index"):
+            state = index.snapshot()
+        if not state.ids:
             return []
-            
-        query_embedding = get_embedding(query)
-        if isinstance(query_embedding, list) and len(query_embedding) > 0 and isinstance(query_embedding[0], list):
-            query_embedding = query_embedding[0]
-
-        import math
-        def cosine_similarity(v1, v2):
-            dot_product = sum(a*b for a, b in zip(v1, v2))
-            magnitude1 = math.sqrt(sum(a*a for a in v1))
-            magnitude2 = math.sqrt(sum(a*a for a in v2))
-            if magnitude1 == 0 or magnitude2 == 0:
-                return 0
-            return dot_product / (magnitude1 * magnitude2)
-
-        scored_docs = []
-        for doc in all_docs:
-            doc_emb = doc.get('embedding')
-            if doc_emb and isinstance(doc_emb, list):
-                score = cosine_similarity(query_embedding, doc_emb)
-                if score >= 0.45:
-                    doc['score'] = score
-                    scored_docs.append(doc)
-        
-        scored_docs.sort(key=lambda x: x['score'], reverse=True)
-        results = scored_docs[:top_k]
-        print(f"[DEBUG] Fallback Search: Found {len(results)} matches (Threshold 0.45). Scores: {[round(r['score'], 3) for r in results]}", file=sys.stderr)
+
+        rows = state.rows_for(active_documents) if active_documents else None
+        bm25 = {}
+        with span("retrieve.search", backend=backend.name, hybrid=sparse is not None):
+            if sparse is not None:
+                hits, bm25 = hybrid_search(state, query, query_embedding, top_k, rows, active_documents)
+                # Keep `score` the cosine similarity; callers threshold on it
+                scores = cosine_scores(state, hits, query_embedding)
+            else:
+                hits, scores = dense_search(state, query_embedding, top_k, rows, active_documents)
+
+        # Only the winners' text and metadata come over the wire
+        hit_ids = [state.ids[row] for row in hits]
+        with span("retrieve.fetch_chunks", chunks=len(hit_ids)):
+            docs = {doc['_id']: doc for doc in collection.find({"_id": {"$in": hit_ids}}, CHUNK_PROJECTION)}
+
+        results = []
+        for row, doc_id, score in zip(hits, hit_ids, scores):
+            doc = docs.get(doc_id)
+            if doc is None:
+                continue  # deleted since the last refresh
+            doc['score'] = float(score)
+            if with_vectors:
+                doc['vector'] = state.matrix[row]
+            if sparse is not None:
+                doc['bm25'] = round(bm25.get(int(row), 0.0), 3)
+            results.append(doc)
+
+        mode = f"{backend.name}+bm25" if sparse is not None else backend.name
+        print(f"[DEBUG] Vector Search ({mode}): Found {len(results)} matches (Threshold {SIMILARITY_THRESHOLD}). Scores: {[round(r['score'], 3) for r in results]}", file=sys.stderr)
         return results
 
     except Exception as fallback_err:
         print(f"[ERROR] All retrieval methods failed: {fallback_err}", file=sys.stderr)
-        return []
\ No newline at end of file
+        return []
@@ -0,0 +1,350 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from config import (INDEX_DIR, RETRIEVAL_BACKEND, IVF_NLIST, IVF_NPROBE, IVF_MIN_ROWS, IVF_RETRAIN_FACTOR,
+                    SEARCH_WORKERS, SEARCH_SLICE_ROWS, SEARCH_PARALLEL_MIN_ROWS)
+
+SIMILARITY_THRESHOLD = 0.45
+# Runs of a source's rows shorter than this are gathered into one scan instead of sliced
+MIN_SLICE_ROWS = 256
+
+def search_matrix(matrix, norms, query_vector, top_k, threshold=SIMILARITY_THRESHOLD, row_mask=None):
+    """Cosine top-k over a precomputed matrix in one matrix-vector product.
+
+    Returns (row_indices, scores) ordered by descending score.
+    """
+    query_norm = np.linalg.norm(query_vector)
+    if len(matrix) == 0 or query_norm == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = (matrix @ query_vector) / (norms * query_norm)
+
+    keep = np.isfinite(scores) & (scores >= threshold)
+    if row_mask is not None:
+        keep &= row_mask
+    candidates = np.flatnonzero(keep)
+    if len(candidates) == 0:
+        return candidates, np.empty(0, dtype=np.float32)
+
+    if len(candidates) > top_k:
+        part = np.argpartition(-scores[candidates], top_k - 1)[:top_k]
+        candidates = candidates[part]
+    order = np.argsort(-scores[candidates], kind='stable')
+    candidates = candidates[order]
+    return candidates, scores[candidates]
+
+def merge_top_k(results, top_k):
+    """Merge per-slice (rows, scores) results into the overall top_k, best first."""
+    results = [(rows, scores) for rows, scores in results if len(rows)]
+    if not results:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    rows = np.concatenate([rows for rows, _ in results])
+    scores = np.concatenate([scores for _, scores in results])
+    if len(rows) > top_k:
+        part = np.argpartition(-scores, top_k - 1)[:top_k]
+        rows, scores = rows[part], scores[part]
+    order = np.argsort(-scores, kind='stable')
+    return rows[order], scores[order]
+
+def split_ranges(ranges, slice_rows):
+    for start, end in ranges:
+        for piece in range(start, end, slice_rows):
+            yield piece, min(piece + slice_rows, end)
+
+search_pool = ThreadPoolExecutor(max_workers=max(1, SEARCH_WORKERS), thread_name_prefix="search")
+
+def search_ranges(state, query_vector, top_k, ranges, threshold=SIMILARITY_THRESHOLD,
+                  slice_rows=SEARCH_SLICE_ROWS, parallel_min_rows=SEARCH_PARALLEL_MIN_ROWS):
+    """Exact top-k over row ranges of the state, scanned as slices of its matrix (no copies).
+
+    Large selections are cut into slices of at most `slice_rows` rows and
+    scored on the search pool; the per-slice winners are merged. Short runs
+    (rows scattered by re-ingestion) are gathered and scanned together.
+    """
+    def search_slice(bounds):
+        if isinstance(bounds, np.ndarray):
+            hits, scores = search_matrix(state.matrix[bounds], state.norms[bounds], query_vector, top_k, threshold)
+            return bounds[hits], scores
+        start, end = bounds
+        hits, scores = search_matrix(state.matrix[start:end], state.norms[start:end], query_vector, top_k, threshold)
+        return hits + start, scores
+
+    runs = [(start, end) for start, end in ranges if end - start >= MIN_SLICE_ROWS]
+    scattered = [np.arange(start, end) for start, end in ranges if end - start < MIN_SLICE_ROWS]
+    slices = list(split_ranges(runs, slice_rows))
+    if scattered:
+        slices.append(np.concatenate(scattered))
+    total = sum(len(piece) if isinstance(piece, np.ndarray) else piece[1] - piece[0] for piece in slices)
+    if len(slices) > 1 and total >= parallel_min_rows:
+        return merge_top_k(search_pool.map(search_slice, slices), top_k)
+    return merge_top_k(map(search_slice, slices), top_k)
+
+
+class RetrievalBackend:
+    """Searches an IndexState (see vector_index.py) and returns global row numbers."""
+
+    name = "base"
+
+    def search(self, state, query_vector, top_k, rows=None, threshold=SIMILARITY_THRESHOLD):
+        """Return (rows, scores) by descending score. `rows` restricts the search to those rows."""
+        raise NotImplementedError
+
+    def search_sources(self, state, query_vector, top_k, sources, threshold=SIMILARITY_THRESHOLD):
+        """Like search(), restricted to the chunks of `sources`."""
+        return self.search(state, query_vector, top_k, state.rows_for(sources), threshold)
+
+
+class ExactBackend(RetrievalBackend):
+    """Brute-force cosine over every candidate row. Always exact."""
+
+    name = "exact"
+
+    def search(self, state, query_vector, top_k, rows=None, threshold=SIMILARITY_THRESHOLD):
+        if rows is None:
+            return search_matrix(state.matrix, state.norms, query_vector, top_k, threshold)
+        hits, scores = search_matrix(state.matrix[rows], state.norms[rows], query_vector, top_k, threshold)
+        return rows[hits], scores
+
+    def search_sources(self, state, query_vector, top_k, sources, threshold=SIMILARITY_THRESHOLD):
+        # Each source's rows are scanned in place, so cost follows the selection, not the corpus
+        return search_ranges(state, query_vector, top_k, state.ranges_for(sources), threshold)
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+def train_centroids(vectors, nlist, iterations=10, seed=0):
+    """Spherical k-means (cosine) on a sample of the corpus."""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * 64)
+    sample = normalize_rows(vectors[rng.choice(len(vectors), sample_size, replace=False)])
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+            else:
+                centroids[c] = sample[rng.integers(sample_size)]
+        centroids = normalize_rows(centroids)
+    return centroids.astype(np.float32)
+
+
+class Buckets:
+    """IVF lists of one index snapshot. Never modified once built, so searches use them without the lock."""
+
+    def __init__(self, state, centroids, buckets):
+        self.state = state
+        self.centroids = centroids
+        order = np.argsort(buckets, kind='stable')
+        bounds = np.searchsorted(buckets[order], np.arange(len(centroids) + 1))
+        self.rows = [order[bounds[c]:bounds[c + 1]] for c in range(len(centroids))]
+
+
+class IVFBackend(RetrievalBackend):
+    """Inverted-file ANN index: rows are bucketed under their nearest k-means
+    centroid and a query scans only the `nprobe` closest buckets, so scan cost
+    grows with corpus_size * nprobe / nlist instead of corpus_size.
+
+    Knobs: nlist (buckets; 0 = ~4*sqrt(rows) at training time), nprobe
+    (buckets scanned per query; higher = better recall, slower), min_rows
+    (below this, or for small active_documents subsets, exact search is
+    used). Centroids and per-chunk bucket assignments are persisted under
+    INDEX_DIR and extended incrementally as new chunks arrive; the index is
+    retrained once the corpus grows by `retrain_factor` since training.
+    Training and saving run in background threads: queries keep using the
+    previous buckets meanwhile (exact search until the first training ends).
+    Like the BM25 index, it only moves forward: a query still holding an
+    older snapshot is bucketed with the current centroids, leaving the
+    index and its file as they are.
+    """
+
+    name = "ivf"
+
+    def __init__(self, index_dir=INDEX_DIR, nlist=IVF_NLIST, nprobe=IVF_NPROBE,
+                 min_rows=IVF_MIN_ROWS, retrain_factor=IVF_RETRAIN_FACTOR):
+        self.path = os.path.join(index_dir, "ivf.npz")
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_rows = min_rows
+        self.retrain_factor = retrain_factor
+        self.exact = ExactBackend()
+        self.lock = threading.Lock()
+        self.trainer = None    # background training thread, while one runs
+        self.dirty = False     # assignments changed since the last save
+        self.saving = False    # a background save is running
+
+        self.centroids = None
+        self.trained_rows = 0
+        self.assignments = {}  # str(_id) -> bucket
+        self.current = None    # Buckets of the newest snapshot seen
+        self.retired = None    # the ones before, for queries that started before a refresh
+        self.load()
+
+    # --- Persistence ---
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                self.centroids = data["centroids"]
+                self.trained_rows = int(data["trained_rows"])
+                self.assignments = dict(zip(data["ids"].tolist(), data["buckets"].tolist()))
+            print(f"[INFO] Loaded IVF index: {len(self.centroids)} lists, {len(self.assignments)} chunks", file=sys.stderr)
+        except Exception as e:
+            print(f"[WARN] Could not load IVF index from {self.path}: {e}. It will be rebuilt.", file=sys.stderr)
+            self.centroids = None
+            self.assignments = {}
+
+    def save(self, centroids, trained_rows, assignments):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            centroids=centroids,
+            trained_rows=np.int64(trained_rows),
+            ids=np.array(list(assignments.keys()), dtype=str),
+            buckets=np.array(list(assignments.values()), dtype=np.int32)
+        )
+        os.replace(tmp_path, self.path)
+
+    def schedule_save(self):
+        """Persist in a background thread; saves requested while one runs are coalesced into the next. Needs self.lock."""
+        self.dirty = True
+        if not self.saving:
+            self.saving = True
+            threading.Thread(target=self.save_pending, name="ivf-save", daemon=True).start()
+
+    def save_pending(self):
+        while True:
+            with self.lock:
+                if not self.dirty:
+                    self.saving = False
+                    return
+                self.dirty = False
+                centroids, trained_rows, assignments = self.centroids, self.trained_rows, dict(self.assignments)
+            try:
+                self.save(centroids, trained_rows, assignments)
+            except Exception as e:
+                print(f"[WARN] Could not persist IVF index: {e}", file=sys.stderr)
+                with self.lock:
+                    self.saving = False
+                return
+
+    # --- Maintenance ---
+
+    def bucket_rows(self, state, assignments, centroids):
+        """(keys, buckets, new rows) for a snapshot: known rows keep their bucket, the rest are assigned now."""
+        keys = [str(doc_id) for doc_id in state.ids]
+        buckets = np.array([assignments.get(k, -1) for k in keys], dtype=np.int64)
+        new_rows = np.flatnonzero(buckets < 0)
+        if len(new_rows):
+            buckets[new_rows] = self.assign(state.matrix[new_rows], centroids)
+        return keys, buckets, new_rows
+
+    def sync(self, state):
+        """Return the bucket lists for an index snapshot, or None until centroids for it are trained."""
+        for buckets in (self.current, self.retired):
+            if buckets is not None and buckets.state is state:
+                return buckets
+        with self.lock:
+            current = self.current
+            for buckets in (current, self.retired):
+                if buckets is not None and buckets.state is state:
+                    return buckets
+
+            n = len(state.ids)
+            trained = self.centroids is not None and self.centroids.shape[1] == state.matrix.shape[1]
+            if not trained or n > self.trained_rows * self.retrain_factor:
+                self.start_training(state)
+            if not trained:
+                return None
+
+            keys, buckets, new_rows = self.bucket_rows(state, self.assignments, self.centroids)
+            result = Buckets(state, self.centroids, buckets)
+            if current is not None and state.version < current.state.version:
+                return result
+
+            changed = len(new_rows) > 0 or len(self.assignments) != n
+            self.assignments = dict(zip(keys, buckets.tolist()))
+            self.current, self.retired = result, current
+            if changed:
+                self.schedule_save()
+            return result
+
+    def start_training(self, state):
+        # k-means is a Python loop over up to ~4*sqrt(n) lists, far too slow for a query to wait on. Needs self.lock.
+        if self.trainer is None:
+            self.trainer = threading.Thread(target=self.train, args=(state,), name="ivf-train", daemon=True)
+            self.trainer.start()
+
+    def train(self, state):
+        """Train centroids on a snapshot and bucket its rows, then swap them in for the newest snapshot."""
+        try:
+            n = len(state.ids)
+            nlist = min(self.nlist or max(1, int(4 * np.sqrt(n))), n)
+            centroids = train_centroids(state.matrix, nlist)
+            assignments = dict(zip((str(doc_id) for doc_id in state.ids), self.assign(state.matrix, centroids).tolist()))
+            with self.lock:
+                # Ingestion may have moved the index on meanwhile; only those rows are assigned here
+                current = self.current
+                latest = current.state if current is not None and current.state.version > state.version else state
+                keys, buckets, _ = self.bucket_rows(latest, assignments, centroids)
+                self.centroids, self.trained_rows = centroids, n
+                self.assignments = dict(zip(keys, buckets.tolist()))
+                self.current, self.retired = Buckets(latest, centroids, buckets), current
+                self.schedule_save()
+            print(f"[INFO] Trained IVF index: {nlist} lists over {n} chunks", file=sys.stderr)
+        except Exception as e:
+            print(f"[WARN] IVF training failed: {e}", file=sys.stderr)
+        finally:
+            with self.lock:
+                self.trainer = None
+
+    @staticmethod
+    def assign(vectors, centroids):
+        return np.argmax(normalize_rows(vectors) @ centroids.T, axis=1).astype(np.int64)
+
+    # --- Search ---
+
+    def search(self, state, query_vector, top_k, rows=None, threshold=SIMILARITY_THRESHOLD):
+        candidate_count = len(state.ids) if rows is None else len(rows)
+        if candidate_count < self.min_rows:
+            return self.exact.search(state, query_vector, top_k, rows, threshold)
+
+        buckets = self.sync(state)
+        if buckets is None:
+            return self.exact.search(state, query_vector, top_k, rows, threshold)
+        nprobe = min(self.nprobe, len(buckets.centroids))
+        closest = np.argpartition(-(buckets.centroids @ query_vector), nprobe - 1)[:nprobe]
+        probe_rows = np.concatenate([buckets.rows[c] for c in closest])
+        if rows is not None:
+            probe_rows = np.intersect1d(probe_rows, rows, assume_unique=True)
+        else:
+            probe_rows = np.sort(probe_rows)
+        return self.exact.search(state, query_vector, top_k, probe_rows, threshold)
+
+    def search_sources(self, state, query_vector, top_k, sources, threshold=SIMILARITY_THRESHOLD):
+        rows = state.rows_for(sources)
+        if len(rows) < self.min_rows:
+            return self.exact.search_sources(state, query_vector, top_k, sources, threshold)
+        return self.search(state, query_vector, top_k, rows, threshold)
+
+
+BACKENDS = {
+    "exact": ExactBackend,
+    "ivf": IVFBackend,
+}
+
+def create_backend(name=RETRIEVAL_BACKEND):
+    if name not in BACKENDS:
+        print(f"[WARN] Unknown RETRIEVAL_BACKEND '{name}', using exact search.", file=sys.stderr)
+        name = "exact"
+    return BACKENDS[name]()
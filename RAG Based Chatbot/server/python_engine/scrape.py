@@ -1,181 +1,116 @@
 import os
 import sys
 import json
-import requests
-from bs4 import BeautifulSoup
+import time
 from urllib.parse import urlparse
 
 # Set a default USER_AGENT to prevent Langchain warnings down the pipeline
 os.environ["USER_AGENT"] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 
 # Re-use the ingestion pipeline
-from config import MONGODB_URI
-from embeddings import get_embeddings
-from pymongo import MongoClient
-import uuid
+from config import INGEST_BATCH_SIZE, INGEST_QUEUE_DEPTH
+from crawler import iter_crawl
+from ingest import embed_batches, throughput
+from embeddings import new_embedding_stats
+from pipeline import batched, prefetch
+from chunk_store import SourceWriter
+from chunker import iter_chunks
+from db import collection, ensure_indexes
+from tracing import span
 
-def get_domain(url):
-    return urlparse(url).netloc
+def page_chunks(page):
+    # Offsets are within the page; its url replaces page numbers
+    for chunk in iter_chunks([(None, page["text"])]):
+        del chunk["page"], chunk["page_end"]
+        chunk["url"] = page["url"]
+        yield chunk
 
-def extract_links(soup, base_url):
-    links = set()
-    domain = get_domain(base_url)
-    for a in soup.find_all('a', href=True):
-        href = a['href']
-        # Handle relative links
-        if href.startswith('/'):
-            href = f"https://{domain}{href}"
-        # Only keep links from same domain and avoid anchors/files
-        if get_domain(href) == domain and not href.endswith(('.pdf', '.png', '.jpg', '.jpeg', '.gif', '.zip', '.tar', '.gz')):
-            links.add(href.split('#')[0]) # Strip anchors
-    return list(links)
+def ingest_url(url, deep_crawl=False, max_depth=None, max_pages=None, on_progress=None):
+    """Crawl `url` (and, for deep crawls, same-domain sublinks) and index pages as they arrive.
 
-def scrape_single_url(url, headers):
-    print(f"Fetching content from: {url}", file=sys.stderr)
-    try:
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # Remove noisy elements
-        for element in soup(["script", "style", "nav", "footer", "header", "aside"]):
-            element.decompose()
+    Pages stream from the crawler into chunking, batched embedding and batched
+    inserts, so the first pages are stored while later ones are still being fetched.
+    """
+    # Validate URL loosely
+    parsed = urlparse(url)
+    if not parsed.scheme or not parsed.netloc:
+        raise ValueError("Invalid URL format. Please provide a full URL including http:// or https://")
 
-        # Extract text
-        text = soup.get_text(separator='\n\n', strip=True)
-        title = soup.title.string if soup.title else url
-        
-        return text, title, soup
-    except Exception as e:
-        print(f"Warning: Failed to fetch {url}: {e}", file=sys.stderr)
-        return None, None, None
+    crawl_options = {"max_depth": 0, "max_pages": 1}
+    if deep_crawl:
+        print(f"Deep crawl enabled for {url}", file=sys.stderr)
+        crawl_options = {}
+        if max_depth is not None:
+            crawl_options["max_depth"] = max_depth
+        if max_pages is not None:
+            crawl_options["max_pages"] = max_pages
+
+    progress = {"pages": 0, "chunks": 0, "embedded": 0, "stored": 0}
+    page_info = {"main_title": None}
+    # Source is named after the start page, so it's set once that page arrives
+    ensure_indexes()
+    writer = SourceWriter(collection, None, {"type": "web"})
+    started, embedding_stats = time.time(), new_embedding_stats()
+
+    def crawled_chunks():
+        for page in iter_crawl(url, **crawl_options):
+            if page_info["main_title"] is None:
+                # The start page always finishes first: it is the only one queued until it has been parsed
+                page_info["main_title"] = page["title"]
+                prefix = "Web (Deep)" if deep_crawl else "Web"
+                writer.source = f"{prefix}: {page['title']}"
+                if deep_crawl:
+                    print(f"Found {len(page['links'])} sublinks on the same domain.", file=sys.stderr)
+            progress["pages"] += 1
+            if len(page["text"].strip()) < 50:
+                print(f"Warning: Extracted text from {page['url']} is too short or empty. It might be a dynamic JS site.", file=sys.stderr)
+            yield from page_chunks(page)
 
-def ingest_url(url, deep_crawl=False):
     try:
-        # Validate URL loosely
-        parsed = urlparse(url)
-        if not parsed.scheme or not parsed.netloc:
-            raise ValueError("Invalid URL format. Please provide a full URL including http:// or https://")
+        chunk_batches = prefetch(batched(crawled_chunks(), INGEST_BATCH_SIZE), INGEST_QUEUE_DEPTH, "scrape-chunk")
+        embedded = prefetch(embed_batches(chunk_batches, writer, embedding_stats), INGEST_QUEUE_DEPTH, "scrape-embed")
+
+        for batch, new_chunks, embeddings in embedded:
+            progress["chunks"] += len(batch)
+            progress["embedded"] += len(new_chunks)
+            with span("ingest.store"):
+                progress["stored"] += writer.write(new_chunks, embeddings)
+            print(f"[INFO] {writer.source}: {progress['pages']} pages fetched, {progress['stored']} new chunks stored", file=sys.stderr)
+            if on_progress:
+                on_progress(dict(progress))
+
+        if page_info["main_title"] is None:
+            raise ValueError(f"Failed to fetch {'base ' if deep_crawl else ''}URL {url}")
+        if not writer.seen:
+            raise ValueError("No chunks generated from extracted text.")
+        with span("ingest.finish"):
+            stats = writer.finish()
+        source_name = writer.source
+
+        rates = throughput(progress, started, embedding_stats)
+        print(f"Successfully stored {url}: {stats['added']} added, {stats['unchanged']} unchanged, {stats['removed']} removed "
+              f"({rates['chunks_per_sec']} chunks/sec)", file=sys.stderr)
 
-        print(f"Fetching content from: {url}", file=sys.stderr)
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        urls_to_scrape = [url]
-        scraped_urls = set()
-        all_text = ""
-        main_title = "Web: " + url
-        source_name = main_title
-        
-        if deep_crawl:
-            print(f"Deep crawl enabled for {url}", file=sys.stderr)
-            main_text, base_title, soup = scrape_single_url(url, headers)
-            if main_text:
-                all_text += main_text + "\n\n"
-                main_title = f"Web (Deep): {base_title}"
-                source_name = main_title
-                scraped_urls.add(url)
-                
-                # Extract sublinks
-                sublinks = extract_links(soup, url)
-                print(f"Found {len(sublinks)} sublinks on the same domain.", file=sys.stderr)
-                
-                # Crawl up to 5 sublinks for speed
-                count = 0
-                for link in sublinks:
-                    if count >= 5: break
-                    if link not in scraped_urls:
-                        sub_text, _, _ = scrape_single_url(link, headers)
-                        if sub_text:
-                            all_text += sub_text + "\n\n"
-                            scraped_urls.add(link)
-                            count += 1
-            else:
-                 raise ValueError(f"Failed to fetch base URL {url}")
-        else:
-            # Single page scrape
-            main_text, base_title, _ = scrape_single_url(url, headers)
-            if main_text:
-                all_text = main_text
-                main_title = f"Web: {base_title}"
-                source_name = main_title
-                scraped_urls.add(url)
-            else:
-                 raise ValueError(f"Failed to fetch URL {url}")
-        
-        text = all_text
-        
-        if not text or len(text.strip()) < 50:
-             print(f"Warning: Extracted text is too short or empty. It might be a dynamic JS site.", file=sys.stderr)
-        
-        # Manually chunk the text (simple word-based chunking similar to ingest.py)
-        # Using langchain's RecursiveCharacterTextSplitter if available, or fallback
-        try:
-             from langchain.text_splitter import RecursiveCharacterTextSplitter
-             text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-             chunks = text_splitter.split_text(text)
-        except ImportError:
-             # Basic fallback chunking (paragraph-aware)
-             paragraphs = text.split('\n\n')
-             chunks = []
-             current_chunk = ""
-             for p in paragraphs:
-                 if len(current_chunk) + len(p) < 1000:
-                     current_chunk += p + "\n\n"
-                 else:
-                     if current_chunk: chunks.append(current_chunk.strip())
-                     current_chunk = p + "\n\n"
-             if current_chunk: chunks.append(current_chunk.strip())
-             
-        if not chunks:
-             print("No chunks generated from extracted text.", file=sys.stderr)
-             sys.exit(1)
-             
-        print(f"Generated {len(chunks)} chunks. Creating embeddings...", file=sys.stderr)
-        
-        # Vectorize
-        embeddings = get_embeddings(chunks)
-        
-        documents = []
-        for i, (chunk, emb) in enumerate(zip(chunks, embeddings)):
-            documents.append({
-                "text": chunk,
-                "embedding": emb,
-                "source": source_name,
-                "chunk_index": i,
-                "type": "web"
-            })
-            
-        print("Connecting to MongoDB Atlas...", file=sys.stderr)
-        client = MongoClient(MONGODB_URI)
-        db = client['rag_chatbot']
-        collection = db['vectorStore']
-        
-        if documents:
-            collection.insert_many(documents)
-            print(f"Successfully stored {len(documents)} chunks from {url}", file=sys.stderr)
-        else:
-             print("No documents generated to store.", file=sys.stderr)
-             
-        client.close()
-        
         # Return success exactly in the format Node.js expects
-        pages_scraped = len(scraped_urls)
-        print(json.dumps({
+        main_title = source_name
+        pages_scraped = progress["pages"]
+        return {
             "success": True, 
             "message": f"Successfully ingested {pages_scraped} pages from {main_title}", 
-            "chunks": len(documents),
+            "chunks": stats["chunks"],
+            "added": stats["added"],
+            "unchanged": stats["unchanged"],
+            "removed": stats["removed"],
             "source": source_name,
-            "pages": pages_scraped
-        }))
+            "pages": pages_scraped,
+            "throughput": rates
+        }
 
     except Exception as e:
+        # All-or-nothing: don't leave a half-crawled site searchable
+        writer.rollback()
         print(f"Error ingesting URL: {e}", file=sys.stderr)
-        print(json.dumps({"success": False, "error": str(e)}))
-        sys.exit(1)
+        raise
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -186,4 +121,8 @@ if __name__ == "__main__":
     target_url = sys.argv[1]
     is_deep = len(sys.argv) > 2 and sys.argv[2] == '--deep'
     
-    ingest_url(target_url, is_deep)
+    try:
+        print(json.dumps(ingest_url(target_url, is_deep)))
+    except Exception as e:
+        print(json.dumps({"success": False, "error": str(e)}))
+        sys.exit(1)
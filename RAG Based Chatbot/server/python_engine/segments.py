@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import uuid
+import numpy as np
+from bson import ObjectId
+from config import SEGMENT_DIR, SEGMENT_MAX_FILES, SEGMENT_COMPACT_DEAD_RATIO
+
+# A segment is two files in SEGMENT_DIR:
+#   <name>.f32   raw little-endian float32 matrix, rows x dim, memory-mapped on load
+#   <name>.json  sidecar: dim, rows, chunk _ids and seqs by row, and [source, start, end] ranges
+# The sidecar is written last (atomically), so a segment without one is an
+# unfinished write and is ignored. MongoDB stays the source of truth: segments
+# only let a fresh process skip downloading embeddings it can rebuild from disk.
+
+def new_segment_name():
+    return f"{time.time_ns()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class SegmentWriter:
+    """Appends one source's vectors to a new segment, batch by batch."""
+
+    def __init__(self, source, directory=SEGMENT_DIR):
+        self.source = source
+        self.directory = directory
+        self.name = new_segment_name()
+        self.file = None
+        self.dim = None
+        self.ids = []
+        self.seqs = []
+
+    def append(self, ids, seqs, vectors):
+        if not ids:
+            return
+        matrix = np.asarray(vectors, dtype="<f4")
+        if self.file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.dim = matrix.shape[1]
+            self.file = open(os.path.join(self.directory, self.name + ".f32"), "wb")
+        self.file.write(matrix.tobytes())
+        self.ids.extend(str(doc_id) for doc_id in ids)
+        self.seqs.extend(int(seq) for seq in seqs)
+
+    def commit(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        write_sidecar(self.directory, self.name, self.dim, self.ids, self.seqs, [[self.source, 0, len(self.ids)]])
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        remove_segment(self.directory, self.name)
+
+
+def write_sidecar(directory, name, dim, ids, seqs, sources):
+    meta = {"dim": int(dim), "rows": len(ids), "ids": ids, "seqs": seqs, "sources": sources}
+    tmp = os.path.join(directory, name + ".json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(directory, name + ".json"))
+
+def remove_segment(directory, name):
+    for suffix in (".json", ".f32"):
+        try:
+            os.remove(os.path.join(directory, name + suffix))
+        except OSError:
+            pass  # already gone, or still mapped on Windows; a later compaction retries
+
+
+class SegmentStore:
+    """Reads and compacts the segment files of one index directory."""
+
+    def __init__(self, directory=SEGMENT_DIR, max_files=SEGMENT_MAX_FILES, dead_ratio=SEGMENT_COMPACT_DEAD_RATIO):
+        self.directory = directory
+        self.max_files = max_files
+        self.dead_ratio = dead_ratio
+        self.loaded = []      # segment names the current index was built from
+        self.loaded_rows = 0  # rows those segments hold, duplicates and deleted chunks included
+
+    def list_segments(self):
+        try:
+            names = [f[:-5] for f in os.listdir(self.directory) if f.endswith(".json")]
+        except FileNotFoundError:
+            return []
+        return sorted(names)  # names start with a timestamp, so this is write order
+
+    def load(self):
+        """Return (ids, sources, seqs, matrix) for all segments; a single segment stays memory-mapped."""
+        ids, sources, seqs, blocks = [], [], [], []
+        seen = set()
+        dim = None
+        self.loaded, self.loaded_rows = [], 0
+        for name in self.list_segments():
+            try:
+                with open(os.path.join(self.directory, name + ".json")) as f:
+                    meta = json.load(f)
+                if dim is not None and meta["dim"] != dim:
+                    print(f"[WARN] Skipping segment {name}: dimension {meta['dim']} != {dim}", file=sys.stderr)
+                    continue
+                matrix = np.memmap(os.path.join(self.directory, name + ".f32"), dtype="<f4", mode="r",
+                                   shape=(meta["rows"], meta["dim"]))
+            except Exception as e:
+                print(f"[WARN] Skipping unreadable segment {name}: {e}", file=sys.stderr)
+                continue
+            dim = meta["dim"]
+            self.loaded.append(name)
+            self.loaded_rows += meta["rows"]
+
+            row_sources = np.empty(meta["rows"], dtype=object)
+            for source, start, end in meta["sources"]:
+                row_sources[start:end] = source
+            # A chunk can appear twice if a compaction raced with a writer; the first copy wins
+            keep = []
+            for row, doc_id in enumerate(meta["ids"]):
+                if doc_id not in seen:
+                    seen.add(doc_id)
+                    keep.append(row)
+            if len(keep) < meta["rows"]:
+                matrix = matrix[keep]
+                row_sources = row_sources[keep]
+            ids.extend(ObjectId(meta["ids"][row]) for row in keep)
+            seqs.extend(meta["seqs"][row] for row in keep)
+            sources.append(row_sources)
+            blocks.append(matrix)
+
+        if not blocks:
+            return [], np.empty(0, dtype=object), np.empty(0, dtype=np.int64), None
+        matrix = blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+        return ids, np.concatenate(sources), np.asarray(seqs, dtype=np.int64), matrix
+
+    def read_ids(self, name):
+        try:
+            with open(os.path.join(self.directory, name + ".json")) as f:
+                return [ObjectId(doc_id) for doc_id in json.load(f)["ids"]]
+        except Exception:
+            return None
+
+    def needs_compaction(self, live_rows):
+        files = len(self.list_segments())
+        if not files and live_rows:
+            return True  # nothing on disk yet: write the first snapshot
+        if files > self.max_files:
+            return True
+        return self.loaded_rows > 0 and (self.loaded_rows - live_rows) / self.loaded_rows > self.dead_ratio
+
+    def compact(self, state):
+        """Replace the loaded segments with one segment holding exactly `state`.
+
+        Newer segments are removed too when every row in them is already part
+        of `state`. Any others were written after the state was refreshed and
+        are merged by a later compaction.
+        """
+        if not len(state.ids):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        order = np.argsort(state.sources, kind="stable")  # contiguous per-source ranges
+        name = new_segment_name()
+        matrix = np.ascontiguousarray(state.matrix[order], dtype="<f4")
+        with open(os.path.join(self.directory, name + ".f32"), "wb") as f:
+            f.write(matrix.tobytes())
+
+        sources = state.sources[order]
+        names, starts = np.unique(sources, return_index=True)
+        ends = list(starts[1:]) + [len(order)]
+        ranges = sorted([str(n), int(s), int(e)] for n, s, e in zip(names, starts, ends))
+        write_sidecar(self.directory, name, matrix.shape[1],
+                      [str(state.ids[row]) for row in order], [int(seq) for seq in state.seqs[order]], ranges)
+
+        for old in self.list_segments():
+            if old == name:
+                continue
+            if old not in self.loaded:
+                ids = self.read_ids(old)
+                if ids is None or any(doc_id not in state.row_of for doc_id in ids):
+                    continue
+            remove_segment(self.directory, old)
+        self.loaded, self.loaded_rows = [name], len(order)
+        print(f"[INFO] Compacted vector segments into {name} ({len(order)} rows)", file=sys.stderr)
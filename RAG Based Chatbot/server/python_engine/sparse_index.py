@@ -0,0 +1,249 @@
+import os
+import re
+import sys
+import threading
+from collections import Counter
+import numpy as np
+from config import INDEX_DIR, BM25_K1, BM25_B
+from db import find_in_batches
+
+# Identifiers such as "us-east-1", "ERR_CONN_RESET" or "SKU-4411" are kept whole
+# and also indexed by their parts, so either spelling in a query matches.
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[_\-/][a-z0-9]+)*")
+PART_SPLIT = re.compile(r"[_\-/]")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how i in is it its of on or that the this to was what "
+    "when where which who why will with you your".split()
+)
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        if len(token) > 2 and PART_SPLIT.search(token):
+            tokens.extend(part for part in PART_SPLIT.split(token) if part and part not in STOPWORDS)
+    return tokens
+
+def term_counts(text):
+    """Sparse term frequencies stored on each chunk at ingest time (`terms` field)."""
+    return dict(Counter(tokenize(text)))
+
+
+class Postings:
+    """BM25 postings of one index snapshot. Never modified once built, so searches use them without the lock."""
+
+    def __init__(self, state, terms, doc_len):
+        self.state = state
+        self.terms = terms      # term id -> (rows, tfs)
+        self.doc_len = doc_len
+        self.avgdl = float(doc_len.mean()) if len(doc_len) else 1.0
+
+
+class BM25Index:
+    """Inverted index over chunk text, kept in step with VectorIndex snapshots.
+
+    Term counts come from each chunk's `terms` field (written at ingest time;
+    older chunks are tokenized from their text once). Like the IVF backend,
+    per-chunk data is keyed by _id and persisted under INDEX_DIR (by a
+    background thread, off the query path), and the postings are extended
+    when a refresh only appended rows. The index only moves forward: a query
+    still holding an older snapshot gets postings built for it without
+    replacing the current ones.
+    """
+
+    def __init__(self, collection, index_dir=INDEX_DIR, k1=BM25_K1, b=BM25_B):
+        self.collection = collection
+        self.path = os.path.join(index_dir, "bm25.npz")
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        self.dirty = False     # doc_terms changed since the last save
+        self.saving = False    # a background save is running
+
+        self.vocab = {}        # token -> term id
+        self.doc_terms = {}    # str(_id) -> (term ids, term frequencies)
+        self.current = None    # Postings of the newest snapshot seen
+        self.retired = None    # the ones before, for queries that started before a refresh
+        self.load()
+
+    # --- Persistence ---
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                self.vocab = {token: i for i, token in enumerate(data["vocab"].tolist())}
+                indptr, term_ids, tfs = data["indptr"], data["term_ids"], data["tfs"]
+                for i, key in enumerate(data["ids"].tolist()):
+                    self.doc_terms[key] = (term_ids[indptr[i]:indptr[i + 1]], tfs[indptr[i]:indptr[i + 1]])
+            print(f"[INFO] Loaded BM25 index: {len(self.vocab)} terms, {len(self.doc_terms)} chunks", file=sys.stderr)
+        except Exception as e:
+            print(f"[WARN] Could not load BM25 index from {self.path}: {e}. It will be rebuilt.", file=sys.stderr)
+            self.vocab, self.doc_terms = {}, {}
+
+    def save(self, vocab, doc_terms):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        keys = list(doc_terms.keys())
+        lengths = [len(doc_terms[k][0]) for k in keys]
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            vocab=np.array(sorted(vocab, key=vocab.get), dtype=str),
+            ids=np.array(keys, dtype=str),
+            indptr=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+            term_ids=np.concatenate([doc_terms[k][0] for k in keys] or [np.empty(0, dtype=np.int32)]),
+            tfs=np.concatenate([doc_terms[k][1] for k in keys] or [np.empty(0, dtype=np.float32)])
+        )
+        os.replace(tmp_path, self.path)
+
+    def schedule_save(self):
+        """Persist in a background thread; saves requested while one runs are coalesced into the next. Needs self.lock."""
+        self.dirty = True
+        if not self.saving:
+            self.saving = True
+            threading.Thread(target=self.save_pending, name="bm25-save", daemon=True).start()
+
+    def save_pending(self):
+        # Rewriting bm25.npz is O(corpus), so it runs here rather than in sync() on the query path.
+        # Only copying the dicts holds the lock; the term arrays themselves are never modified.
+        while True:
+            with self.lock:
+                if not self.dirty:
+                    self.saving = False
+                    return
+                self.dirty = False
+                vocab, doc_terms = dict(self.vocab), dict(self.doc_terms)
+            try:
+                self.save(vocab, doc_terms)
+            except Exception as e:
+                print(f"[WARN] Could not persist BM25 index: {e}", file=sys.stderr)
+                with self.lock:
+                    self.saving = False
+                return
+
+    # --- Maintenance ---
+
+    def encode(self, counts):
+        ids = np.fromiter((self.vocab.setdefault(t, len(self.vocab)) for t in counts), dtype=np.int32, count=len(counts))
+        return ids, np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+
+    def fetch_terms(self, doc_ids):
+        legacy = []
+        for doc in find_in_batches(self.collection, doc_ids, {"terms": 1}):
+            if isinstance(doc.get("terms"), dict):
+                self.doc_terms[str(doc["_id"])] = self.encode(doc["terms"])
+            else:
+                legacy.append(doc["_id"])
+        for doc in find_in_batches(self.collection, legacy, {"text": 1}):
+            self.doc_terms[str(doc["_id"])] = self.encode(term_counts(doc.get("text", "")))
+
+    def build_postings(self, keys, first_row):
+        empty = (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32))
+        per_row = [self.doc_terms.get(k, empty) for k in keys]
+        lengths = np.array([len(t) for t, _ in per_row], dtype=np.int64)
+        doc_len = np.array([tfs.sum() for _, tfs in per_row], dtype=np.float32)
+        if not lengths.sum():
+            return {}, doc_len
+        term_ids = np.concatenate([t for t, _ in per_row])
+        tfs = np.concatenate([f for _, f in per_row])
+        rows = np.repeat(np.arange(first_row, first_row + len(keys)), lengths)
+        order = np.argsort(term_ids, kind='stable')
+        terms, starts = np.unique(term_ids[order], return_index=True)
+        bounds = list(starts[1:]) + [len(order)]
+        return {int(t): (rows[order[s:e]], tfs[order[s:e]]) for t, s, e in zip(terms, starts, bounds)}, doc_len
+
+    def sync(self, state):
+        """Return the postings for an index snapshot, building them if needed."""
+        for postings in (self.current, self.retired):
+            if postings is not None and postings.state is state:
+                return postings
+        with self.lock:
+            current = self.current
+            for postings in (current, self.retired):
+                if postings is not None and postings.state is state:
+                    return postings
+            keys = [str(doc_id) for doc_id in state.ids]
+            missing = [doc_id for doc_id, key in zip(state.ids, keys) if key not in self.doc_terms]
+            if missing:
+                self.fetch_terms(missing)
+
+            previous = current.state if current is not None else None
+            appended = (previous is not None and 0 < len(previous.ids) <= len(state.ids)
+                        and state.ids[len(previous.ids) - 1] == previous.ids[-1])
+            if appended:
+                # Rows were only added: extend the affected postings lists
+                start = len(previous.ids)
+                new_terms, new_len = self.build_postings(keys[start:], start)
+                terms = dict(current.terms)
+                for term, (rows, tfs) in new_terms.items():
+                    if term in terms:
+                        rows = np.concatenate([terms[term][0], rows])
+                        tfs = np.concatenate([terms[term][1], tfs])
+                    terms[term] = (rows, tfs)
+                postings = Postings(state, terms, np.concatenate([current.doc_len, new_len]))
+            else:
+                postings = Postings(state, *self.build_postings(keys, 0))
+
+            if current is not None and state.version < current.state.version:
+                return postings
+
+            changed = bool(missing)
+            if len(self.doc_terms) > len(keys):
+                live = set(keys)
+                self.doc_terms = {k: v for k, v in self.doc_terms.items() if k in live}
+                changed = True
+
+            self.current, self.retired = postings, current
+            if changed:
+                self.schedule_save()
+            return postings
+
+    # --- Search ---
+
+    def search(self, state, query, top_k, rows=None):
+        """Return (rows, scores) of the top_k BM25 matches, best first. `rows` restricts the candidates."""
+        postings = self.sync(state)
+        n = len(state.ids)
+        query_terms = [self.vocab[t] for t in set(tokenize(query)) if t in self.vocab]
+        hit_rows, contributions = [], []
+        for term in query_terms:
+            if term not in postings.terms:
+                continue
+            term_rows, tfs = postings.terms[term]
+            idf = np.log(1 + (n - len(term_rows) + 0.5) / (len(term_rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * postings.doc_len[term_rows] / postings.avgdl)
+            hit_rows.append(term_rows)
+            contributions.append(idf * tfs * (self.k1 + 1) / (tfs + norm))
+        if not hit_rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        scores = np.bincount(np.concatenate(hit_rows), np.concatenate(contributions), minlength=n)
+        candidates = np.flatnonzero(scores > 0)
+        if rows is not None:
+            candidates = np.intersect1d(candidates, rows, assume_unique=True)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return candidates, scores[candidates].astype(np.float32)
+
+
+def fuse_rankings(rankings, method="rrf", weights=None, rrf_k=60):
+    """Merge ranked (rows, scores) lists into one (rows, fused scores), best first.
+
+    "rrf" sums 1 / (rrf_k + rank) over the lists; "weighted" sums each list's
+    scores scaled to [0, 1] by its best score, times that list's weight.
+    """
+    weights = weights or [1.0] * len(rankings)
+    fused = {}
+    for (rows, scores), weight in zip(rankings, weights):
+        if not len(rows):
+            continue
+        top = float(scores[0]) or 1.0
+        for rank, (row, score) in enumerate(zip(rows.tolist(), scores.tolist())):
+            value = 1.0 / (rrf_k + rank + 1) if method == "rrf" else float(score) / top
+            fused[row] = fused.get(row, 0.0) + weight * value
+    ordered = sorted(fused, key=fused.get, reverse=True)
+    return np.array(ordered, dtype=np.int64), np.array([fused[r] for r in ordered], dtype=np.float32)
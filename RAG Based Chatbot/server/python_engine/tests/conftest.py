@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+# Run offline like benchmark.py: mongomock, hash embeddings, a scratch index directory.
+# Configuration is read at import, so the environment is set before any test loads an engine module.
+ENGINE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ENGINE_DIR)
+os.environ.update({
+    "EMBEDDING_PROVIDER": "hash",
+    "EMBEDDING_CACHE_PATH": "",
+    "GROQ_API_KEY": os.environ.get("GROQ_API_KEY") or "test",
+    "INDEX_DIR": os.path.join(tempfile.mkdtemp(prefix="rag-test-"), "index_data"),
+    "MONGO_DB_NAME": "rag_test",
+    "MONGODB_URI": "mongodb://mongomock",
+})
@@ -0,0 +1,111 @@
+import time
+import asyncio
+import threading
+from collections import Counter
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web  # noqa: E402
+
+import crawler  # noqa: E402
+from crawler import iter_crawl  # noqa: E402
+
+# Page -> the links it carries. Spellings differ (fragments, tracking parameters,
+# absolute URLs) but normalize to the same few pages, which must be fetched once each.
+SITE = {
+    "/": ["/a", "/b#intro", "/private/secret"],
+    "/a": ["/b?utm_source=feed", "/", "/c"],
+    "/b": ["/a", "{base}/c"],
+    "/c": ["/a#top", "/b"],
+}
+WIDE = [f"/wide/{i}" for i in range(10)]
+ROBOTS = "User-agent: *\nDisallow: /private\n"
+
+
+class Site:
+    """Linked fixture pages on a background loop, counting requests and concurrent fetches."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.requests = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.base = None
+
+    async def robots(self, request):
+        return web.Response(text=ROBOTS, content_type="text/plain")
+
+    async def page(self, request):
+        path = request.path
+        self.requests[path] += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        if path == "/wide":
+            links = WIDE
+        elif path in SITE:
+            links = [link.format(base=self.base) for link in SITE[path]]
+        elif path in WIDE or path.startswith("/private"):
+            links = []
+        else:
+            raise web.HTTPNotFound()
+        anchors = "".join(f'<a href="{link}">{link}</a>' for link in links)
+        html = f"<html><head><title>{path}</title></head><body><p>Page {path}</p>{anchors}</body></html>"
+        return web.Response(text=html, content_type="text/html")
+
+    def start(self):
+        app = web.Application()
+        app.router.add_get("/robots.txt", self.robots)
+        app.router.add_get("/{tail:.*}", self.page)
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        loop.run_until_complete(site.start())
+        threading.Thread(target=loop.run_forever, name="test-site", daemon=True).start()
+        self.base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self.base
+
+
+def crawl(start_url, **options):
+    return {page["url"].split("/", 3)[3]: page for page in iter_crawl(start_url, **options)}
+
+
+def test_each_page_fetched_once():
+    site = Site()
+    base = site.start()
+    pages = crawl(base + "/", max_depth=5, max_pages=20, respect_robots=False)
+    assert sorted(pages) == ["", "a", "b", "c", "private/secret"]
+    assert all(count == 1 for count in site.requests.values())
+
+
+def test_robots_disallowed_pages_are_skipped():
+    site = Site()
+    base = site.start()
+    pages = crawl(base + "/", max_depth=5, max_pages=20)
+    assert sorted(pages) == ["", "a", "b", "c"]
+    assert "/private/secret" not in site.requests
+
+
+def test_requests_per_host_are_capped():
+    site = Site(delay=0.2)
+    base = site.start()
+    pages = crawl(base + "/wide", max_depth=1, max_pages=20, concurrency=8, host_concurrency=3)
+    assert len(pages) == 11
+    assert site.max_in_flight == 3
+
+
+def test_slow_consumer_does_not_time_out_fetches(monkeypatch):
+    # Fetches must keep running while the caller is busy with a page, or they
+    # would run out their timeout without ever being read
+    monkeypatch.setattr(crawler, "CRAWL_QUEUE_DEPTH", 1)
+    site = Site(delay=0.3)
+    base = site.start()
+    pages = []
+    for page in iter_crawl(base + "/wide", max_depth=1, max_pages=6, concurrency=4, host_concurrency=4, timeout=1.0):
+        pages.append(page)
+        time.sleep(1.2)
+    assert len(pages) == 6
@@ -0,0 +1,86 @@
+import time
+import random
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from benchmark import MockServer, make_vocabulary  # noqa: E402
+from llm_client import LLMClient, LLMError  # noqa: E402
+
+TOKENS = 20
+
+
+@pytest.fixture
+def server():
+    rng = random.Random(0)
+    mock = MockServer(TOKENS, first_token_ms=0, token_ms=1, site_pages=0, page_paragraphs=0, rng=rng,
+                      vocabulary=make_vocabulary(rng, topics=1))
+    mock.base_url = mock.start() + "/v1"
+    return mock
+
+
+@pytest.fixture
+def make_client(server):
+    clients = []
+
+    def make(**options):
+        options = {"max_retries": 2, "backoff_base": 0.01, "backoff_max": 5, **options}
+        client = LLMClient(base_url=server.base_url, api_key="test", **options)
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        client.close()
+
+
+def complete(client, model="primary"):
+    deltas = []
+    started = time.perf_counter()
+    result = client.stream([{"role": "user", "content": "hello"}], model, deltas.append)
+    return result, deltas, time.perf_counter() - started
+
+
+def test_retry_after_is_honoured(server, make_client):
+    expected, _, _ = complete(make_client())
+    server.faults = [{"status": 429, "headers": {"Retry-After": "0.5"}}]
+    result, deltas, seconds = complete(make_client())
+    assert result["attempts"] == 2
+    assert seconds >= 0.5
+    assert "".join(deltas) == result["text"] == expected["text"]
+
+
+def test_client_errors_are_not_retried(server, make_client):
+    server.faults = [{"status": 400}]
+    requests_before = len(server.chat_requests)
+    with pytest.raises(LLMError):
+        complete(make_client())
+    assert len(server.chat_requests) == requests_before + 1
+
+
+def test_broken_stream_resumes_without_repeating_tokens(server, make_client):
+    expected, _, _ = complete(make_client())
+    server.faults = [{"cut_after": 5}]
+    result, deltas, _ = complete(make_client())
+    assert result["attempts"] == 2
+    # Every token arrives once, in order, and the retry carried the partial answer
+    assert "".join(deltas) == result["text"] == expected["text"]
+    resumed = server.chat_requests[-1]["messages"][-1]
+    assert resumed == {"role": "assistant", "content": "".join(deltas[:5])}
+
+
+def test_slow_primary_is_hedged(server, make_client):
+    server.faults = [{"model": "primary", "delay_ms": 3000}]
+    client = make_client(hedge_model="backup", hedge_delay=0.2)
+    result, deltas, seconds = complete(client)
+    assert result["model"] == "backup" and result["hedged"]
+    assert seconds < 2
+    assert "".join(deltas) == result["text"]
+
+
+def test_fast_primary_is_not_hedged(server, make_client):
+    client = make_client(hedge_model="backup", hedge_delay=0.5)
+    requests_before = len(server.chat_requests)
+    result, _, _ = complete(client)
+    assert result["model"] == "primary" and not result["hedged"]
+    assert len(server.chat_requests) == requests_before + 1
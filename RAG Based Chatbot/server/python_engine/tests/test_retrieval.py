@@ -0,0 +1,33 @@
+import pytest
+
+pytest.importorskip("mongomock")
+
+from benchmark import use_mongomock, bulk_load  # noqa: E402
+use_mongomock()
+
+from db import client, collection  # noqa: E402
+import retrieval  # noqa: E402
+
+CHUNKS = [
+    "The lentil harvest in the northern valley depends on spring rainfall and soil drainage.",
+    "Crop rotation with lentils and wheat keeps nitrogen in the soil between seasons.",
+    "Irrigation schedules for pulses are planned around the expected rainfall each spring.",
+]
+
+
+@pytest.fixture(autouse=True)
+def corpus():
+    client.drop_database("rag_test")
+    bulk_load(collection, [(0, text) for text in CHUNKS], "farming.txt")
+    yield
+    client.drop_database("rag_test")
+
+
+def test_related_query_finds_chunk():
+    results = retrieval.retrieve_chunks(CHUNKS[0], top_k=3)
+    assert results and results[0]["text"] == CHUNKS[0]
+
+
+def test_unrelated_query_sharing_a_word_finds_nothing():
+    # "lentil" matches lexically, but the question is about something else
+    assert retrieval.retrieve_chunks("tell me about lentil astronomy galaxies quasars", top_k=3) == []
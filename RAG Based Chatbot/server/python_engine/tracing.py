@@ -0,0 +1,141 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Stage timings for the engine. Each request runs inside trace(op); span()
+# and count() inside it (on any thread that inherited the context, see
+# pipeline.prefetch) add to that request's Trace, which the engine sends as a
+# {"type": "metrics"} message. Everything is also folded into the process-wide
+# registry, rendered in Prometheus text format by the `metrics` op.
+
+_current = contextvars.ContextVar("trace", default=None)
+
+DURATION_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class Trace:
+    """Stage spans and counters of one request. Spans with the same name are merged."""
+
+    def __init__(self, op):
+        self.op = op
+        self.started = time.perf_counter()
+        self.spans = {}     # name -> {"start_ms", "ms", "count", **attrs}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add_span(self, name, started, ms, attrs):
+        with self.lock:
+            span = self.spans.get(name)
+            if span is None:
+                self.spans[name] = {"start_ms": round((started - self.started) * 1000, 1), "ms": ms, "count": 1, **attrs}
+            else:
+                span["ms"] += ms
+                span["count"] += 1
+                span.update(attrs)
+
+    def add_count(self, name, n):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_message(self):
+        with self.lock:
+            spans = [{"name": name, **span, "ms": round(span["ms"], 1)}
+                     for name, span in sorted(self.spans.items(), key=lambda item: item[1]["start_ms"])]
+            return {"op": self.op, "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+                    "spans": spans, "counters": dict(self.counters)}
+
+
+class Registry:
+    """Process-wide latency histograms (ms) per stage, event counters and gauges."""
+
+    def __init__(self, buckets=DURATION_BUCKETS_MS):
+        self.buckets = buckets
+        self.histograms = {}  # stage -> [bucket counts..., +Inf count, sum]
+        self.counters = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, ms):
+        with self.lock:
+            histogram = self.histograms.setdefault(name, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if ms <= bound:
+                    histogram[i] += 1
+            histogram[len(self.buckets)] += 1
+            histogram[-1] += ms
+
+    def increment(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def prometheus_text(self):
+        lines = ["# HELP rag_stage_duration_ms Time spent per pipeline stage.",
+                 "# TYPE rag_stage_duration_ms histogram"]
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                for bound, value in zip(self.buckets, histogram):
+                    lines.append(f'rag_stage_duration_ms_bucket{{stage="{name}",le="{bound}"}} {value}')
+                lines.append(f'rag_stage_duration_ms_bucket{{stage="{name}",le="+Inf"}} {histogram[len(self.buckets)]}')
+                lines.append(f'rag_stage_duration_ms_sum{{stage="{name}"}} {round(histogram[-1], 3)}')
+                lines.append(f'rag_stage_duration_ms_count{{stage="{name}"}} {histogram[len(self.buckets)]}')
+            lines += ["# HELP rag_events_total Cache hits, retries and other pipeline events.",
+                      "# TYPE rag_events_total counter"]
+            lines += [f'rag_events_total{{event="{name}"}} {value}' for name, value in sorted(self.counters.items())]
+            for name, value in sorted(self.gauges.items()):
+                lines += [f"# TYPE rag_{name} gauge", f"rag_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+
+@contextmanager
+def trace(op):
+    """Collect the spans of one request; yields its Trace."""
+    current = Trace(op)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        registry.observe(f"request.{op}", (time.perf_counter() - current.started) * 1000)
+
+@contextmanager
+def span(name, **attrs):
+    """Time a stage. The yielded dict can take attributes to attach to the span."""
+    started = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        record(name, (time.perf_counter() - started) * 1000, started, **attrs)
+
+def record(name, ms, started=None, **attrs):
+    """Add a stage timed elsewhere (e.g. time to first token, measured in a callback)."""
+    registry.observe(name, ms)
+    current = _current.get()
+    if current is not None:
+        current.add_span(name, started if started is not None else time.perf_counter() - ms / 1000, ms, attrs)
+
+def count(name, n=1):
+    if not n:
+        return
+    registry.increment(name, n)
+    current = _current.get()
+    if current is not None:
+        current.add_count(name, n)
+
+def timed(iterable, name):
+    """Yield from `iterable`, recording the time spent producing each item under `name`."""
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        record(name, (time.perf_counter() - started) * 1000, started)
+        yield item
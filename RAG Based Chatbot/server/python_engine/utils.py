@@ -7,6 +7,15 @@ try:
 except ImportError:
     InferenceClient = None
 
+_client = None
+
+def get_client():
+    # One client per process; building it per call costs a TLS handshake every time
+    global _client
+    if _client is None:
+        _client = InferenceClient(token=HF_API_KEY)
+    return _client
+
 def get_embedding(input_data):
 
     if not HF_API_KEY:
@@ -15,7 +24,7 @@ def get_embedding(input_data):
     if InferenceClient is None:
          raise ImportError("huggingface-hub not found. Please run start_rag.bat to install dependencies.")
 
-    client = InferenceClient(token=HF_API_KEY)
+    client = get_client()
     
     max_retries = 3
     retry_delay = 1
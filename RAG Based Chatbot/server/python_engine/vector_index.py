@@ -0,0 +1,348 @@
+import sys
+import time
+import threading
+import itertools
+from collections import OrderedDict
+import numpy as np
+from pymongo import ReturnDocument
+from config import INDEX_REFRESH_INTERVAL, INDEX_REFRESH_OVERLAP, MONGO_BATCH_SIZE
+from embedding_codec import PROJECTION, decode_embedding
+from db import find_in_batches
+
+SELECTION_CACHE_SIZE = 64
+
+_state_versions = itertools.count()
+
+# Bumped by ingestion running in this process so the next query refreshes
+# without waiting for INDEX_REFRESH_INTERVAL.
+_stale_generation = 0
+
+def mark_stale():
+    global _stale_generation
+    _stale_generation += 1
+
+def assign_seqs(collection, documents):
+    """Stamp documents with a monotonic insertion marker before insert_many.
+
+    The counter lives in the `counters` collection next to vectorStore, so
+    every writer (ingest.py, scrape.py) draws from the same sequence.
+    """
+    if not documents:
+        return
+    counter = collection.database['counters'].find_one_and_update(
+        {"_id": collection.name},
+        {"$inc": {"seq": len(documents)}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    first = counter["seq"] - len(documents) + 1
+    for offset, doc in enumerate(documents):
+        doc["seq"] = first + offset
+
+
+def group_rows(sources, offset=0):
+    """source -> sorted row numbers (counted from `offset`) of each source in `sources`."""
+    if not len(sources):
+        return {}
+    order = np.argsort(sources, kind='stable')
+    names, starts = np.unique(sources[order], return_index=True)
+    return {name: np.sort(rows) + offset for name, rows in zip(names, np.split(order, starts[1:]))}
+
+
+class IndexState:
+    """Immutable snapshot of the index; searches hold a reference while refreshes swap in a new one.
+
+    `base` is an earlier snapshot that this one only appends rows to: its
+    norms, row map and source rows are extended rather than rebuilt, so an
+    ingest batch costs a refresh in proportion to the batch, not the corpus.
+    """
+
+    def __init__(self, ids, sources, seqs, matrix, base=None):
+        self.ids = ids
+        self.sources = sources
+        self.seqs = seqs
+        self.matrix = matrix
+        self.version = next(_state_versions)  # snapshots made later have higher versions
+        start = len(base.ids) if base is not None else 0
+        if start:
+            self.norms = np.concatenate([base.norms, np.linalg.norm(matrix[start:], axis=1)])
+            self.row_of = base.row_of.copy()
+            self.row_of.update(zip(ids[start:], range(start, len(ids))))
+            # source -> rows; appended rows come after every existing one, so the lists stay sorted
+            self.source_rows = dict(base.source_rows)
+            for name, rows in group_rows(sources[start:], start).items():
+                previous = self.source_rows.get(name)
+                self.source_rows[name] = rows if previous is None else np.concatenate([previous, rows])
+        else:
+            self.norms = np.linalg.norm(matrix, axis=1) if len(matrix) else np.empty(0, dtype=np.float32)
+            self.row_of = {doc_id: row for row, doc_id in enumerate(ids)}
+            # source -> rows; chunks of one source are inserted together, so these are mostly contiguous ranges
+            self.source_rows = group_rows(sources)
+        self.source_ranges = {}   # source -> [(start, end)], built on first use
+        # Conversations keep asking about the same document sets; the snapshot never changes, so cache them
+        self.selections = OrderedDict()
+        self.lock = threading.Lock()
+
+    def selection(self, kind, active_documents, build):
+        key = (kind, frozenset(active_documents))
+        with self.lock:
+            if key in self.selections:
+                self.selections.move_to_end(key)
+                return self.selections[key]
+        value = build()
+        with self.lock:
+            self.selections[key] = value
+            while len(self.selections) > SELECTION_CACHE_SIZE:
+                self.selections.popitem(last=False)
+        return value
+
+    def rows_for(self, active_documents):
+        def build():
+            parts = [self.source_rows[s] for s in set(active_documents) if s in self.source_rows]
+            if not parts:
+                return np.empty(0, dtype=np.int64)
+            return np.sort(np.concatenate(parts))
+        return self.selection("rows", active_documents, build)
+
+    def ranges(self, source):
+        """The source's rows as contiguous (start, end) runs, so they can be scanned as matrix slices."""
+        if source not in self.source_ranges:
+            rows = self.source_rows.get(source, np.empty(0, dtype=np.int64))
+            breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+            starts = np.concatenate([rows[:1], rows[breaks]])
+            ends = np.concatenate([rows[breaks - 1], rows[-1:]]) + 1
+            self.source_ranges[source] = list(zip(starts.tolist(), ends.tolist()))
+        return self.source_ranges[source]
+
+    def ranges_for(self, active_documents):
+        return self.selection("ranges", active_documents,
+                              lambda: sorted(r for s in set(active_documents) for r in self.ranges(s)))
+
+
+def empty_state(dim=0):
+    return IndexState([], np.empty(0, dtype=object), np.empty(0, dtype=np.int64), np.empty((0, dim), dtype=np.float32))
+
+
+class VectorIndex:
+    """Process-resident copy of the vectorStore embeddings.
+
+    Loads the collection once, then refreshes incrementally: new chunks are
+    found through their `seq` insertion marker, and a cheap document count
+    check triggers an _id reconciliation, limited to the sources whose chunk
+    counts changed, when chunks were deleted (or written without a marker). Text and metadata stay in MongoDB and are fetched only
+    for the final top-k hits.
+    """
+
+    def __init__(self, collection, refresh_interval=INDEX_REFRESH_INTERVAL, refresh_overlap=INDEX_REFRESH_OVERLAP,
+                 segments=None):
+        self.collection = collection
+        self.segments = segments  # optional segments.SegmentStore for fast cold starts
+        self.refresh_interval = refresh_interval
+        self.refresh_overlap = refresh_overlap
+        self.state = empty_state()
+        self.lock = threading.Lock()
+        self.compact_lock = threading.Lock()
+        self.loaded = False
+        self.seen_generation = _stale_generation
+        self.last_refresh = 0.0
+        self.last_refresh_seconds = 0.0
+        self.last_change = None
+        # _id -> source of documents without a usable embedding; remembered so they don't look like pending inserts
+        self.skipped = {}
+        # Highest insertion marker ever loaded; survives deletion of those rows
+        self.seq_watermark = 0
+
+    # --- Loading ---
+
+    def fetch_rows(self, doc_ids=None):
+        """Download (ids, sources, seqs, vectors) for doc_ids, or for the whole collection."""
+        ids, sources, seqs, vectors = [], [], [], []
+        projection = {**PROJECTION, "source": 1, "seq": 1}
+        if doc_ids is None:
+            cursor = self.collection.find({}, projection, batch_size=MONGO_BATCH_SIZE)
+        else:
+            cursor = find_in_batches(self.collection, doc_ids, projection)
+        for doc in cursor:
+            emb = decode_embedding(doc)
+            if emb is None:
+                self.skipped[doc["_id"]] = doc.get("source") or ""
+                continue
+            ids.append(doc["_id"])
+            sources.append(doc.get("source") or "")
+            seqs.append(doc.get("seq", 0))
+            vectors.append(emb)
+        return ids, sources, seqs, vectors
+
+    def append_rows(self, state, ids, sources, seqs, vectors):
+        dim = state.matrix.shape[1] if len(state.ids) else len(vectors[0])
+        keep = [i for i, v in enumerate(vectors) if len(v) == dim]
+        if len(keep) < len(vectors):
+            self.skipped.update((ids[i], sources[i]) for i, v in enumerate(vectors) if len(v) != dim)
+            print(f"[WARN] Skipping {len(vectors) - len(keep)} chunks with mismatched embedding dimension", file=sys.stderr)
+        if not keep:
+            return state
+        new_matrix = np.stack([vectors[i] for i in keep])
+        matrix = np.concatenate([state.matrix.reshape(-1, dim), new_matrix]) if len(state.ids) else new_matrix
+        return IndexState(
+            state.ids + [ids[i] for i in keep],
+            np.concatenate([state.sources, np.array([sources[i] for i in keep], dtype=object)]),
+            np.concatenate([state.seqs, np.array([seqs[i] for i in keep], dtype=np.int64)]),
+            matrix,
+            base=state
+        )
+
+    def drop_rows(self, state, drop_ids):
+        keep = np.array([doc_id not in drop_ids for doc_id in state.ids], dtype=bool)
+        return IndexState(
+            [doc_id for doc_id, k in zip(state.ids, keep) if k],
+            state.sources[keep],
+            state.seqs[keep],
+            np.ascontiguousarray(state.matrix[keep])
+        )
+
+    def full_load(self):
+        if self.segments is not None:
+            ids, sources, seqs, matrix = self.segments.load()
+            if ids:
+                # Start from disk, then catch up with MongoDB like any other refresh
+                state = IndexState(ids, sources, seqs, matrix)
+                self.seq_watermark = int(seqs.max())
+                state, added, removed = self.incremental_refresh(state)
+                print(f"[INFO] Loaded {len(ids)} rows from {len(self.segments.loaded)} vector segments "
+                      f"(+{added} -{removed} from MongoDB)", file=sys.stderr)
+                return state
+
+        state = empty_state()
+        ids, sources, seqs, vectors = self.fetch_rows()
+        if ids:
+            state = self.append_rows(state, ids, sources, seqs, vectors)
+        return state
+
+    def incremental_refresh(self, state):
+        added = removed = 0
+
+        # New chunks: scan the insertion-marker tail. The overlap re-checks
+        # recent markers so a writer that allocated a lower seq but committed
+        # later is not missed; only unknown _ids are downloaded.
+        tail = self.collection.find({"seq": {"$gt": self.seq_watermark - self.refresh_overlap}}, {"_id": 1},
+                                    batch_size=MONGO_BATCH_SIZE)
+        new_ids = [doc["_id"] for doc in tail
+                   if doc["_id"] not in state.row_of and doc["_id"] not in self.skipped]
+        if new_ids:
+            fetched = self.fetch_rows(new_ids)
+            if fetched[0]:
+                state = self.append_rows(state, *fetched)
+                added += len(fetched[0])
+
+        # Deletions (or unmarked inserts) show up as a count mismatch. Per-source
+        # counts narrow the _id reconciliation to the sources that changed.
+        if self.collection.count_documents({}) != len(state.ids) + len(self.skipped):
+            changed = self.changed_sources(state)
+            names = changed + [None] if "" in changed else changed  # "" stands for chunks without a source
+            live_ids = {doc["_id"] for doc in self.collection.find({"source": {"$in": names}}, {"_id": 1},
+                                                                   batch_size=MONGO_BATCH_SIZE)}
+            self.skipped = {doc_id: source for doc_id, source in self.skipped.items()
+                            if source not in changed or doc_id in live_ids}
+            stale = {state.ids[row] for source in changed for row in state.source_rows.get(source, ())
+                     if state.ids[row] not in live_ids}
+            if stale:
+                state = self.drop_rows(state, stale)
+                removed += len(stale)
+            missing = [doc_id for doc_id in live_ids
+                       if doc_id not in state.row_of and doc_id not in self.skipped]
+            if missing:
+                fetched = self.fetch_rows(missing)
+                if fetched[0]:
+                    state = self.append_rows(state, *fetched)
+                    added += len(fetched[0])
+
+        return state, added, removed
+
+    def changed_sources(self, state):
+        """Sources whose chunk count in MongoDB differs from the snapshot's (skipped chunks included)."""
+        stored = {}
+        for group in self.collection.aggregate([{"$group": {"_id": "$source", "count": {"$sum": 1}}}]):
+            name = group["_id"] or ""
+            stored[name] = stored.get(name, 0) + group["count"]
+        loaded = {name: len(rows) for name, rows in state.source_rows.items()}
+        for source in self.skipped.values():
+            loaded[source] = loaded.get(source, 0) + 1
+        return [name for name in stored.keys() | loaded.keys() if stored.get(name, 0) != loaded.get(name, 0)]
+
+    def refresh(self, force=False):
+        now = time.time()
+        due = (not self.loaded or force or self.seen_generation != _stale_generation
+               or now - self.last_refresh >= self.refresh_interval)
+        if not due:
+            return
+
+        with self.lock:
+            if self.loaded and not force and now < self.last_refresh:
+                return
+            started = time.time()
+            generation = _stale_generation
+            if not self.loaded:
+                self.state = self.full_load()
+                self.loaded = True
+                added, removed = len(self.state.ids), 0
+            else:
+                self.state, added, removed = self.incremental_refresh(self.state)
+            self.seen_generation = generation
+            if len(self.state.seqs):
+                self.seq_watermark = max(self.seq_watermark, int(self.state.seqs.max()))
+            self.last_refresh = time.time()
+            self.last_refresh_seconds = self.last_refresh - started
+            if added or removed:
+                self.last_change = self.last_refresh
+                print(f"[INFO] Vector index refreshed: +{added} -{removed} rows in {self.last_refresh_seconds * 1000:.1f}ms "
+                      f"({len(self.state.ids)} rows, {self.state.matrix.nbytes / (1024 * 1024):.1f} MB matrix)", file=sys.stderr)
+
+    def compact_segments(self):
+        """Merge the vector segments into one file if there are too many or too many dead rows.
+
+        This writes the whole matrix, so it isn't done by refresh() on the
+        query path: the engine calls it after ingestion. It works from an
+        immutable snapshot and doesn't hold the index lock.
+        """
+        if self.segments is None or not self.compact_lock.acquire(blocking=False):
+            return
+        try:
+            state = self.snapshot()
+            if self.segments.needs_compaction(len(state.ids)):
+                self.segments.compact(state)
+        except Exception as e:
+            print(f"[WARN] Vector segment compaction failed: {e}", file=sys.stderr)
+        finally:
+            self.compact_lock.release()
+
+    # --- Querying ---
+
+    def snapshot(self):
+        self.refresh()
+        return self.state
+
+    def stats(self):
+        state = self.state
+        memory = state.matrix.nbytes + state.norms.nbytes + state.seqs.nbytes + state.sources.nbytes
+        # ObjectIds and the row map are ~100 bytes per row of Python object overhead
+        memory += len(state.ids) * 100
+        return {
+            "rows": len(state.ids),
+            "dim": int(state.matrix.shape[1]) if state.matrix.ndim == 2 else 0,
+            "sources": len(state.source_rows),
+            "memory_mb": round(memory / (1024 * 1024), 2),
+            "max_seq": self.seq_watermark,
+            "last_refresh_ms": round(self.last_refresh_seconds * 1000, 1),
+            "refresh_lag_seconds": round(time.time() - self.last_refresh, 1) if self.loaded else None,
+            "pending_chunks": self.pending_chunks(),
+        }
+
+    def pending_chunks(self):
+        # Markers handed out by assign_seqs that this index has not loaded yet
+        try:
+            counter = self.collection.database['counters'].find_one({"_id": self.collection.name})
+        except Exception:
+            return None
+        if not counter:
+            return 0
+        return max(0, counter["seq"] - self.seq_watermark)
@@ -5,7 +5,6 @@ const ragService = require('../services/aiService');
 const multer = require('multer');
 const path = require('path');
 const fs = require('fs');
-const { spawn } = require('child_process');
 
 const Conversation = require('../models/Conversation');
 
@@ -103,12 +102,35 @@ router.get('/documents', async (req, res) => {
     }
 });
 
+// In-memory vector index size and refresh lag (for host sizing)
+router.get('/index-stats', async (req, res) => {
+    try {
+        const stats = await ragService.getIndexStats();
+        res.json(stats);
+    } catch (error) {
+        console.error("Error fetching index stats:", error);
+        res.status(500).json({ error: "Failed to fetch index stats" });
+    }
+});
+
+// Get engine stage metrics (Prometheus text format)
+router.get('/metrics', async (req, res) => {
+    try {
+        const text = await ragService.getMetrics();
+        res.type('text/plain; version=0.0.4').send(text);
+    } catch (error) {
+        console.error("Error fetching metrics:", error);
+        res.status(500).json({ error: "Failed to fetch metrics" });
+    }
+});
+
 // Delete document chunks
 router.delete('/documents/:filename', async (req, res) => {
     try {
         const filename = req.params.filename;
         const collection = mongoose.connection.collection('vectorStore');
         const result = await collection.deleteMany({ source: filename });
+        await mongoose.connection.collection('sourceManifests').deleteOne({ _id: filename });
         res.json({ message: `Deleted ${result.deletedCount} chunks for ${filename}` });
     } catch (error) {
         console.error("Error deleting document:", error);
@@ -172,7 +194,12 @@ router.post('/chat', async (req, res) => {
                 conversation.lastUpdated = new Date();
                 await conversation.save();
 
-                res.write(`data: ${JSON.stringify({ type: 'metadata', sources: metadata.sources || [], followups: metadata.followups || [] })}\n\n`);
+                if (metadata.usage && metadata.usage.prompt_tokens !== undefined) {
+                    const { prompt_tokens, ttft_ms, total_ms } = metadata.usage;
+                    console.log(`[Chat] Prompt ~${prompt_tokens} tokens, first token ${ttft_ms}ms, total ${total_ms}ms`);
+                }
+
+                res.write(`data: ${JSON.stringify({ type: 'metadata', sources: metadata.sources || [], followups: metadata.followups || [], usage: metadata.usage })}\n\n`);
                 res.end();
             },
             (error) => {
@@ -208,75 +235,31 @@ const storage = multer.diskStorage({
 const upload = multer({ storage: storage });
 
 // Upload Endpoint
-router.post('/upload', upload.single('file'), (req, res) => {
+router.post('/upload', upload.single('file'), async (req, res) => {
     if (!req.file) {
         return res.status(400).json({ error: "No file uploaded" });
     }
 
+    // With the resident engine ingestion runs as a background job; the client follows it on /jobs/:id
+    if (ragService.useResidentEngine) {
+        return queueFileJob(req, res);
+    }
+
     const filePath = req.file.path;
     console.log(`[Upload] Processing file: ${filePath}`);
 
-    // Spawn Python ingestion script
-    // Note: Assuming we are in server/ directory when running node
-    const pythonScriptPath = path.join(__dirname, '../python_engine/ingest.py');
-
-    // Use python3 (standard for Render/Linux) or custom path
-    const pythonCommand = process.env.PYTHON_PATH || (process.platform === 'win32' ? 'python' : 'python3');
-    const pythonProcess = spawn(pythonCommand, [pythonScriptPath, filePath]);
-
-    // Add a timeout for uploads (60 seconds)
-    const timeout = setTimeout(() => {
-        pythonProcess.kill();
-        console.error(`[Upload] Python script timed out for file: ${filePath}`);
-    }, 60000);
-
-    let output = "";
-    let errorOutput = "";
-
-    pythonProcess.stdout.on('data', (data) => {
-        output += data.toString();
-    });
-
-    pythonProcess.stderr.on('data', (data) => {
-        errorOutput += data.toString();
-    });
-
-    pythonProcess.on('error', (err) => {
-        clearTimeout(timeout);
-        console.error(`[Ingest Spawn Error]: ${err.message}`);
-        errorOutput += `\nSpawn Error: ${err.message}`;
-    });
-
-    pythonProcess.on('close', (code) => {
-        clearTimeout(timeout);
-        const exitMessage = code === 0 ? "success" : `failed with code ${code}`;
-        console.log(`[Upload] Python process finished with: ${exitMessage}`);
-
-        if (code !== 0) {
-            console.error(`[Upload Details] Stderr: ${errorOutput}`);
-        }
-
-        // Clean up file after processing
-        try {
-            if (fs.existsSync(filePath)) {
-                fs.unlinkSync(filePath);
-                console.log(`[Upload] Cleaned up file: ${filePath}`);
-            }
-        } catch (cleanupErr) {
-            console.error(`[Upload] Failed to delete file: ${filePath}`, cleanupErr);
-        }
-
-        if (code === 0) {
-            res.json({ message: "File processed successfully", details: output });
-        } else {
-            console.error(`[Upload Failed] Code: ${code}, Error: ${errorOutput}`);
-            res.status(500).json({
-                error: "Ingestion failed",
-                details: errorOutput || "Unknown python script error",
-                exitCode: code
-            });
-        }
-    });
+    // ingestFile deletes the upload once Python is done with it
+    try {
+        const result = await ragService.ingestFile(filePath, req.file.originalname);
+        console.log(`[Upload] Python ingestion finished with: success`);
+        res.json({ message: "File processed successfully", details: result.details });
+    } catch (error) {
+        console.error(`[Upload Failed] Error: ${error.message}`);
+        res.status(500).json({
+            error: "Ingestion failed",
+            details: error.message || "Unknown python script error"
+        });
+    }
 });
 
 // Ingest Web URL Endpoint
@@ -286,63 +269,130 @@ router.post('/ingest-url', async (req, res) => {
         return res.status(400).json({ error: "No URL provided" });
     }
 
+    if (ragService.useResidentEngine) {
+        return queueUrlJob(res, url, isDeep);
+    }
+
     console.log(`[URL Ingest] Processing URL: ${url} (Deep: ${isDeep})`);
 
-    const pythonScriptPath = path.join(__dirname, '../python_engine/scrape.py');
-    const pythonCommand = process.env.PYTHON_PATH || (process.platform === 'win32' ? 'python' : 'python3');
+    try {
+        const result = await ragService.ingestUrl(url, isDeep);
+        console.log(`[URL Ingest] Python ingestion finished with: success`);
+        res.json({ message: result.message || "URL processed successfully", details: result });
+    } catch (error) {
+        console.error(`[URL Ingest Failed] Error: ${error.message}`);
+        res.status(500).json({
+            error: "URL Ingestion failed",
+            details: error.message || "Unknown python script error"
+        });
+    }
+});
 
-    const args = [pythonScriptPath, url];
-    if (isDeep) args.push('--deep');
+// --- Background Ingestion Jobs ---
+// The job endpoints return as soon as the job is queued; progress is polled or streamed.
 
-    const pythonProcess = spawn(pythonCommand, args);
+const FINISHED_JOB_STATES = ['done', 'failed', 'cancelled'];
 
-    const timeout = setTimeout(() => {
-        pythonProcess.kill();
-        console.error(`[URL Ingest] Python script timed out for URL: ${url}`);
-    }, 300000); // 5 minute timeout for large embeddings
+const sendJobError = (res, error, fallback) => {
+    const status = /Unknown job/.test(error.message) ? 404 : 500;
+    res.status(status).json({ error: fallback, details: error.message });
+};
 
-    let output = "";
-    let errorOutput = "";
+// Queue an uploaded file; the engine deletes it once the job has finished
+async function queueFileJob(req, res) {
+    try {
+        const source = req.file.originalname.replace(/[^a-zA-Z0-9.-]/g, '_');
+        const job = await ragService.submitIngestJob('file', { file_path: req.file.path, source, delete_file: true });
+        console.log(`[Jobs] Queued ${job.id} for file ${req.file.originalname}`);
+        res.status(202).json(job);
+    } catch (error) {
+        console.error("Error queueing upload:", error);
+        fs.unlink(req.file.path, () => {});
+        res.status(500).json({ error: "Failed to queue ingestion", details: error.message });
+    }
+}
+
+async function queueUrlJob(res, url, isDeep) {
+    try {
+        const job = await ragService.submitIngestJob('url', { url, deep_crawl: !!isDeep });
+        console.log(`[Jobs] Queued ${job.id} for URL ${url} (Deep: ${isDeep})`);
+        res.status(202).json(job);
+    } catch (error) {
+        console.error("Error queueing URL ingestion:", error);
+        res.status(500).json({ error: "Failed to queue ingestion", details: error.message });
+    }
+}
 
-    pythonProcess.stdout.on('data', (data) => {
-        output += data.toString();
-    });
+router.post('/jobs/upload', upload.single('file'), (req, res) => {
+    if (!req.file) {
+        return res.status(400).json({ error: "No file uploaded" });
+    }
+    return queueFileJob(req, res);
+});
+
+router.post('/jobs/url', (req, res) => {
+    const { url, isDeep } = req.body;
+    if (!url) {
+        return res.status(400).json({ error: "No URL provided" });
+    }
+    return queueUrlJob(res, url, isDeep);
+});
 
-    pythonProcess.stderr.on('data', (data) => {
-        errorOutput += data.toString();
-    });
+// Recent jobs, newest first (optionally ?status=running)
+router.get('/jobs', async (req, res) => {
+    try {
+        const limit = Math.min(parseInt(req.query.limit, 10) || 50, 500);
+        res.json(await ragService.listJobs(limit, req.query.status));
+    } catch (error) {
+        console.error("Error listing jobs:", error);
+        res.status(500).json({ error: "Failed to list jobs" });
+    }
+});
 
-    pythonProcess.on('error', (err) => {
-        clearTimeout(timeout);
-        console.error(`[URL Ingest Spawn Error]: ${err.message}`);
-        errorOutput += `\nSpawn Error: ${err.message}`;
-    });
+router.get('/jobs/:id', async (req, res) => {
+    try {
+        res.json(await ragService.getJob(req.params.id));
+    } catch (error) {
+        sendJobError(res, error, "Failed to fetch job");
+    }
+});
 
-    pythonProcess.on('close', (code) => {
-        clearTimeout(timeout);
-        const exitMessage = code === 0 ? "success" : `failed with code ${code}`;
-        console.log(`[URL Ingest] Python process finished with: ${exitMessage}`);
+// Cancel a job: queued jobs are dropped, running ones stop at their next batch and roll back
+router.delete('/jobs/:id', async (req, res) => {
+    try {
+        res.json(await ragService.cancelJob(req.params.id));
+    } catch (error) {
+        sendJobError(res, error, "Failed to cancel job");
+    }
+});
 
-        if (code !== 0) {
-            console.error(`[URL Ingest Details] Stderr: ${errorOutput}`);
-        }
+// Stream a job's progress as SSE until it finishes
+router.get('/jobs/:id/events', async (req, res) => {
+    let job;
+    try {
+        job = await ragService.getJob(req.params.id);
+    } catch (error) {
+        return sendJobError(res, error, "Failed to fetch job");
+    }
 
-        if (code === 0) {
-            try {
-                const parsedOutput = JSON.parse(output.trim());
-                res.json({ message: parsedOutput.message || "URL processed successfully", details: parsedOutput });
-            } catch (e) {
-                res.json({ message: "URL processed successfully, but output parsing failed", details: output });
-            }
-        } else {
-            console.error(`[URL Ingest Failed] Code: ${code}, Error: ${errorOutput}`);
-            res.status(500).json({
-                error: "URL Ingestion failed",
-                details: errorOutput || "Unknown python script error",
-                exitCode: code
-            });
-        }
-    });
+    res.setHeader('Content-Type', 'text/event-stream');
+    res.setHeader('Cache-Control', 'no-cache');
+    res.setHeader('Connection', 'keep-alive');
+
+    const onJob = (update) => {
+        if (update.id !== job.id) return;
+        res.write(`data: ${JSON.stringify({ type: 'job', job: update })}\n\n`);
+        if (FINISHED_JOB_STATES.includes(update.status)) stop();
+    };
+    const stop = () => {
+        ragService.off('job', onJob);
+        res.end();
+    };
+
+    res.write(`data: ${JSON.stringify({ type: 'job', job })}\n\n`);
+    if (FINISHED_JOB_STATES.includes(job.status)) return res.end();
+    ragService.on('job', onJob);
+    req.on('close', () => ragService.off('job', onJob));
 });
 
 module.exports = router;
@@ -1,18 +1,156 @@
 const { spawn } = require('child_process');
 const path = require('path');
+const fs = require('fs');
+const readline = require('readline');
+const { EventEmitter } = require('events');
 
 
 const PYTHON_SCRIPT_DIR = path.join(__dirname, '../python_engine');
 const INGEST_SCRIPT = path.join(PYTHON_SCRIPT_DIR, 'ingest.py');
+const SCRAPE_SCRIPT = path.join(PYTHON_SCRIPT_DIR, 'scrape.py');
 const RETRIEVAL_SCRIPT = path.join(PYTHON_SCRIPT_DIR, 'retrieval.py');
 const GENERATION_SCRIPT = path.join(PYTHON_SCRIPT_DIR, 'generation.py');
+const ENGINE_SCRIPT = path.join(PYTHON_SCRIPT_DIR, 'engine_server.py');
 
-class AIService {
+const getPythonCommand = () => process.env.PYTHON_PATH || (process.platform === 'win32' ? 'python' : 'python3');
+
+class AIService extends EventEmitter {
     constructor() {
-        console.log("AIService initialized in Hybrid Mode (Python backend).");
+        super();
+        // One 'job' listener per open job progress stream
+        this.setMaxListeners(0);
+        // PYTHON_ENGINE_MODE=spawn restores the old one-process-per-request behaviour
+        this.useResidentEngine = process.env.PYTHON_ENGINE_MODE !== 'spawn';
+        this.engine = null;
+        this.nextRequestId = 1;
+        console.log(`AIService initialized in Hybrid Mode (Python backend, ${this.useResidentEngine ? 'resident engine' : 'spawn per request'}).`);
     }
 
 
+    // --- Resident engine (python_engine/engine_server.py) ---
+
+    getEngine() {
+        if (this.engine) return this.engine;
+
+        const engine = spawn(getPythonCommand(), [ENGINE_SCRIPT], { cwd: PYTHON_SCRIPT_DIR });
+        // Requests are tracked per engine, so a dying engine only fails what was sent to it
+        const pending = new Map();
+        engine.pending = pending;
+        const rl = readline.createInterface({ input: engine.stdout });
+
+        rl.on('line', (line) => {
+            if (!line.trim()) return;
+            let message;
+            try {
+                message = JSON.parse(line);
+            } catch (e) {
+                console.log("[Python Engine Non-JSON]:", line);
+                return;
+            }
+
+            if (message.type === 'ready') {
+                console.log(`[Python Engine]: ready in ${message.startup_ms}ms`);
+                return;
+            }
+
+            if (message.type === 'job') {
+                // Background ingestion job changed state; not tied to a request
+                this.emit('job', message.job);
+                return;
+            }
+
+            const handlers = pending.get(message.id);
+            if (!handlers) return;
+
+            if (message.type === 'chunk') {
+                handlers.onChunk && handlers.onChunk(message.text);
+            } else if (message.type === 'metrics') {
+                // Per-stage timings, sent just before the request's final message
+                const stages = message.spans.map((span) => `${span.name}=${span.ms}ms`).join(' ');
+                console.log(`[Python Engine Metrics]: ${message.op} ${message.total_ms}ms ${stages}`);
+            } else if (message.type === 'metadata' || message.type === 'result') {
+                pending.delete(message.id);
+                handlers.onDone(message);
+            } else if (message.type === 'error') {
+                pending.delete(message.id);
+                handlers.onError(new Error(message.error));
+            }
+        });
+
+        engine.stderr.on('data', (data) => {
+            console.error(`[Python Engine Log]: ${data.toString()}`);
+        });
+
+        const failPending = (err) => {
+            if (this.engine === engine) this.engine = null;
+            for (const handlers of pending.values()) {
+                handlers.onError(err);
+            }
+            pending.clear();
+        };
+
+        engine.on('error', (err) => {
+            console.error(`[Python Engine Spawn Error]: ${err.message}`);
+            failPending(err);
+        });
+
+        engine.on('exit', (code) => {
+            console.error(`[Python Engine]: exited with code ${code}, will restart on next request`);
+            failPending(new Error(`Python engine exited with code ${code}`));
+        });
+
+        // A write racing the engine's death fails with EPIPE, which would crash the server unhandled
+        engine.stdin.on('error', (err) => {
+            console.error(`[Python Engine stdin Error]: ${err.message}, will restart on next request`);
+            failPending(err);
+            engine.kill();
+        });
+
+        this.engine = engine;
+        return engine;
+    }
+
+    // Returns a function that stops waiting for the request (true if it was still pending)
+    sendEngineRequest(op, payload, handlers) {
+        const id = String(this.nextRequestId++);
+        let engine = null;
+        try {
+            engine = this.getEngine();
+            engine.pending.set(id, handlers);
+            engine.stdin.write(JSON.stringify({ id, op, ...payload }) + '\n');
+        } catch (err) {
+            if (engine) engine.pending.delete(id);
+            handlers.onError(err);
+        }
+        return () => engine !== null && engine.pending.delete(id);
+    }
+
+    callEngine(op, payload, timeoutMs) {
+        return new Promise((resolve, reject) => {
+            let timeout = null;
+            const forget = this.sendEngineRequest(op, payload, {
+                onDone: (message) => {
+                    clearTimeout(timeout);
+                    resolve(message);
+                },
+                onError: (err) => {
+                    clearTimeout(timeout);
+                    reject(err);
+                }
+            });
+
+            // The engine keeps working on the request; we only stop waiting for it
+            timeout = setTimeout(() => {
+                if (forget()) {
+                    reject(new Error(`Python engine request '${op}' timed out after ${timeoutMs / 1000} seconds`));
+                }
+            }, timeoutMs);
+        });
+    }
+
+
+    // --- Legacy spawn-per-request mode ---
+
     parsePythonOutput(output) {
         try {
             return JSON.parse(output);
@@ -23,38 +161,37 @@ class AIService {
     }
 
 
-    async runPythonScript(scriptPath, args = [], inputJson = null) {
+    async runPythonScript(scriptPath, args = [], inputJson = null, timeoutMs = 45000) {
         return new Promise((resolve, reject) => {
 
-            const pythonCommand = process.env.PYTHON_PATH || (process.platform === 'win32' ? 'python' : 'python3');
-            const process = spawn(pythonCommand, [scriptPath, ...args]);
+            const child = spawn(getPythonCommand(), [scriptPath, ...args]);
 
 
             const timeout = setTimeout(() => {
-                process.kill();
-                reject(new Error(`Python script timed out after 45 seconds: ${scriptPath}`));
-            }, 45000);
+                child.kill();
+                reject(new Error(`Python script timed out after ${timeoutMs / 1000} seconds: ${scriptPath}`));
+            }, timeoutMs);
 
             let stdoutData = "";
             let stderrData = "";
 
-            process.stdout.on('data', (data) => {
+            child.stdout.on('data', (data) => {
                 stdoutData += data.toString();
             });
 
-            process.stderr.on('data', (data) => {
+            child.stderr.on('data', (data) => {
                 const msg = data.toString();
                 stderrData += msg;
                 console.error(`[Python Log]: ${msg}`);
             });
 
-            process.on('error', (err) => {
+            child.on('error', (err) => {
                 clearTimeout(timeout);
                 console.error(`[Python Spawn Error]: ${err.message}`);
                 reject(err);
             });
 
-            process.on('close', (code) => {
+            child.on('close', (code) => {
                 clearTimeout(timeout);
                 if (code !== 0) {
                     console.error(`Python script error (${scriptPath}):`, stderrData);
@@ -65,25 +202,85 @@ class AIService {
             });
 
             if (inputJson) {
-                process.stdin.write(JSON.stringify(inputJson));
-                process.stdin.end();
+                child.stdin.write(JSON.stringify(inputJson));
+                child.stdin.end();
             }
         });
     }
 
+    // Synchronous ingestion, used in spawn mode; with the resident engine the routes submit jobs instead
     async ingestFile(filePath, originalFilename) {
         console.log(`Ingesting file via Python: ${filePath}`);
+        // Stable source name (multer's sanitizing, without the upload suffix) so a
+        // re-upload of the same file updates its chunks instead of duplicating them
+        const source = originalFilename ? originalFilename.replace(/[^a-zA-Z0-9.-]/g, '_') : undefined;
         try {
-
-            const output = await this.runPythonScript(INGEST_SCRIPT, [filePath]);
-            console.log("Ingest output:", output);
-            return { message: "Ingestion complete" };
+            const args = source ? [filePath, source] : [filePath];
+            try {
+                const output = await this.runPythonScript(INGEST_SCRIPT, args, null, 60000);
+                console.log("Ingest output:", output);
+                return { message: "Ingestion complete", details: output };
+            } finally {
+                // The script has exited (or was killed on timeout), so nothing reads the file any more
+                fs.unlink(filePath, (err) => {
+                    if (err && err.code !== 'ENOENT') console.error(`Failed to delete file: ${filePath}`, err);
+                });
+            }
         } catch (error) {
             console.error("Ingestion failed:", error);
             throw error;
         }
     }
 
+    async ingestUrl(url, isDeep = false) {
+        console.log(`Ingesting URL via Python: ${url} (Deep: ${isDeep})`);
+        const args = [url];
+        if (isDeep) args.push('--deep');
+        const output = await this.runPythonScript(SCRAPE_SCRIPT, args, null, 300000);
+        return this.parsePythonOutput(output);
+    }
+
+    async getIndexStats() {
+        if (!this.useResidentEngine) {
+            throw new Error("Index stats are only available with the resident Python engine");
+        }
+        return this.callEngine('index_stats', {}, 15000);
+    }
+
+    // --- Background ingestion jobs (python_engine/jobs.py) ---
+
+    async submitIngestJob(kind, params) {
+        if (!this.useResidentEngine) {
+            throw new Error("Background jobs are only available with the resident Python engine");
+        }
+        const result = await this.callEngine('submit_job', { kind, params }, 15000);
+        return result.job;
+    }
+
+    async getJob(jobId) {
+        const result = await this.callEngine('job_status', { job_id: jobId }, 15000);
+        return result.job;
+    }
+
+    async listJobs(limit = 50, status) {
+        const result = await this.callEngine('list_jobs', { limit, status }, 15000);
+        return result.jobs;
+    }
+
+    async cancelJob(jobId) {
+        const result = await this.callEngine('cancel_job', { job_id: jobId }, 15000);
+        return result.job;
+    }
+
+    // Stage latency histograms and counters in Prometheus text format
+    async getMetrics() {
+        if (!this.useResidentEngine) {
+            throw new Error("Metrics are only available with the resident Python engine");
+        }
+        const result = await this.callEngine('metrics', {}, 15000);
+        return result.text;
+    }
+
     // generateAnswer is no longer used (replaced by generateAnswerStream)
 
     generateAnswerStream(query, history = [], settings = {}, onChunk, onMetadata, onError) {
@@ -97,10 +294,13 @@ class AIService {
             active_documents: settings.activeDocuments || []
         };
 
-        const pythonCommand = process.env.PYTHON_PATH || (process.platform === 'win32' ? 'python' : 'python3');
-        const child = spawn(pythonCommand, [GENERATION_SCRIPT]);
+        if (this.useResidentEngine) {
+            this.sendEngineRequest('generate', inputPayload, { onChunk, onDone: onMetadata, onError });
+            return;
+        }
+
+        const child = spawn(getPythonCommand(), [GENERATION_SCRIPT]);
 
-        const readline = require('readline');
         const rl = readline.createInterface({ input: child.stdout });
 
         rl.on('line', (line) => {
@@ -133,4 +333,3 @@ class AIService {
 }
 
 module.exports = new AIService();
-